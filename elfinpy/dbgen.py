@@ -5,6 +5,8 @@ import codecs
 import json
 import argparse
 import shutil
+import hashlib
+import multiprocessing
 from collections import defaultdict
 from collections import OrderedDict
 
@@ -12,9 +14,15 @@ import Bio.PDB
 
 from utilities import *
 from pdb_utilities import *
+from module_library import ModuleLibrary, ModuleLibraryWriter
+from kabsch import superimpose
 
 nested_dict = lambda: defaultdict(nested_dict)
 
+# Part of every module cache key. Bump it whenever a change here alters the
+# alignment results, so that old cache entries are not reused.
+MODULE_CACHE_VERSION = 3
+
 def parse_args(args):
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -23,6 +31,20 @@ def parse_args(args):
     parser.add_argument('--metadata_dir', default='./resources/metadata/')
     parser.add_argument('--output', default='./resources/xdb.json')
     parser.add_argument('--aligned_pdb_dir', default='./resources/pdb_aligned/')
+    parser.add_argument('--relaxed_library', default='',
+        help='Module library to read relaxed modules from instead of relaxed_pdbs_dir.')
+    parser.add_argument('--aligned_library', default='./resources/aligned_modules.eml',
+        help='Module library file to save aligned modules to. Empty to skip.')
+    parser.add_argument('--skip_aligned_pdbs', action='store_true',
+        help='Only save aligned modules to aligned_library, not as PDBs.')
+    parser.add_argument('-w', '--worker_count', default='1',
+        help='Number of processes aligning doubles and hubs, or cpu_count.')
+    parser.add_argument('--cache_dir', default='',
+        help='Directory to keep per-module results in. When given, only modules '
+        'whose inputs changed since the last run are aligned again.')
+    parser.add_argument('--writer_threads', type=int, default=1,
+        help='Number of threads writing aligned PDBs and cache entries while '
+        'the next modules are aligned. 0 writes them in the aligning thread.')
     return parser.parse_args(args)
 
 def main(test_args=None):
@@ -33,7 +55,13 @@ def main(test_args=None):
         args.relaxed_pdbs_dir,
         args.metadata_dir,
         args.aligned_pdb_dir,
-        args.output
+        args.output,
+        relaxed_library=args.relaxed_library,
+        aligned_library=args.aligned_library,
+        export_pdbs=not args.skip_aligned_pdbs,
+        worker_count=parse_worker_count(args.worker_count),
+        cache_dir=args.cache_dir,
+        writer_threads=args.writer_threads
     ).run()
 
 class XDBGenerator:
@@ -42,33 +70,75 @@ class XDBGenerator:
         relaxed_pdbs_dir,
         metadata_dir,
         aligned_pdb_dir,
-        out_file
+        out_file,
+        relaxed_library='',
+        aligned_library='',
+        export_pdbs=True,
+        worker_count=1,
+        cache_dir='',
+        writer_threads=1
     ):
         self.relaxed_pdbs_dir = relaxed_pdbs_dir
         module_types = ['doubles', 'singles', 'hubs']
         shutil.move('metadata','resources/metadata' )
-        make_dir(aligned_pdb_dir)
-        for mt in module_types:
-            make_dir(aligned_pdb_dir + '/{}/'.format(mt))
+        if export_pdbs:
+            make_dir(aligned_pdb_dir)
+            for mt in module_types:
+                make_dir(aligned_pdb_dir + '/{}/'.format(mt))
+
+        # Optionally read relaxed modules from, and save aligned modules to,
+        # module libraries instead of PDB trees.
+        self.relaxed_library  = ModuleLibrary(relaxed_library) if relaxed_library else None
+        self.aligned_library  = aligned_library
+        self.library_writer   = ModuleLibraryWriter() if aligned_library else None
+        self.export_pdbs      = export_pdbs
+        self.worker_count     = worker_count
+
+        # Aligned PDBs and cache entries are written in the background. Modules
+        # handed to the writer must not be changed afterwards.
+        self.writer           = BackgroundWriter(writer_threads)
+
+        # Content-addressed per-module results, keyed by module_key()
+        self.cache            = ModuleCache(cache_dir) if cache_dir else None
+        self.module_keys      = defaultdict(dict)
+        self.n_reused         = 0
 
         self.hub_info         = read_json(metadata_dir + '/hub_info.json')
         self.aligned_pdb_dir  = aligned_pdb_dir
         self.out_file         = out_file
-        self.si               = Bio.PDB.Superimposer()
         self.modules          = nested_dict()
         self.n_to_c_tx        = []
         self.hub_tx           = []
 
-        # Cache in memory because disk I/O is really heavy here
-        self.single_pdbs      = defaultdict(dict)
-        self.double_pdbs      = defaultdict(dict)
-
-    def find_tip(self, term, struct, chain_id):
+        # Single to single tx_ids by mod_a (forward) and by mod_b (reverse),
+        # in tx_id order, so hubs find their component's doubles directly.
+        self.tx_ids_by_mod_a  = defaultdict(list)
+        self.tx_ids_by_mod_b  = defaultdict(list)
+
+        # CA-only ModuleRecords of centred singles and aligned doubles, which
+        # is all that aligning doubles and hubs needs. Full atoms are only
+        # kept until they are exported, so memory does not grow with them.
+        self.single_records   = {}
+        self.double_records   = defaultdict(dict)
+
+    def __getstate__(self):
+        # Pool workers only align modules; the xdb entries and the module
+        # library are built by the parent process.
+        state = self.__dict__.copy()
+        state['modules'] = None
+        state['hub_tx'] = None
+        state['library_writer'] = None
+        state['cache'] = None
+        state['writer'] = None
+        return state
+
+    def find_tip(self, term, chain_block):
+        """Returns the tip of a chain terminus, from the carbon alpha
+        coordinates of the chain's AtomBlock.
+        """
         term = term.lower()
         assert(term in {'c', 'n'})
-        chain = get_chain(struct, chain_id=chain_id)
-        residues = chain.child_list
-        n = len(residues)
+        n = chain_block.n_residues
         divider = 6  # The smaller the divider, the closer to terminus.
 
         assert(n > 0)
@@ -77,9 +147,8 @@ class XDBGenerator:
         else:
             start_idx, end_idx = (divider-1)*n//divider, n
 
-        sum_coord = np.asarray([0., 0., 0.])
-        for r in residues[start_idx:end_idx]:
-            sum_coord += r['CA'].get_coord().astype('float64')
+        sum_coord = chain_block.residues(start_idx, end_idx) \
+            .ca_atoms().coord.sum(axis=0)
 
         tip_vector = sum_coord/(end_idx - start_idx - 1)
 
@@ -93,21 +162,34 @@ class XDBGenerator:
                 ('mod_a_chain', a_chain),
                 ('mod_b', mod_b),
                 ('mod_b_chain', b_chain),
-                ('rot', rot.tolist()),
+                ('rot', np.asarray(rot).tolist()),
                 ('tran', np.asarray(tran).tolist())
             ])
         return tx_entry
 
     def process_hub(self, file_name):
+        """Aligns a hub module and adds its transforms to the xdb."""
+        self.add_hub(*self.align_hub(file_name))
+
+    def align_hub(self, file_name):
         """Aligns a hub module to its A component (chain A), then computes the
         transform for aligning itself to its other components.
+
+        Only reads generator state, so it can run in a pool worker.
+
+        Returns:
+        - (hub_name, hub, geometry, links) - the centred hub, its
+            get_geometry() descriptors, and a
+            list of (term, hub_chain_id, single_name, single_chain_id, rot,
+            tran) tuples in the order their tx_ids are to be assigned.
         """
 
         # Load structures
-        hub = read_pdb(file_name)
+        hub = self.read_module(file_name)
 
         # Centre the hub
-        self.move_to_origin(hub)
+        hub_blocks = self.move_to_origin(hub)
+        hub_record = ModuleRecord.from_module(hub_blocks)
 
         hub_fusion_factor = 4
 
@@ -117,21 +199,8 @@ class XDBGenerator:
         if hub_meta is None:
             raise ValueError('Could not get hub metadata for hub {}\n'.format(hub_name))
 
-        # Create module entry first
         comp_data = hub_meta['component_data']
-        del hub_meta['component_data']
-        hub_meta['chains'] = {
-                c.id: {
-                        'single_name': comp_data[c.id]['single_name'],
-                        'n': nested_dict(),
-                        'n_tip': nested_dict(),
-                        'c': nested_dict(),
-                        'c_tip': nested_dict(),
-                        'n_residues': len(c.child_list)
-                    }  for c in hub.get_chains()
-            }
-        hub_meta['radii'] = self.get_radii(hub)
-        self.modules['hubs'][hub_name] = hub_meta
+        links = []
 
         # The current process does not allow hub to hub connections. Maybe this
         # need to be changed?
@@ -139,52 +208,46 @@ class XDBGenerator:
             chain_data = comp_data[hub_chain_id]
             comp_name = chain_data['single_name']
 
-            if chain_data['c_free']:
-                b_name_gen = (tx['mod_b'] for tx in self.n_to_c_tx if tx['mod_a'] == comp_name)
-                for single_b_name in b_name_gen:
-                    # Compute the transformation required to move a single
-                    # module B from its aligned position to the current hub's
-                    # "finger tip".
-                    #
-                    # Here we do not use the second quadrant method, because during
-                    # stitching none of the hubs' residues get changed. The stitching
-                    # will take place at the end of the hub's component's terminal.
-                    rc_hub_a = get_chain_residue_count(hub, hub_chain_id)
-                    rc_dbl_a = get_pdb_residue_count(self.single_pdbs[comp_name])
-                    fusion_count = int_ceil(float(rc_dbl_a) / hub_fusion_factor)
-                    double = self.double_pdbs[comp_name][single_b_name]
-
+            if chain_data['c_free'] and self.tx_ids_by_mod_a[comp_name]:
+                dbl_tx_ids = self.tx_ids_by_mod_a[comp_name]
+
+                # Compute the transformation required to move a single
+                # module B from its aligned position to the current hub's
+                # "finger tip".
+                #
+                # Here we do not use the second quadrant method, because during
+                # stitching none of the hubs' residues get changed. The stitching
+                # will take place at the end of the hub's component's terminal.
+                rc_hub_a = hub_blocks[hub_chain_id].n_residues
+                rc_dbl_a = self.single_records[comp_name].n_residues
+                fusion_count = int_ceil(float(rc_dbl_a) / hub_fusion_factor)
+
+                # Find transforms from hub to single A, fitting the same hub
+                # residues to every double of the component in one batch.
+                hub_cas = self.get_chain_cas(
+                    hub_record, hub_chain_id, rc_hub_a - fusion_count, fusion_count)
+                dbl_cas = [
+                    self.get_chain_cas(
+                        self.get_double(comp_name, self.n_to_c_tx[i]['mod_b']),
+                        'A', rc_dbl_a - fusion_count, fusion_count)
+                    for i in dbl_tx_ids]
+                rots, trans, _ = superimpose(
+                    np.repeat(hub_cas[np.newaxis], len(dbl_cas), axis=0),
+                    np.array(dbl_cas))
+
+                for dbl_tx_id, rot, tran in zip(dbl_tx_ids, rots, trans):
+                    dbl_n_to_c = self.n_to_c_tx[dbl_tx_id]
+                    single_b_name = dbl_n_to_c['mod_b']
+                    single_b_chain_id = dbl_n_to_c['mod_b_chain']
 
                     # Compute transformation matrix.
 
-                    # Find transform between component single and single b.
-                    hub_single_chain_id = \
-                        list(self.single_pdbs[comp_name].get_chains())[0].id
-                    single_b_chain_id = \
-                        list(self.single_pdbs[single_b_name].get_chains())[0].id
-
-                    dbl_tx_id = self.modules['singles'][comp_name]['chains'] \
-                        [hub_single_chain_id]['c'] \
-                        [single_b_name][single_b_chain_id]
-
-                    assert(dbl_tx_id is not None)
-                    dbl_n_to_c = self.n_to_c_tx[dbl_tx_id]
-
+                    # Transform between component single and single b.
                     dbl_tx = np.vstack(
                         (np.hstack((dbl_n_to_c['rot'], np.transpose([dbl_n_to_c['tran']]))),
                          [0,0,0,1])
                     )
 
-                    # Find transform from hub to single A.
-                    rot, tran = self.get_rot_trans(
-                        fixed=hub,
-                        fixed_chain_id=hub_chain_id,
-                        moving=double,
-                        fixed_resi_offset=rc_hub_a - fusion_count,
-                        moving_resi_offset=rc_dbl_a - fusion_count,
-                        match_count=fusion_count
-                    )
-
                     # Rotation in BioPython is inversed.
                     rot = np.transpose(rot)
 
@@ -201,51 +264,35 @@ class XDBGenerator:
                     rot = dbl_raised_tx[:3, :3]
                     tran = dbl_raised_tx[:3, 3]
 
-                    tx = self.create_tx(
-                        hub_name,
-                        hub_chain_id,
-                        single_b_name,
-                        single_b_chain_id,
-                        rot,
-                        tran)
-                    tx_id = len(self.n_to_c_tx) + len(self.hub_tx)
-
-                    self.modules['hubs'][hub_name]['chains'] \
-                        [hub_chain_id]['c'] \
-                        [single_b_name][single_b_chain_id] = tx_id
-
-                    self.modules['hubs'][hub_name]['chains'] \
-                        [hub_chain_id]['c_tip'] = \
-                        self.find_tip('c', hub, hub_chain_id)
-
-                    self.modules['singles'][single_b_name]['chains'] \
-                        [single_b_chain_id]['n'] \
-                        [hub_name][hub_chain_id] = tx_id
-
-                    self.hub_tx.append(tx)
-
-            if chain_data['n_free']:
-                a_name_gen = (tx['mod_a'] for tx in self.n_to_c_tx if tx['mod_b'] == comp_name)
-                for single_a_name in a_name_gen:
-                    # Same as c_free except comp acts as single b
-                    rc_a = get_pdb_residue_count(self.single_pdbs[single_a_name])
-                    rc_b = get_pdb_residue_count(self.single_pdbs[comp_name])
-                    fusion_count = int_ceil(float(rc_b) / hub_fusion_factor)
-                    double = self.double_pdbs[single_a_name][comp_name]
-
-
+                    links.append(
+                        ('c', hub_chain_id, single_b_name, single_b_chain_id, rot, tran))
+
+            if chain_data['n_free'] and self.tx_ids_by_mod_b[comp_name]:
+                dbl_tx_ids = self.tx_ids_by_mod_b[comp_name]
+                single_a_names = [self.n_to_c_tx[i]['mod_a'] for i in dbl_tx_ids]
+
+                # Same as c_free except comp acts as single b
+                rc_b = self.single_records[comp_name].n_residues
+                fusion_count = int_ceil(float(rc_b) / hub_fusion_factor)
+
+                # Find transforms from double component B to hub component.
+                # Matching starts from the n-term of the hub component, and at
+                # the beginning of single b in each double.
+                hub_cas = self.get_chain_cas(hub, hub_chain_id, 0, fusion_count)
+                dbl_cas = [
+                    self.get_chain_cas(
+                        self.get_double(single_a_name, comp_name),
+                        'A',
+                        self.single_records[single_a_name].n_residues,
+                        fusion_count)
+                    for single_a_name in single_a_names]
+                rots, trans, _ = superimpose(
+                    np.repeat(hub_cas[np.newaxis], len(dbl_cas), axis=0),
+                    np.array(dbl_cas))
+
+                for single_a_name, rot, tran in zip(single_a_names, rots, trans):
                     # Compute transformation matrix.
 
-                    # Find transform from double component B to hub component.
-                    rot, tran = self.get_rot_trans(
-                        fixed=hub,
-                        fixed_chain_id=hub_chain_id,
-                        moving=double,
-                        fixed_resi_offset=0,      # start matching from the n-term of hub component, which is index 0
-                        moving_resi_offset=rc_a,  # start matching at the beginning of single b in the double
-                        match_count=fusion_count
-                    )
-
                     # Rotation in BioPython is inversed.
                     rot = np.transpose(rot)
 
@@ -261,42 +308,94 @@ class XDBGenerator:
                     tran = dbl_to_hub_tx[:3, 3]
 
                     single_a_chain_id = \
-                        list(self.single_pdbs[single_a_name].get_chains())[0].id
-
-                    tx = self.create_tx(
-                        single_a_name,
-                        single_a_chain_id,
-                        hub_name,
-                        hub_chain_id,
-                        rot,
-                        tran)
-                    tx_id = len(self.n_to_c_tx) + len(self.hub_tx)
-
-                    self.modules['singles'][single_a_name]['chains'] \
-                        [single_a_chain_id]['c'] \
-                        [hub_name][hub_chain_id] = tx_id
-
-                    self.modules['hubs'][hub_name]['chains'] \
-                        [hub_chain_id]['n'] \
-                        [single_a_name][single_a_chain_id] = tx_id
-
-                    self.modules['hubs'][hub_name]['chains'] \
-                        [hub_chain_id]['n_tip'] = \
-                        self.find_tip('n', hub, hub_chain_id)
-
-                    self.hub_tx.append(tx)
-
-        save_pdb(
-            struct=hub,
-            path=self.aligned_pdb_dir + '/hubs/' + hub_name + '.pdb'
-        )
+                        self.single_records[single_a_name].chain_ids[0]
+
+                    links.append(
+                        ('n', hub_chain_id, single_a_name, single_a_chain_id, rot, tran))
+
+        self.export_module_pdb('hubs', hub_name, hub)
+
+        return hub_name, hub, self.get_geometry(hub_blocks), links
+
+    def add_hub(self, hub_name, hub, geometry, links):
+        """Creates the xdb entry of an aligned hub and assigns tx_ids to its
+        links in order.
+        """
+        # Create module entry first
+        hub_meta = self.hub_info[hub_name]
+        comp_data = hub_meta['component_data']
+        del hub_meta['component_data']
+        hub_meta['chains'] = {
+                c.id: {
+                        'single_name': comp_data[c.id]['single_name'],
+                        'n': nested_dict(),
+                        'n_tip': nested_dict(),
+                        'c': nested_dict(),
+                        'c_tip': nested_dict(),
+                        'n_residues': len(c.child_list)
+                    }  for c in hub.get_chains()
+            }
+        hub_meta['radii'] = geometry['radii']
+        hub_meta['bounding_box'] = geometry['bounding_box']
+        self.modules['hubs'][hub_name] = hub_meta
+
+        for term, hub_chain_id, single_name, single_chain_id, rot, tran in links:
+            tx_id = len(self.n_to_c_tx) + len(self.hub_tx)
+            hub_chain = self.modules['hubs'][hub_name]['chains'][hub_chain_id]
+
+            if term == 'c':
+                tx = self.create_tx(
+                    hub_name,
+                    hub_chain_id,
+                    single_name,
+                    single_chain_id,
+                    rot,
+                    tran)
+
+                hub_chain['c'][single_name][single_chain_id] = tx_id
+                if not hub_chain['c_tip']:
+                    hub_chain['c_tip'] = geometry['tips'][hub_chain_id]['c']
+
+                self.modules['singles'][single_name]['chains'] \
+                    [single_chain_id]['n'] \
+                    [hub_name][hub_chain_id] = tx_id
+            else:
+                tx = self.create_tx(
+                    single_name,
+                    single_chain_id,
+                    hub_name,
+                    hub_chain_id,
+                    rot,
+                    tran)
+
+                self.modules['singles'][single_name]['chains'] \
+                    [single_chain_id]['c'] \
+                    [hub_name][hub_chain_id] = tx_id
+
+                hub_chain['n'][single_name][single_chain_id] = tx_id
+                if not hub_chain['n_tip']:
+                    hub_chain['n_tip'] = geometry['tips'][hub_chain_id]['n']
+
+            self.hub_tx.append(tx)
+
+        self.add_library_module('hubs', hub_name, hub)
 
     def process_double(self, file_name):
+        """Aligns a double module and adds its transform to the xdb."""
+        self.add_double(*self.align_double(file_name))
+
+    def align_double(self, file_name):
         """Aligns a double module to its A component and then computes the transform
         for aligning to its B component. Saves aligned structure to output folder.
+
+        Only reads generator state, so it can run in a pool worker.
+
+        Returns:
+        - (double_name, double, rot, tran) - the aligned double and the
+            transform from single A to single B.
         """
         # Step 1: Load structures
-        double = read_pdb(file_name)
+        double = self.read_module(file_name)
 
         # Preprocessed pdbs have only 1 chain
         assert(len(list(double.get_chains())) == 1)
@@ -304,11 +403,11 @@ class XDBGenerator:
         double_name = file_name.split('/')[-1].replace('.pdb', '')
         single_a_name, single_b_name = double_name.split('-')
 
-        single_a = self.single_pdbs[single_a_name]
-        single_b = self.single_pdbs[single_b_name]
+        single_a = self.single_records[single_a_name]
+        single_b = self.single_records[single_b_name]
 
-        rc_a = get_pdb_residue_count(single_a)
-        rc_b = get_pdb_residue_count(single_b)
+        rc_a = single_a.n_residues
+        rc_b = single_b.n_residues
         rc_double = get_pdb_residue_count(double)
 
         rc_a_half = int_floor(float(rc_a)/2)
@@ -328,16 +427,7 @@ class XDBGenerator:
             match_count=fusion_count_a
         )
 
-        # Step 3: Get COM of the single_b as seen in the double.
-        com_b = self.get_centre_of_mass(
-            single_b,
-            mother=double,
-            child_resi_offset=rc_b_half - fusion_count_b,
-            mother_resi_offset=rc_a + rc_b_half - fusion_count_b,
-            match_count=fusion_count_b
-        )
-
-        # Step 4: Get transformation of single B to part B inside double.
+        # Step 3: Get transformation of single B to part B inside double.
         #
         #   Double is already aligned to first single so there is no need for
         # the first transformation.
@@ -368,18 +458,22 @@ class XDBGenerator:
         rot = inv_tx[:3, :3]
         tran = inv_tx[:3, 3]
 
-        # Step 5: Save the aligned molecules.
+        # Step 4: Save the aligned molecules.
         #
         # Here the PDB format adds some slight floating point error. PDB is
         # already phased out so and we should really consider using mmCIF for
         # all modules.
-        save_pdb(
-            struct=double,
-            path=self.aligned_pdb_dir + '/doubles/' + double_name + '.pdb'
-        )
+        self.export_module_pdb('doubles', double_name, double)
+
+        return double_name, double, rot, tran
 
-        single_a_chain_id = list(single_a.get_chains())[0].id
-        single_b_chain_id = list(single_b.get_chains())[0].id
+    def add_double(self, double_name, double, rot, tran):
+        """Creates the xdb transform entry of an aligned double, and keeps
+        only its ModuleRecord after adding it to the module library.
+        """
+        single_a_name, single_b_name = double_name.split('-')
+        single_a_chain_id = self.single_records[single_a_name].chain_ids[0]
+        single_b_chain_id = self.single_records[single_b_name].chain_ids[0]
         tx = self.create_tx(
             single_a_name,
             single_a_chain_id,
@@ -394,14 +488,25 @@ class XDBGenerator:
         self.modules['singles'][single_b_name]['chains'] \
             [single_b_chain_id]['n'][single_a_name][single_a_chain_id] = tx_id
         self.n_to_c_tx.append(tx)
-
-        # Cache structure in memory
-        self.double_pdbs[single_a_name][single_b_name] = double
+        self.tx_ids_by_mod_a[single_a_name].append(tx_id)
+        self.tx_ids_by_mod_b[single_b_name].append(tx_id)
+        self.add_library_module('doubles', double_name, double)
+        self.double_records[single_a_name][single_b_name] = \
+            ModuleRecord.from_module(double)
 
     def process_single(self, file_name):
-        """Centres a single module and saves to output folder."""
+        """Centres a single module and adds it to the xdb."""
+        self.add_single(*self.align_single(file_name))
+
+    def align_single(self, file_name):
+        """Centres a single module and saves to output folder.
+
+        Returns:
+        - (single_name, single, geometry) - the centred single and its
+            get_geometry() descriptors.
+        """
         single_name = file_name.split('/')[-1].replace('.pdb', '')
-        single = read_pdb(file_name)
+        single = self.read_module(file_name)
 
         # Preprocessed pdbs have only 1 chain
         assert(len(list(single.get_chains())) == 1)
@@ -411,11 +516,15 @@ class XDBGenerator:
         if len(chain_list) != 1:
             raise ValueError('Single PDB contains {} chains!\n'.format(len(chain_list)))
 
-        self.move_to_origin(single)
-        save_pdb(
-            struct=single,
-            path=self.aligned_pdb_dir + '/singles/' + single_name + '.pdb'
-        )
+        single_blocks = self.move_to_origin(single)
+        self.export_module_pdb('singles', single_name, single)
+
+        return single_name, single, self.get_geometry(single_blocks)
+
+    def add_single(self, single_name, single, geometry):
+        """Creates the xdb entry of a centred single."""
+        chain_list = list(single.get_chains())
+        self.add_library_module('singles', single_name, single)
 
         self.modules['singles'][single_name] = {
                 'chains': {
@@ -425,11 +534,207 @@ class XDBGenerator:
                         'n_residues': len(chain_list[0].child_list)
                     }
                 },
-                'radii': self.get_radii(single)
+                'radii': geometry['radii'],
+                'bounding_box': geometry['bounding_box']
             }
 
-        # Cache structure in memory
-        self.single_pdbs[single_name] = single
+        self.single_records[single_name] = ModuleRecord.from_module(single)
+
+    def get_double(self, single_a_name, single_b_name):
+        """Returns the ModuleRecord of an aligned double."""
+        return self.double_records[single_a_name][single_b_name]
+
+    def find_modules(self, mod_type):
+        """Lists the relaxed module files of a module type. When reading from a
+        relaxed module library, these are the paths the modules would have in
+        relaxed_pdbs_dir.
+
+        Files are sorted by name so that tx_ids do not depend on glob order.
+        """
+        if self.relaxed_library is not None:
+            return [self.relaxed_pdbs_dir + '/' + mod_type + '/' + name + '.pdb'
+                for name in sorted(self.relaxed_library.module_names(mod_type))]
+        return sorted(glob.glob(self.relaxed_pdbs_dir + '/' + mod_type + '/*.pdb'))
+
+    def read_module(self, file_name):
+        """Reads a relaxed module as a Bio.PDB.Structure.Structure, from the
+        relaxed module library if there is one.
+        """
+        if self.relaxed_library is not None:
+            mod_type = os.path.basename(os.path.dirname(file_name))
+            mod_name = os.path.basename(file_name).replace('.pdb', '')
+            return self.relaxed_library.get_structure(mod_type, mod_name)
+        return read_pdb(file_name)
+
+    def export_module_pdb(self, mod_type, mod_name, struct):
+        """Saves an aligned module as PDB if PDBs are being exported."""
+        if self.export_pdbs:
+            path = self.aligned_pdb_dir + '/' + mod_type + '/' + mod_name + '.pdb'
+            self.writer.submit(save_pdb, struct=struct, path=path, key=path)
+
+    def add_library_module(self, mod_type, mod_name, module):
+        """Adds an aligned module, either a Bio.PDB.Structure.Structure or an
+        OrderedDict of chain ID to AtomBlock, to the aligned module library if
+        one is being saved.
+        """
+        if self.library_writer is None:
+            return
+        if isinstance(module, Bio.PDB.Structure.Structure):
+            self.library_writer.add_structure(mod_type, mod_name, module)
+        else:
+            self.library_writer.add(mod_type, mod_name, module)
+
+    def hash_module_input(self, file_name):
+        """Returns the SHA-1 hex digest of a relaxed module's content."""
+        h = hashlib.sha1()
+        if self.relaxed_library is not None:
+            mod_type = os.path.basename(os.path.dirname(file_name))
+            mod_name = os.path.basename(file_name).replace('.pdb', '')
+            for chain_id, block in \
+                    self.relaxed_library.get_module(mod_type, mod_name).items():
+                h.update(chain_id.encode())
+                for array in (block.atoms, block.coord, block.res_starts):
+                    h.update(np.ascontiguousarray(array).tobytes())
+        else:
+            with open(file_name, 'rb') as file:
+                h.update(file.read())
+        return h.hexdigest()
+
+    def module_key(self, mod_type, file_name):
+        """Computes the cache key of a module from its own content and the keys
+        of everything its alignment reads: the two singles of a double, and the
+        component singles, doubles and metadata of a hub. Doubles must have
+        been added before hub keys are computed.
+        """
+        mod_name = os.path.basename(file_name).replace('.pdb', '')
+        parts = [MODULE_CACHE_VERSION, mod_type, self.hash_module_input(file_name)]
+
+        if mod_type == 'doubles':
+            parts.extend(
+                self.module_keys['singles'][s] for s in mod_name.split('-'))
+        elif mod_type == 'hubs':
+            # Hub links are assigned tx_ids in component and double order, so
+            # both orders are part of the key.
+            hub_meta = self.hub_info.get(mod_name, {})
+            parts.append(hub_meta)
+            for chain_data in hub_meta.get('component_data', {}).values():
+                comp_name = chain_data['single_name']
+                parts.append(self.module_keys['singles'].get(comp_name))
+                if chain_data['c_free']:
+                    parts.append(self.double_keys(self.tx_ids_by_mod_a[comp_name]))
+                if chain_data['n_free']:
+                    parts.append(self.double_keys(self.tx_ids_by_mod_b[comp_name]))
+
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def double_keys(self, tx_ids):
+        names = (self.n_to_c_tx[i]['mod_a'] + '-' + self.n_to_c_tx[i]['mod_b']
+            for i in tx_ids)
+        return [[name, self.module_keys['doubles'][name]] for name in names]
+
+    def align_modules(self, mod_type, files, align, task):
+        """Yields the align() result of each module file in order, along with
+        whether it was reused from the module cache. Modules that are not in
+        the cache are aligned by map_modules() and then cached.
+
+        The first two result values are always the module name and the aligned
+        module. Reused doubles are OrderedDicts of chain ID to AtomBlock, which
+        add_double() takes as they are.
+        """
+        if self.cache is None:
+            for result in self.map_modules(align, task, files):
+                yield result, False
+            return
+
+        keys = [self.module_key(mod_type, f) for f in files]
+        for f, key in zip(files, keys):
+            self.module_keys[mod_type][os.path.basename(f).replace('.pdb', '')] = key
+
+        # Entries are only loaded when their turn comes, so that no more than
+        # one reused module is held in memory at a time.
+        cached = [self.cache.has(key) for key in keys]
+        missing = [f for f, c in zip(files, cached) if not c]
+        aligned = self.map_modules(align, task, missing)
+        for f, key, c in zip(files, keys, cached):
+            entry = self.cache.load(key) if c else None
+            if entry is None:
+                # Bad entries are aligned here, as they were not known to be
+                # missing.
+                result = align(f) if c else next(aligned)
+                self.writer.submit(self.save_cache_entry, mod_type, key, result)
+                yield result, False
+                continue
+
+            mod_name, values, chain_blocks, pdb_sha1 = entry
+            module = chain_blocks
+            if mod_type != 'doubles':
+                module = structure_from_blocks(mod_name, chain_blocks)
+                module.at_origin = True
+            self.export_cached_pdb(mod_type, mod_name, chain_blocks, pdb_sha1)
+            self.n_reused += 1
+            yield (mod_name, module) + tuple(values), True
+
+    def save_cache_entry(self, mod_type, key, result):
+        """Saves an align() result to the module cache, along with the digest
+        of its exported PDB.
+        """
+        self.cache.save(
+            key,
+            result[0],
+            to_json_values(result[2:]),
+            get_chain_blocks(result[1]),
+            self.aligned_pdb_sha1(mod_type, result[0]))
+
+    def aligned_pdb_sha1(self, mod_type, mod_name):
+        """Returns the SHA-1 hex digest of an exported aligned PDB, or None if
+        PDBs are not being exported. Waits for the PDB to be written first.
+        """
+        if not self.export_pdbs:
+            return None
+        path = self.aligned_pdb_dir + '/' + mod_type + '/' + mod_name + '.pdb'
+        self.writer.wait(path)
+        with open(path, 'rb') as file:
+            return hashlib.sha1(file.read()).hexdigest()
+
+    def export_cached_pdb(self, mod_type, mod_name, chain_blocks, pdb_sha1):
+        """Exports a module reused from the cache as PDB, unless the exported
+        PDB is already there with the cached content.
+        """
+        if not self.export_pdbs:
+            return
+        path = self.aligned_pdb_dir + '/' + mod_type + '/' + mod_name + '.pdb'
+        if pdb_sha1 is not None and os.path.isfile(path) and \
+                self.aligned_pdb_sha1(mod_type, mod_name) == pdb_sha1:
+            return
+        self.writer.submit(save_pdb, chain_blocks=chain_blocks, path=path, key=path)
+
+    def map_modules(self, align, task, files):
+        """Yields align(file) for each file in order, computed by a pool of
+        worker_count processes if there is more than one worker.
+
+        Args:
+        - align - bound method that aligns one module file
+        - task - module level function calling the same method in a worker
+        - files - module files to align
+
+        Returns:
+        - _ - generator of align() results in the order of files
+        """
+        if self.worker_count < 2 or len(files) < 2:
+            for file_name in files:
+                yield align(file_name)
+            return
+
+        # Workers are forked after the previous stage finished, so each gets
+        # the centred singles and aligned doubles it needs. Pending writes are
+        # finished first so that no writer thread is busy while forking.
+        self.writer.wait()
+        with multiprocessing.Pool(
+                min(self.worker_count, len(files)),
+                _init_worker,
+                (self,)) as pool:
+            for result in pool.imap(task, files):
+                yield result
 
     def dump_xdb(self):
         """Writes alignment data to a json file."""
@@ -457,9 +762,9 @@ class XDBGenerator:
 
         Args:
         - child - Bio.PDB.Structure.Structure for which the centre-of-mass should
-            be calculated.
+            be calculated, or its OrderedDict of chain ID to AtomBlock.
         - mother - Bio.PDB.Structure.Structure onto which child is to be first
-            aligned.
+            aligned. child must then be a Bio.PDB.Structure.Structure too.
         - moving_resi_offset - the residue offset of the moving
             Bio.PDB.Structure.Structure when extracting carbon alpha coordinates.
         - fixed_resi_offset - the residue offset of the fixed
@@ -470,7 +775,10 @@ class XDBGenerator:
         Returns:
         - com - 3x1 numpy array of the centre-of-mass.
         """
-        CAs = [r['CA'].get_coord().astype('float64') for r in child.get_residues()]
+        chain_blocks = child if isinstance(child, OrderedDict) \
+            else get_chain_blocks(child)
+        CAs = np.concatenate(
+            [b.ca_atoms().coord for b in chain_blocks.values()])
         com = np.mean(CAs, axis=0)
 
         if mother is not None:
@@ -486,57 +794,75 @@ class XDBGenerator:
             com += tran
         return com
 
-    def get_radii(self, pose):
-        """Computes three different measures of the radius.
+    def get_geometry(self, chain_blocks):
+        """Computes the geometric descriptors of a centred module in one pass
+        over its atom coordinates.
 
         Args:
-        - pose - Bio.PDB.Structure.Structure
+        - chain_blocks - OrderedDict of chain ID to AtomBlock of the module,
+            as returned by move_to_origin().
 
         Returns:
-        - _ - an dict containing: average of all atoms distances, max
-            carbon alpha distance, and max heavy atom distance, each calculated
-            against the centre-of-mass.
+        - _ - a dict containing:
+            radii - average of all atom distances, max carbon alpha distance,
+                max heavy atom distance, each calculated against the
+                centre-of-mass, and the radius of gyration of all atoms.
+            bounding_box - min and max corners of the axis-aligned box around
+                all atoms.
+            tips - dict of chain ID to the find_tip() of its 'n' and 'c'
+                termini.
         """
-        if not pose.at_origin:
-            raise ValueError('get_radii() must be called with centered modules.')
-
-        natoms = 0;
-        rg_sum = 0;
-        max_ca_dist = 0;
-
-        nHeavy = 0;
-        max_heavy_dist = 0;
-        for a in pose.get_atoms():
-            dist = np.linalg.norm(
-                a.get_coord().astype('float64'));
+        block = AtomBlock.concatenate(list(chain_blocks.values()))
+        coords = block.coord
+        is_ca = block.atoms['name'] == 'CA'
+        is_heavy = block.atoms['element'] != 'H'
 
-            rg_sum += dist;
+        dists = np.sqrt(np.sum(coords * coords, axis=1))
+        spread = coords - coords.mean(axis=0)
 
-            if(a.name =='CA'):
-                max_ca_dist = max(max_ca_dist, dist);
+        def max_or_zero(values):
+            return float(values.max()) if len(values) else 0.
 
-            if(a.element != 'H'):
-                max_heavy_dist = max(max_heavy_dist, dist);
-                nHeavy = nHeavy + 1;
-
-            natoms = natoms + 1;
-
-        average_all = rg_sum / natoms;
         return {
-                'average_all': average_all,
-                'max_ca_dist': max_ca_dist,
-                'max_heavy_dist': max_heavy_dist
+                'radii': {
+                    'average_all': float(dists.mean()),
+                    'max_ca_dist': max_or_zero(dists[is_ca]),
+                    'max_heavy_dist': max_or_zero(dists[is_heavy]),
+                    'radius_of_gyration':
+                        float(np.sqrt(np.mean(np.sum(spread * spread, axis=1))))
+                },
+                'bounding_box': {
+                    'min': coords.min(axis=0).tolist(),
+                    'max': coords.max(axis=0).tolist()
+                },
+                'tips': {
+                    chain_id: {
+                        'n': self.find_tip('n', chain_block),
+                        'c': self.find_tip('c', chain_block)
+                    } for chain_id, chain_block in chain_blocks.items()
+                }
             }
 
     def move_to_origin(self, pdb):
-        """Centres a Bio.PDB.Structure.Structure to the global origin."""
-        com = self.get_centre_of_mass(pdb)
+        """Centres a Bio.PDB.Structure.Structure to the global origin.
+
+        Returns:
+        - chain_blocks - OrderedDict of chain ID to AtomBlock of the centred
+            structure, read once for its centre-of-mass and moved along with
+            it, for get_geometry().
+        """
+        chain_blocks = get_chain_blocks(pdb)
+        com = self.get_centre_of_mass(chain_blocks)
 
         # No rotation - just move to centre
-        pdb.transform([[1,0,0],[0,1,0],[0,0,1]], -com)
+        identity = [[1,0,0],[0,1,0],[0,0,1]]
+        pdb.transform(identity, -com)
+        for block in chain_blocks.values():
+            block.transform(identity, -com)
 
         # Tag the pdb
         pdb.at_origin = True
+        return chain_blocks
 
     def align(
         self,
@@ -567,8 +893,8 @@ class XDBGenerator:
         self,
         **kwargs
     ):
-        """Computes the rotation and transformation matrices using BioPython's
-        superimposer.
+        """Computes the rotation and transformation matrices with
+        kabsch.superimpose(), which follows BioPython's superimposer.
 
         Args:
         - moving - the Bio.PDB.Structure.Structure that is to move towards the
@@ -607,53 +933,211 @@ class XDBGenerator:
         match_count = kwargs.pop('match_count', -1)
 
 
-        moving_chain = get_chain(moving, chain_id=moving_chain_id)
-        moving_residues = moving_chain.child_list \
-            [moving_resi_offset:(moving_resi_offset+match_count)]
-        ma = [r['CA'] for r in moving_residues]
+        ma = self.get_chain_cas(
+            moving, moving_chain_id, moving_resi_offset, match_count)
+        fa = self.get_chain_cas(
+            fixed, fixed_chain_id, fixed_resi_offset, match_count)
 
-        fixed_chain = get_chain(fixed, chain_id=fixed_chain_id)
-        fixed_residues = fixed_chain.child_list \
-            [fixed_resi_offset:(fixed_resi_offset+match_count)]
-        fa = [r['CA'] for r in fixed_residues]
+        rot, tran, _ = superimpose(fa, ma)
+        return rot, tran
 
-        self.si.set_atoms(fa, ma)
-        return self.si.rotran
+    def get_chain_cas(self, struct, chain_id, resi_offset, match_count):
+        """Returns the carbon alpha coordinates of match_count residues of a
+        chain, starting at residue index resi_offset, as an (N, 3) array.
+        struct is either a Bio.PDB.Structure.Structure or a ModuleRecord.
+        """
+        if isinstance(struct, ModuleRecord):
+            return struct.get_chain_cas(chain_id, resi_offset, match_count)
+
+        chain = get_chain(struct, chain_id=chain_id)
+        return get_ca_coords(
+            chain.child_list[resi_offset:(resi_offset+match_count)])
 
     def run(self):
         """Calls the processing functions for singles, doubles, and hubs in that
         order. Dumps alignment data into json database.
         """
 
-        # Single modules
-        single_files = glob.glob(self.relaxed_pdbs_dir + '/singles/*.pdb')
-        n_singles = len(single_files)
-        for i in range(0, n_singles):
-            print('Centering single [{}/{}] {}' \
-                .format(i+1, n_singles, single_files[i]))
-            self.process_single(single_files[i])
-
-        # Double modules
-        double_files = glob.glob(self.relaxed_pdbs_dir + '/doubles/*.pdb')
-        nDoubles = len(double_files)
-        for i in range(0, nDoubles):
-            print('Aligning double [{}/{}] {}' \
-                .format(i+1, nDoubles, double_files[i]))
-            self.process_double(double_files[i])
-
-        # Hub modules
-        hub_files = glob.glob(self.relaxed_pdbs_dir + '/hubs/*.pdb')
-        nHubs = len(hub_files)
-        for i in range(0, nHubs):
-            print('Aligning hub [{}/{}] {}' \
-                .format(i+1, nHubs, hub_files[i]))
-            self.process_hub(hub_files[i])
+        # Pending writes are finished, and the writer threads stopped, even if
+        # a stage fails.
+        try:
+            # Single modules
+            single_files = self.find_modules('singles')
+            n_singles = len(single_files)
+            singles = self.align_modules(
+                'singles', single_files, self.align_single, _align_single_task)
+            for i, (single, reused) in enumerate(singles):
+                print('{} single [{}/{}] {}' \
+                    .format('Reused' if reused else 'Centred',
+                        i+1, n_singles, single_files[i]))
+                self.add_single(*single)
+
+            # Double modules. Results come back in file order, so tx_ids are the
+            # same however many workers there are.
+            double_files = self.find_modules('doubles')
+            nDoubles = len(double_files)
+            doubles = self.align_modules(
+                'doubles', double_files, self.align_double, _align_double_task)
+            for i, (double, reused) in enumerate(doubles):
+                print('{} double [{}/{}] {}' \
+                    .format('Reused' if reused else 'Aligned',
+                        i+1, nDoubles, double_files[i]))
+                self.add_double(*double)
+
+            # Hub modules
+            hub_files = self.find_modules('hubs')
+            nHubs = len(hub_files)
+            hubs = self.align_modules(
+                'hubs', hub_files, self.align_hub, _align_hub_task)
+            for i, (hub, reused) in enumerate(hubs):
+                print('{} hub [{}/{}] {}' \
+                    .format('Reused' if reused else 'Aligned',
+                        i+1, nHubs, hub_files[i]))
+                self.add_hub(*hub)
+
+            self.writer.wait()
+        finally:
+            self.writer.shutdown()
 
         self.n_to_c_tx += self.hub_tx
 
         print('Total: {} singles, {} doubles, {} hubs'.format(n_singles, nDoubles, nHubs))
+        if self.cache is not None:
+            print('Reused {} of {} modules from {}'.format(
+                self.n_reused, n_singles + nDoubles + nHubs, self.cache.cache_dir))
 
         self.dump_xdb()
 
+        if self.library_writer is not None:
+            self.library_writer.save(self.aligned_library)
+            print('Saved module library to {}'.format(self.aligned_library))
+
+class ModuleCache:
+    """Keeps aligned modules and their alignment results on disk, keyed by
+    XDBGenerator.module_key(), so unchanged modules need not be aligned again.
+
+    Each entry is a <key>.json file holding the module name, result values,
+    chain IDs and exported PDB digest, plus a <key>.<chain_id>.npz AtomBlock
+    per chain. The JSON is written last, so only complete entries are found.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        make_dir(cache_dir)
+
+    def has(self, key):
+        return os.path.isfile(os.path.join(self.cache_dir, key + '.json'))
+
+    def load(self, key):
+        """Returns (mod_name, values, chain_blocks, pdb_sha1), or None if there
+        is no usable entry for key.
+        """
+        path = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.isfile(path):
+            return None
+        try:
+            entry = read_json(path)
+            chain_blocks = OrderedDict(
+                (chain_id, AtomBlock.load_npz(self.block_path(key, chain_id)))
+                for chain_id in entry['chains'])
+        except (OSError, ValueError, KeyError) as e:
+            print('Warning: ignoring bad module cache entry {}: {}'.format(path, e))
+            return None
+        return entry['name'], entry['values'], chain_blocks, entry['pdb_sha1']
+
+    def save(self, key, mod_name, values, chain_blocks, pdb_sha1):
+        """Saves an entry; see load()."""
+        for chain_id, block in chain_blocks.items():
+            block.save_npz(self.block_path(key, chain_id))
+
+        path = os.path.join(self.cache_dir, key + '.json')
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as file:
+            json.dump(OrderedDict([
+                ('name', mod_name),
+                ('values', values),
+                ('chains', list(chain_blocks.keys())),
+                ('pdb_sha1', pdb_sha1)
+            ]), file)
+        os.replace(tmp_path, path)
+
+    def block_path(self, key, chain_id):
+        return os.path.join(self.cache_dir, '{}.{}.npz'.format(key, chain_id))
+
+class ModuleRecord:
+    """The chain IDs, residue counts and carbon alpha coordinates of a
+    module, without the rest of its atoms.
+
+    Args:
+    - chain_cas - OrderedDict of chain ID to an (R, 3) float64 array holding
+        the CA coordinate of each of its R residues, or NaN for residues
+        without a CA.
+    """
+    def __init__(self, chain_cas):
+        self.chain_cas = chain_cas
+
+    @classmethod
+    def from_module(cls, module):
+        """Builds the record of a Bio.PDB.Structure.Structure, or of an
+        OrderedDict of chain ID to AtomBlock.
+        """
+        if isinstance(module, Bio.PDB.Structure.Structure):
+            return cls(OrderedDict(
+                (c.id, np.array(
+                    [r['CA'].get_coord() if 'CA' in r else [np.nan] * 3
+                        for r in c.child_list],
+                    dtype='float64').reshape(-1, 3))
+                for c in get_chains(module)))
+
+        chain_cas = OrderedDict()
+        for chain_id, block in module.items():
+            cas = np.full((block.n_residues, 3), np.nan)
+            ca_idx = np.flatnonzero(block.atoms['name'] == 'CA')
+            # Keep the first CA of each residue, like Bio.PDB does.
+            res_idx, first = np.unique(
+                block.residue_index()[ca_idx], return_index=True)
+            cas[res_idx] = block.coord[ca_idx[first]]
+            chain_cas[chain_id] = cas
+        return cls(chain_cas)
+
+    @property
+    def chain_ids(self):
+        return list(self.chain_cas.keys())
+
+    @property
+    def n_residues(self):
+        return sum(len(cas) for cas in self.chain_cas.values())
+
+    def get_chain_cas(self, chain_id, resi_offset, match_count):
+        """Same as XDBGenerator.get_chain_cas() on the module's structure."""
+        cas = self.chain_cas[chain_id][resi_offset:(resi_offset+match_count)]
+        return cas[~np.isnan(cas[:, 0])]
+
+def to_json_values(value):
+    """Converts numpy arrays and tuples inside value into lists, so that
+    json.dump() writes exactly the same numbers back.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_json_values(v) for v in value]
+    return value
+
+_worker_generator = None
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+    # Workers write their aligned PDBs themselves, in parallel with each other.
+    _worker_generator.writer = BackgroundWriter(0)
+
+def _align_single_task(file_name):
+    return _worker_generator.align_single(file_name)
+
+def _align_double_task(file_name):
+    return _worker_generator.align_double(file_name)
+
+def _align_hub_task(file_name):
+    return _worker_generator.align_hub(file_name)
+
 if __name__ =='__main__':
     safe_exec(main)
@@ -77,6 +77,68 @@ def run_kabsch(P, Q):
     return U
 
 
+def superimpose(fixed, moving):
+    """Find the rotation and translation that superimpose moving onto fixed
+    with minimum RMSD, for one or a batch of coordinate set pairs.
+
+    The result follows Bio.SVDSuperimposer, which Bio.PDB.Superimposer and the
+    callers in elfinpy are written against: rot is right-multiplying, so
+    moving is superimposed by np.dot(moving, rot) + tran. This rot is the
+    transpose of the usual R in R*v + T, and can be passed as it is to
+    Bio.PDB.Entity.transform().
+
+    Parameters:
+    fixed -- (N, 3) or (K, N, 3) array
+    moving -- array of the same shape as fixed
+
+    Returns:
+    rot -- (3, 3) or (K, 3, 3) right-multiplying rotation matrix
+    tran -- (3,) or (K, 3) translation
+    rms -- RMSD after superimposition, a float or (K,) array
+
+    """
+    fixed = np.asarray(fixed, dtype='float64')
+    moving = np.asarray(moving, dtype='float64')
+    if fixed.shape != moving.shape or fixed.ndim not in (2, 3) or \
+            fixed.shape[-1] != 3:
+        raise ValueError('Cannot superimpose coordinates of shapes {} and {}'
+                         .format(fixed.shape, moving.shape))
+
+    batched = fixed.ndim == 3
+    if not batched:
+        fixed = fixed[np.newaxis]
+        moving = moving[np.newaxis]
+    n = fixed.shape[1]
+
+    # Center on centroids
+    av_moving = moving.sum(axis=1) / n
+    av_fixed = fixed.sum(axis=1) / n
+    moving_centered = moving - av_moving[:, np.newaxis]
+    fixed_centered = fixed - av_fixed[:, np.newaxis]
+
+    # Correlation matrix, then rotation by SVD with reflection correction
+    corr = np.matmul(np.transpose(moving_centered, (0, 2, 1)), fixed_centered)
+    # Built as a transposed product like Bio.SVDSuperimposer, whose memory
+    # layout makes tran and the transformed coordinates round identically.
+    u, _, vt = np.linalg.svd(corr)
+    ut = np.transpose(u, (0, 2, 1))
+    rot = np.transpose(np.matmul(np.transpose(vt, (0, 2, 1)), ut), (0, 2, 1))
+    reflected = np.linalg.det(rot) < 0
+    if reflected.any():
+        vt[reflected, 2] = -vt[reflected, 2]
+        rot = np.transpose(
+            np.matmul(np.transpose(vt, (0, 2, 1)), ut), (0, 2, 1))
+
+    tran = av_fixed - np.matmul(av_moving[:, np.newaxis], rot)[:, 0]
+
+    diff = np.matmul(moving, rot) + tran[:, np.newaxis] - fixed
+    rms = np.sqrt((diff * diff).sum(axis=(1, 2)) / n)
+
+    if not batched:
+        return rot[0], tran[0], float(rms[0])
+    return rot, tran, rms
+
+
 def quaternion_rmsd(P, Q):
     """Rotate matrix P unto Q and calculate the RMSD.
 
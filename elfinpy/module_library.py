@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+#
+# This script packs a tree of module PDBs (e.g. pdb_aligned/) into a single
+# binary module library file, or exports a library back into a PDB tree.
+#
+# A module library holds every module's atoms as flat arrays that can be
+# memory mapped, so loading a module is a few array slices instead of parsing
+# a PDB file. The file layout is:
+#
+#   magic (8 bytes) | header size (uint64 LE) | JSON header | arrays
+#
+# The JSON header holds the name tables, the dtype, shape and byte offset of
+# each array, and the residue range of every module chain. Arrays start on
+# ARRAY_ALIGNMENT byte boundaries so they can be viewed in place.
+#
+
+import os
+import sys
+import glob
+import json
+import mmap
+import struct
+import shutil
+import argparse
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import utilities as utils
+    import pdb_utilities as pdb_utils
+except ImportError:
+    from . import utilities as utils
+    from . import pdb_utilities as pdb_utils
+
+MAGIC = b'ELFINML1'
+ARRAY_ALIGNMENT = 64
+MODULE_TYPES = ['singles', 'doubles', 'hubs']
+
+# Per-atom fields. Names are indices into the header's atom_names table,
+# which holds PDB full names (e.g. ' CA '), and likewise for elements.
+LIB_ATOM_DTYPE = np.dtype([
+    ('name', '<u2'),
+    ('element', 'u1'),
+    ('altloc', 'S1'),
+    ('occupancy', '<f4'),
+    ('bfactor', '<f4'),
+])
+
+# Per-residue fields. resname, hetfield and segid index name tables too.
+LIB_RESIDUE_DTYPE = np.dtype([
+    ('resname', '<u2'),
+    ('hetfield', '<u2'),
+    ('segid', '<u2'),
+    ('icode', 'S1'),
+    ('resseq', '<i4'),
+])
+
+
+def parse_args(args):
+    desc = ('Packs module PDBs into a binary module library, or exports a '
+            'library as module PDBs.')
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('library', help='Module library file.')
+    parser.add_argument('--pack', default='',
+                        help='PDB directory with singles/, doubles/ and '
+                        'hubs/ subdirectories to pack into the library.')
+    parser.add_argument('--export', default='',
+                        help='Directory to export the library into as '
+                        'singles/, doubles/ and hubs/ PDBs.')
+    return parser.parse_args(args)
+
+
+def main(test_args=None):
+    args = parse_args(sys.argv[1:] if test_args is None else test_args)
+
+    if args.pack:
+        writer = ModuleLibraryWriter()
+        for mod_type in MODULE_TYPES:
+            pdb_files = sorted(
+                glob.glob(args.pack + '/' + mod_type + '/*.pdb'))
+            for i, pdb_file in enumerate(pdb_files):
+                print('Packing {} [{}/{}] {}'.format(
+                    mod_type[:-1], i+1, len(pdb_files), pdb_file))
+                writer.add(
+                    mod_type,
+                    os.path.basename(pdb_file).replace('.pdb', ''),
+                    pdb_utils.read_pdb_blocks(pdb_file))
+        writer.save(args.library)
+        print('Saved {} modules to {}'.format(len(writer), args.library))
+
+    if args.export:
+        library = ModuleLibrary(args.library)
+        n_exported = library.export_pdbs(args.export)
+        print('Exported {} modules to {}'.format(n_exported, args.export))
+
+    if not args.pack and not args.export:
+        library = ModuleLibrary(args.library)
+        for mod_type in MODULE_TYPES:
+            print('{}: {}'.format(mod_type, len(library.module_names(mod_type))))
+
+
+class ModuleLibraryWriter(object):
+    """Collects modules and saves them as one module library file.
+
+    Modules are converted to library arrays as they are added and spooled to
+    temporary files, so memory use does not grow with the number of modules.
+    Name tables are numbered in the order names are first added.
+    """
+    def __init__(self):
+        self.modules = OrderedDict((t, OrderedDict()) for t in MODULE_TYPES)
+        self.tables = OrderedDict((k, OrderedDict()) for k in
+                                  ('atom_names', 'elements', 'resnames',
+                                   'hetfields', 'segids'))
+        self.spools = OrderedDict((t, ArraySpool()) for t in MODULE_TYPES)
+
+    def __len__(self):
+        return sum(len(mods) for mods in self.modules.values())
+
+    def add(self, mod_type, mod_name, chain_blocks):
+        """Adds a module.
+
+        Args:
+        - mod_type - one of MODULE_TYPES.
+        - mod_name - module name, e.g. D14 or D14-D14.
+        - chain_blocks - OrderedDict of chain ID to AtomBlock.
+        """
+        if mod_name in self.modules[mod_type]:
+            raise ValueError('Module {} was already added'.format(mod_name))
+
+        spool = self.spools[mod_type]
+        chains = OrderedDict()
+        for chain_id, block in chain_blocks.items():
+            n_residues = spool.count('residues')
+            chains[chain_id] = [n_residues, n_residues + block.n_residues]
+            spool.write(self.to_arrays(block, spool.count('atoms')))
+        self.modules[mod_type][mod_name] = chains
+
+    def add_structure(self, mod_type, mod_name, struct):
+        """Adds a module from a Bio.PDB.Structure.Structure."""
+        self.add(mod_type, mod_name, pdb_utils.get_chain_blocks(struct))
+
+    def lookup(self, table, values):
+        index = self.tables[table]
+        return [index.setdefault(v, len(index)) for v in values]
+
+    def to_arrays(self, block, atom_offset):
+        """Converts an AtomBlock into library arrays. res_starts are offset by
+        atom_offset and leave out the leading 0.
+        """
+        atoms = block.atoms
+        first = atoms[block.res_starts[:-1]]
+
+        lib_atoms = np.zeros(len(atoms), dtype=LIB_ATOM_DTYPE)
+        lib_atoms['name'] = self.lookup('atom_names', atoms['fullname'].tolist())
+        lib_atoms['element'] = self.lookup('elements', atoms['element'].tolist())
+        lib_atoms['altloc'] = np.char.encode(atoms['altloc'], 'ascii')
+        lib_atoms['occupancy'] = atoms['occupancy']
+        lib_atoms['bfactor'] = atoms['bfactor']
+
+        lib_residues = np.zeros(len(first), dtype=LIB_RESIDUE_DTYPE)
+        lib_residues['resname'] = \
+            self.lookup('resnames', first['resname'].tolist())
+        lib_residues['hetfield'] = \
+            self.lookup('hetfields', first['hetfield'].tolist())
+        lib_residues['segid'] = self.lookup('segids', first['segid'].tolist())
+        lib_residues['icode'] = np.char.encode(first['icode'], 'ascii')
+        lib_residues['resseq'] = first['resseq']
+
+        # PDB files only hold 3 decimals, so that is all that is kept.
+        return OrderedDict([
+            ('coord', np.round(block.coord, 3).astype('<f4')),
+            ('atoms', lib_atoms),
+            ('residues', lib_residues),
+            ('res_starts', (block.res_starts[1:] + atom_offset).astype('<i8'))
+        ])
+
+    def save(self, path):
+        # Modules are laid out by type, so the residue and atom indices each
+        # type's spool holds are offset by the sizes of the types before it.
+        module_index = OrderedDict()
+        res_offsets = OrderedDict()
+        atom_offsets = OrderedDict()
+        n_residues = n_atoms = 0
+        for mod_type, mods in self.modules.items():
+            module_index[mod_type] = OrderedDict(
+                (mod_name, OrderedDict(
+                    (chain_id, [start + n_residues, stop + n_residues])
+                    for chain_id, (start, stop) in chains.items()))
+                for mod_name, chains in mods.items())
+            res_offsets[mod_type] = n_residues
+            atom_offsets[mod_type] = n_atoms
+            n_residues += self.spools[mod_type].count('residues')
+            n_atoms += self.spools[mod_type].count('atoms')
+
+        arrays = OrderedDict([
+            ('coord', (np.dtype('<f4'), [n_atoms, 3])),
+            ('atoms', (LIB_ATOM_DTYPE, [n_atoms])),
+            ('residues', (LIB_RESIDUE_DTYPE, [n_residues])),
+            ('res_starts', (np.dtype('<i8'), [n_residues + 1]))
+        ])
+
+        header = OrderedDict([('version', 1)])
+        header.update((k, list(v)) for k, v in self.tables.items())
+        header['modules'] = module_index
+        header['arrays'] = OrderedDict()
+
+        # Offsets depend on the header size and vice versa, so lay the arrays
+        # out relative to the end of the header first.
+        offset = 0
+        for name, (dtype, shape) in arrays.items():
+            header['arrays'][name] = OrderedDict([
+                ('dtype', dtype.descr),
+                ('shape', shape),
+                ('offset', offset)
+            ])
+            offset = align(offset + dtype.itemsize * int(np.prod(shape)))
+
+        header_bytes = json.dumps(header, separators=(',', ':')).encode()
+        data_start = align(len(MAGIC) + 8 + len(header_bytes))
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(struct.pack('<Q', data_start - len(MAGIC) - 8))
+            file.write(header_bytes)
+            for name in arrays:
+                file.write(b'\0' * (
+                    data_start + header['arrays'][name]['offset'] -
+                    file.tell()))
+                if name == 'res_starts':
+                    file.write(np.zeros(1, dtype='<i8').tobytes())
+                for mod_type, spool in self.spools.items():
+                    if name == 'res_starts':
+                        for chunk in spool.read(name):
+                            file.write(
+                                (chunk + atom_offsets[mod_type]).tobytes())
+                    else:
+                        spool.copy_to(name, file)
+        os.replace(tmp_path, path)
+
+
+class ArraySpool(object):
+    """Appends arrays to temporary files, one file per array name, and counts
+    the rows written.
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self):
+        self.files = {}
+        self.dtypes = {}
+        self.counts = {}
+
+    def count(self, name):
+        return self.counts.get(name, 0)
+
+    def write(self, arrays):
+        for name, arr in arrays.items():
+            if name not in self.files:
+                self.files[name] = tempfile.TemporaryFile()
+                self.dtypes[name] = arr.dtype
+            self.files[name].seek(0, os.SEEK_END)
+            self.files[name].write(np.ascontiguousarray(arr).tobytes())
+            self.counts[name] = self.counts.get(name, 0) + len(arr)
+
+    def read(self, name):
+        """Yields the rows written under name in chunks."""
+        if name not in self.files:
+            return
+        file = self.files[name]
+        dtype = self.dtypes[name]
+        file.seek(0)
+        chunk_bytes = max(1, self.CHUNK_SIZE // dtype.itemsize) * dtype.itemsize
+        for data in iter(lambda: file.read(chunk_bytes), b''):
+            yield np.frombuffer(data, dtype=dtype)
+
+    def copy_to(self, name, out_file):
+        if name not in self.files:
+            return
+        file = self.files[name]
+        file.seek(0)
+        shutil.copyfileobj(file, out_file, self.CHUNK_SIZE)
+
+
+def align(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+class ModuleLibrary(object):
+    """Memory maps a module library file for reading.
+
+    Args:
+    - path - module library file path.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(
+                    '{} is not an elfin module library'.format(path))
+            header_size, = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(header_size).rstrip(b'\0 '))
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        data_start = len(MAGIC) + 8 + header_size
+        self.arrays = {}
+        for name, info in header['arrays'].items():
+            dtype = np.dtype([tuple(f) for f in info['dtype']]) \
+                if len(info['dtype']) > 1 or info['dtype'][0][0] \
+                else np.dtype(info['dtype'][0][1])
+            count = int(np.prod(info['shape']))
+            self.arrays[name] = np.frombuffer(
+                self.mmap,
+                dtype=dtype,
+                count=count,
+                offset=data_start + info['offset']).reshape(info['shape'])
+
+        self.modules = header['modules']
+        self.atom_names = np.array(header['atom_names'], dtype='U4')
+        self.elements = np.array(header['elements'], dtype='U2')
+        self.resnames = np.array(header['resnames'], dtype='U3')
+        self.hetfields = np.array(header['hetfields'], dtype='U8')
+        self.segids = np.array(header['segids'], dtype='U4')
+
+    def __reduce__(self):
+        # Memory maps cannot be pickled, so e.g. process pool workers map the
+        # file again instead.
+        return (ModuleLibrary, (self.path,))
+
+    def module_names(self, mod_type):
+        return list(self.modules[mod_type])
+
+    def has_module(self, mod_type, mod_name):
+        return mod_name in self.modules.get(mod_type, {})
+
+    def get_chain_block(self, res_start, res_stop):
+        """Returns residues [res_start, res_stop) of the library as a new
+        AtomBlock.
+        """
+        res_starts = self.arrays['res_starts'][res_start:res_stop + 1]
+        a, b = int(res_starts[0]), int(res_starts[-1])
+        res_sizes = np.diff(res_starts)
+
+        lib_atoms = self.arrays['atoms'][a:b]
+        residues = self.arrays['residues'][res_start:res_stop]
+
+        atoms = np.zeros(b - a, dtype=pdb_utils.ATOM_DTYPE)
+        atoms['fullname'] = self.atom_names[lib_atoms['name']]
+        atoms['name'] = np.char.strip(atoms['fullname'])
+        atoms['element'] = self.elements[lib_atoms['element']]
+        atoms['altloc'] = np.char.decode(lib_atoms['altloc'], 'ascii')
+        # Round back to the 2 decimals PDB files hold, so values print the
+        # same as when parsed from PDB.
+        atoms['occupancy'] = np.round(lib_atoms['occupancy'].astype('f8'), 2)
+        atoms['bfactor'] = np.round(lib_atoms['bfactor'].astype('f8'), 2)
+        atoms['serial'] = np.arange(1, b - a + 1)
+        atoms['resname'] = \
+            np.repeat(self.resnames[residues['resname']], res_sizes)
+        atoms['hetfield'] = \
+            np.repeat(self.hetfields[residues['hetfield']], res_sizes)
+        atoms['segid'] = np.repeat(self.segids[residues['segid']], res_sizes)
+        atoms['icode'] = np.repeat(
+            np.char.decode(residues['icode'], 'ascii'), res_sizes)
+        atoms['resseq'] = np.repeat(residues['resseq'], res_sizes)
+
+        # Missing codes read back as empty strings; PDB parsing gives spaces.
+        for field in ('altloc', 'icode'):
+            atoms[field][atoms[field] == ''] = ' '
+
+        return pdb_utils.AtomBlock(
+            atoms,
+            self.arrays['coord'][a:b].astype('float64'),
+            res_starts - a)
+
+    def get_module(self, mod_type, mod_name):
+        """Returns an OrderedDict of chain ID to AtomBlock for a module.
+
+        Args:
+        - mod_type - one of MODULE_TYPES.
+        - mod_name - module name.
+        """
+        return OrderedDict(
+            (chain_id, self.get_chain_block(*res_range))
+            for chain_id, res_range in
+            self.modules[mod_type][mod_name].items())
+
+    def get_structure(self, mod_type, mod_name):
+        """Returns a module as a new Bio.PDB.Structure.Structure, with float32
+        coordinates like those read by Bio.PDB.PDBParser.
+        """
+        chain_blocks = self.get_module(mod_type, mod_name)
+        for block in chain_blocks.values():
+            block.coord = block.coord.astype('float32')
+        return pdb_utils.structure_from_blocks(mod_name, chain_blocks)
+
+    def export_pdbs(self, out_dir):
+        """Saves every module as out_dir/<mod_type>/<mod_name>.pdb. Returns
+        the number of modules exported.
+        """
+        n_exported = 0
+        for mod_type in MODULE_TYPES:
+            utils.make_dir(out_dir + '/' + mod_type)
+            for mod_name in self.modules.get(mod_type, {}):
+                chain_blocks = self.get_module(mod_type, mod_name)
+                # Same float32 coordinates as get_structure() returns.
+                for block in chain_blocks.values():
+                    block.coord = block.coord.astype('float32')
+                pdb_utils.save_pdb(
+                    chain_blocks=chain_blocks,
+                    path=out_dir + '/' + mod_type + '/' + mod_name + '.pdb')
+                n_exported += 1
+        return n_exported
+
+
+if __name__ == '__main__':
+    utils.safe_exec(main)
@@ -1,10 +1,211 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
 import Bio.PDB
+import Bio.Data.IUPACData
 
 DIRTY_ATOMS = {'1H', '2H', '3H', 'OXT'}
 BACKBONE_NAMES = {'N', 'CA', 'C', 'O', 'H', 'HA'}
 
+# Per-atom fields of an AtomBlock, besides coordinates.
+ATOM_DTYPE = np.dtype([
+    ('hetfield', 'U8'),
+    ('resseq', 'i4'),
+    ('icode', 'U1'),
+    ('resname', 'U3'),
+    ('segid', 'U4'),
+    ('name', 'U4'),
+    ('fullname', 'U4'),
+    ('altloc', 'U1'),
+    ('element', 'U2'),
+    ('occupancy', 'f8'),
+    ('bfactor', 'f8'),
+    ('serial', 'i4'),
+])
+
+class AtomBlock(object):
+    """A run of residues stored as contiguous arrays, so that whole modules
+    can be moved with one matrix multiply instead of atom by atom.
+
+    Args:
+    - atoms - structured numpy array of ATOM_DTYPE, one row per atom.
+    - coord - Nx3 float64 numpy array of atom coordinates.
+    - res_starts - int numpy array of the index of the first atom of each
+        residue, followed by the total atom count.
+    """
+    def __init__(self, atoms, coord, res_starts):
+        self.atoms = atoms
+        self.coord = coord
+        self.res_starts = res_starts
+
+    def __len__(self):
+        return len(self.atoms)
+
+    @property
+    def n_residues(self):
+        return len(self.res_starts) - 1
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.zeros(0, dtype=ATOM_DTYPE),
+            np.zeros((0, 3)),
+            np.zeros(1, dtype=int))
+
+    @classmethod
+    def from_residues(cls, residues):
+        """Creates an AtomBlock from a list of Bio.PDB.Residue.Residue."""
+        rows = []
+        coords = []
+        res_starts = [0]
+        for r in residues:
+            hetfield, resseq, icode = r.id
+            for a in r:
+                rows.append((hetfield, resseq, icode, r.resname, r.segid,
+                             a.name, a.fullname, a.altloc, a.element or '',
+                             a.occupancy, a.bfactor, a.serial_number or 0))
+                coords.append(a.coord)
+            res_starts.append(len(rows))
+
+        return cls(
+            np.array(rows, dtype=ATOM_DTYPE),
+            np.array(coords, dtype='float64').reshape(-1, 3),
+            np.array(res_starts))
+
+    @classmethod
+    def concatenate(cls, blocks):
+        """Joins AtomBlocks in order into a new AtomBlock."""
+        blocks = [b for b in blocks if len(b.res_starts) > 1]
+        if not blocks:
+            return cls.empty()
+
+        offsets = np.cumsum([0] + [len(b) for b in blocks])
+        res_starts = [blocks[0].res_starts[:1]] + \
+            [b.res_starts[1:] + off for b, off in zip(blocks, offsets)]
+        return cls(
+            np.concatenate([b.atoms for b in blocks]),
+            np.concatenate([b.coord for b in blocks]),
+            np.concatenate(res_starts))
+
+    def copy(self):
+        return AtomBlock(
+            self.atoms.copy(), self.coord.copy(), self.res_starts.copy())
+
+    def save_npz(self, path):
+        """Saves the block arrays as an uncompressed .npz file. The file is
+        written next to path first and then moved in place, so readers never
+        see a partially written file.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, atoms=self.atoms, coord=self.coord,
+                     res_starts=self.res_starts)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_npz(cls, path):
+        """Loads a block saved by save_npz()."""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['atoms'], data['coord'], data['res_starts'])
+
+    def residues(self, start=None, stop=None):
+        """Returns residues [start:stop) as a new AtomBlock. Follows python
+        slice semantics, including negative indices.
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_residues)
+        stop = max(start, stop)
+        a, b = self.res_starts[start], self.res_starts[stop]
+        return AtomBlock(
+            self.atoms[a:b],
+            self.coord[a:b],
+            self.res_starts[start:stop + 1] - a)
+
+    def residue_index(self):
+        """Returns the residue index of each atom."""
+        return np.repeat(np.arange(self.n_residues), np.diff(self.res_starts))
+
+    def residue_ids(self):
+        """Returns the residue sequence number of each residue."""
+        return self.atoms['resseq'][self.res_starts[:-1]]
+
+    def ca_coord(self):
+        """Returns an Rx3 array of the carbon alpha coordinate of each
+        residue.
+        """
+        ca_idx = np.flatnonzero(self.atoms['name'] == 'CA')
+        if not np.array_equal(
+                self.residue_index()[ca_idx], np.arange(self.n_residues)):
+            raise KeyError('CA')
+        return self.coord[ca_idx]
+
+    def ca_atoms(self):
+        """Returns a new AtomBlock of only the CA atom of each residue,
+        dropping residues without one.
+        """
+        ca_idx = np.flatnonzero(self.atoms['name'] == 'CA')
+        _, first = np.unique(self.residue_index()[ca_idx], return_index=True)
+        ca_idx = ca_idx[first]
+        return AtomBlock(
+            self.atoms[ca_idx],
+            self.coord[ca_idx],
+            np.arange(len(ca_idx) + 1))
+
+    def renumber(self, first_resseq):
+        """Renumbers residues consecutively starting from first_resseq."""
+        self.atoms['resseq'] = first_resseq + self.residue_index()
+
+    def transform(self, rot, tran):
+        """Applies R*v + T to every atom with one batched matrix multiply.
+
+        Note that this is the conventional order, not BioPython's v*R + T.
+        """
+        self.coord = np.dot(self.coord, np.transpose(rot)) + tran
+
+    def to_residues(self):
+        """Returns a list of new Bio.PDB.Residue.Residue."""
+        # Fields are converted to python values column by column, as reading
+        # them from numpy records one atom at a time is much slower.
+        fields = ('name', 'bfactor', 'occupancy', 'altloc', 'fullname',
+                  'serial', 'element')
+        atom_rows = list(zip(*[self.atoms[f].tolist() for f in fields]))
+        starts = self.res_starts.tolist()
+        firsts = self.atoms[self.res_starts[:-1]]
+        residues = []
+        for i, (hetfield, resseq, icode, resname, segid) in enumerate(zip(
+                *[firsts[f].tolist() for f in
+                  ('hetfield', 'resseq', 'icode', 'resname', 'segid')])):
+            residue = Bio.PDB.Residue.Residue(
+                (hetfield, resseq, icode), resname, segid)
+            for j in range(starts[i], starts[i+1]):
+                name, bfactor, occupancy, altloc, fullname, serial, element = \
+                    atom_rows[j]
+                residue.add(Bio.PDB.Atom.Atom(
+                    name,
+                    self.coord[j],
+                    bfactor,
+                    occupancy,
+                    altloc,
+                    fullname,
+                    serial,
+                    element=element))
+            residues.append(residue)
+        return residues
+
+def get_ca_coords(residues):
+    """Returns the CA coordinates of a list of Bio.PDB.Residue.Residue as an
+    (N, 3) float64 array. Residues without a CA are skipped.
+    """
+    return np.array([r['CA'].get_coord() for r in residues if 'CA' in r],
+                    dtype='float64').reshape(-1, 3)
+
 def get_pdb_residue_count(pdb):
-    """Returns the residue count of a Bio.PDB.Structure.Structure."""
+    """Returns the residue count of a Bio.PDB.Structure.Structure, or of a PDB
+    file path, which is then read with read_pdb_blocks().
+    """
+    if isinstance(pdb, str):
+        return sum(b.n_residues for b in read_pdb_blocks(pdb).values())
     return sum([len(c.child_list) for c in pdb.child_list[0].child_list])
 
 def get_chain_residue_count(struct, chain_id):
@@ -39,6 +240,27 @@ def get_chains(struct):
     """Returns all chains of a Bio.PDB.Structure.Structure."""
     return struct.child_list[0].child_list
 
+def get_chain_blocks(struct):
+    """Returns an OrderedDict of chain ID to AtomBlock, one per chain of a
+    Bio.PDB.Structure.Structure.
+    """
+    return OrderedDict(
+        (c.id, AtomBlock.from_residues(c.child_list)) for c in get_chains(struct))
+
+def structure_from_blocks(name, chain_blocks):
+    """Builds a Bio.PDB.Structure.Structure from an OrderedDict of chain ID to
+    AtomBlock, keeping the block coordinates as they are.
+    """
+    struct = Bio.PDB.Structure.Structure(name)
+    model = Bio.PDB.Model.Model(0)
+    struct.add(model)
+    for chain_id, block in chain_blocks.items():
+        chain = Bio.PDB.Chain.Chain(chain_id)
+        for r in block.to_residues():
+            chain.add(r)
+        model.add(chain)
+    return struct
+
 def read_pdb(
         read_path,
         pdb_name=None
@@ -58,6 +280,314 @@ def read_pdb(
     structure = parser.get_structure(pdb_name, read_path)
     return structure
 
+def read_pdb_blocks(read_path, ca_only=False):
+    """Reads the first model of a PDB file as an OrderedDict of chain ID to
+    AtomBlock, without building a Bio.PDB.Structure.Structure first.
+
+    Well-formed files, such as the ones preprocess.py and dbgen.py write, are
+    parsed by parse_pdb_blocks(). Anything it does not handle is read with
+    read_pdb() instead, so the result is the same as
+    get_chain_blocks(read_pdb(read_path)) either way.
+
+    Args:
+    - read_path - PDB string file path to read from.
+    - ca_only - keep only the CA atom of each residue, dropping residues
+        without one.
+
+    Returns:
+    - chain_blocks - OrderedDict of chain ID to AtomBlock.
+    """
+    with open(read_path, 'rb') as file:
+        data = file.read()
+
+    try:
+        return parse_pdb_blocks(data, ca_only=ca_only)
+    except ValueError:
+        chain_blocks = get_chain_blocks(read_pdb(read_path))
+
+    if ca_only:
+        chain_blocks = OrderedDict(
+            (chain_id, block.ca_atoms())
+            for chain_id, block in chain_blocks.items())
+    return chain_blocks
+
+# Fixed (start, stop) columns of ATOM record fields.
+PDB_COLUMNS = {
+    'record': (0, 6),
+    'serial': (6, 11),
+    'fullname': (12, 16),
+    'altloc': (16, 17),
+    'resname': (17, 20),
+    'chain': (21, 22),
+    'resseq': (22, 26),
+    'icode': (26, 27),
+    'x': (30, 38),
+    'y': (38, 46),
+    'z': (46, 54),
+    'occupancy': (54, 60),
+    'bfactor': (60, 66),
+    'segid': (72, 76),
+    'element': (76, 78),
+}
+
+def parse_pdb_blocks(data, ca_only=False):
+    """Parses the first model of a PDB file into an OrderedDict of chain ID to
+    AtomBlock, the same as get_chain_blocks() of what
+    Bio.PDB.PDBParser(PERMISSIVE=False) reads. Each field is cut out of all
+    ATOM records at once as a column of a 2D character array.
+
+    Only files with a single model of ATOM records are handled, where every
+    atom has an element symbol and no alternate location, and no residue or
+    chain is repeated. Anything else raises ValueError, as do malformed
+    fields.
+
+    Args:
+    - data - bytes content of a PDB file.
+    - ca_only - keep only the CA atom of each residue, dropping residues
+        without one.
+
+    Returns:
+    - chain_blocks - OrderedDict of chain ID to AtomBlock.
+    """
+    if b'\r' in data or b'\0' in data:
+        raise ValueError('Unexpected control characters')
+
+    # Short lines are padded with NULs, which numpy drops from the ends of
+    # byte strings, so every column reads the same as the line slice would.
+    lines = np.array(data.split(b'\n'), dtype='S80')
+    chars = lines.view('u1').reshape(len(lines), 80)
+
+    def column(rows, field):
+        start, stop = PDB_COLUMNS[field]
+        return np.ascontiguousarray(rows[:, start:stop]) \
+            .view('S{}'.format(stop - start)).ravel()
+
+    # Coordinates start at the first ATOM, HETATM or MODEL record and stop at
+    # the first END or CONECT record, like in Bio.PDB.PDBParser.
+    records = column(chars, 'record')
+    coord_starts = np.flatnonzero(
+        np.isin(records, [b'ATOM  ', b'HETATM', b'MODEL ']))
+    if len(coord_starts) == 0:
+        raise ValueError('No coordinate records')
+    start = coord_starts[0]
+    ends = np.flatnonzero(np.isin(records[start:], [b'END   ', b'CONECT']))
+    stop = start + ends[0] if len(ends) else len(records)
+    records = records[start:stop]
+
+    if np.isin(records, [b'HETATM', b'MODEL ', b'ENDMDL']).any():
+        raise ValueError('Unsupported HETATM or MODEL records')
+    rows = chars[start:stop][records == b'ATOM  ']
+    if (rows[:, PDB_COLUMNS['altloc'][0]] != ord(' ')).any():
+        raise ValueError('Unsupported alternate locations')
+
+    chains = column(rows, 'chain')
+    resseqs = column(rows, 'resseq').astype('i4')
+    icodes = column(rows, 'icode')
+    resnames = np.char.strip(column(rows, 'resname'))
+    fullnames = column(rows, 'fullname')
+    names = np.char.strip(fullnames)
+    if (np.char.str_len(names) == 0).any() or \
+            (np.char.find(names, b' ') >= 0).any():
+        raise ValueError('Unsupported atom names')
+
+    # A new residue starts whenever the chain, residue ID or name changes.
+    n_atoms = len(rows)
+    new_res = np.ones(n_atoms, dtype=bool)
+    new_res[1:] = (chains[1:] != chains[:-1]) | \
+        (resseqs[1:] != resseqs[:-1]) | (icodes[1:] != icodes[:-1]) | \
+        (resnames[1:] != resnames[:-1])
+    res_starts = np.append(np.flatnonzero(new_res), n_atoms)
+    res_index = np.cumsum(new_res) - 1
+
+    # Repeated chains, residues and atoms are merged or flagged as disordered
+    # by Bio.PDB, which AtomBlocks do not model.
+    chain_changes = np.flatnonzero(chains[1:] != chains[:-1]) + 1
+    chain_starts = np.concatenate(([0], chain_changes, [n_atoms]))
+    chain_ids = chains[chain_starts[:-1]]
+    if len(np.unique(chain_ids)) != len(chain_ids):
+        raise ValueError('Discontinuous chains')
+
+    first = res_starts[:-1]
+    if has_duplicates(chains[first], resseqs[first], icodes[first]):
+        raise ValueError('Repeated residues')
+    if has_duplicates(res_index, names):
+        raise ValueError('Repeated atom names')
+
+    elements = np.char.upper(np.char.strip(column(rows, 'element')))
+    for element in np.unique(elements).tolist():
+        if element.decode().capitalize() not in \
+                Bio.Data.IUPACData.atom_weights:
+            raise ValueError('Unknown element {}'.format(element))
+
+    # Coordinates are parsed as float64 and then rounded to float32, which is
+    # what Bio.PDB.Atom.Atom stores.
+    coord = np.stack(
+        [column(rows, axis).astype('f8') for axis in ('x', 'y', 'z')],
+        axis=1).astype('f4').astype('f8')
+
+    atoms = np.empty(n_atoms, dtype=ATOM_DTYPE)
+    atoms['hetfield'] = ' '
+    atoms['resseq'] = resseqs
+    atoms['icode'] = icodes.astype('U1')
+    atoms['resname'] = resnames.astype('U3')
+    # Residues take the segment ID of their first atom.
+    atoms['segid'] = column(rows, 'segid')[first][res_index].astype('U4')
+    atoms['name'] = names.astype('U4')
+    atoms['fullname'] = fullnames.astype('U4')
+    atoms['altloc'] = ' '
+    atoms['element'] = elements.astype('U2')
+    atoms['occupancy'] = column(rows, 'occupancy').astype('f8')
+    atoms['bfactor'] = column(rows, 'bfactor').astype('f8')
+    atoms['serial'] = column(rows, 'serial').astype('i4')
+
+    chain_blocks = OrderedDict()
+    for chain_id, a, b in zip(
+            chain_ids.astype('U1').tolist(),
+            chain_starts[:-1].tolist(), chain_starts[1:].tolist()):
+        block_res_starts = res_starts[
+            np.searchsorted(res_starts, a):np.searchsorted(res_starts, b) + 1]
+        block = AtomBlock(atoms[a:b], coord[a:b], block_res_starts - a)
+        chain_blocks[chain_id] = block.ca_atoms() if ca_only else block
+    return chain_blocks
+
+def has_duplicates(*keys):
+    """Returns whether any two rows of the given equal length key arrays are
+    the same.
+    """
+    order = np.lexsort(keys)
+    same = np.ones(len(order) - 1 if len(order) else 0, dtype=bool)
+    for key in keys:
+        sorted_key = key[order]
+        same &= sorted_key[1:] == sorted_key[:-1]
+    return bool(same.any())
+
+# Dummy section appended to CIF files for Rosetta (see save_cif()).
+CIF_TRAILER = '_citation.title  "Elfin"'
+
+CIF_ATOM_SITE_FIELDS = [
+    'group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id',
+    'label_comp_id', 'label_asym_id', 'label_entity_id', 'label_seq_id',
+    'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy',
+    'B_iso_or_equiv', 'auth_seq_id', 'auth_asym_id', 'pdbx_PDB_model_num'
+]
+
+_CIF_ROW_FORMAT = \
+    '{:<6} {:<6} {:<2} {:<4} {} {:<3} {:<3} ? {:<5} {} ' \
+    '{:<9.3f} {:<9.3f} {:<9.3f} {:<4} {:<5} {:<5} {} 1\n'
+
+def cif_quote(val):
+    """Quotes an mmCIF value if it would otherwise be misread, the same way
+    Bio.PDB.MMCIFIO does.
+    """
+    if not val:
+        return '?'
+    if ' ' in val or "'" in val or '"' in val or \
+            val[0] in ['_', '#', '$', '[', ']', ';'] or \
+            val.startswith(('data_', 'save_')) or \
+            val in ['loop_', 'stop_', 'global_']:
+        return '"' + val + '"' if "' " in val else "'" + val + "'"
+    return val
+
+def cif_asym_id(entity_id):
+    """Converts a positive integer into a label_asym_id: A to Z, then AA to ZA,
+    AB to ZB etc, like Bio.PDB.MMCIFIO.
+    """
+    out = ''
+    while entity_id > 0:
+        mod = (entity_id - 1) % 26
+        out += chr(65 + mod)
+        entity_id = (entity_id - mod) // 26
+    return out
+
+class CifWriter(object):
+    """Streams AtomBlocks into an mmCIF _atom_site table one chain at a time,
+    so that neither a whole Bio.PDB.Structure.Structure nor an mmCIF dict of
+    it needs to be held in memory. Produces the same table as save_cif().
+
+    Args:
+    - file - writable text file object.
+    - data_name - name of the mmCIF data block.
+    """
+    def __init__(self, file, data_name='0'):
+        self.file = file
+        self.data_name = data_name
+        self.atom_id = 1
+        self.entity_id = 0
+
+    def write_header(self):
+        self.file.write('data_{}\n#\nloop_\n'.format(self.data_name))
+        self.file.writelines(
+            '_atom_site.' + f + '\n' for f in CIF_ATOM_SITE_FIELDS)
+
+    def write_chain(self, chain_block, chain_id):
+        """Writes the _atom_site rows of one chain.
+
+        Args:
+        - chain_block - AtomBlock of the chain's residues.
+        - chain_id - string chain ID.
+        """
+        n_atoms = len(chain_block)
+        if n_atoms == 0:
+            return
+
+        atoms = chain_block.atoms
+        res_first = atoms[chain_block.res_starts[:-1]]
+        res_sizes = np.diff(chain_block.res_starts)
+
+        # label_entity_id and label_asym_id change with each molecule, i.e.
+        # on the first residue of a chain and whenever the residue type or a
+        # hetero residue name changes.
+        is_atom = res_first['hetfield'] == ' '
+        resnames = res_first['resname']
+        changed = np.ones(len(res_first), dtype=bool)
+        changed[1:] = (is_atom[1:] != is_atom[:-1]) | \
+            (~is_atom[1:] & (resnames[1:] != resnames[:-1]))
+        entity_ids = self.entity_id + np.cumsum(changed)
+        self.entity_id = int(entity_ids[-1])
+
+        # label_seq_id counts ATOM residues only.
+        seq_ids = np.cumsum(is_atom)
+
+        res_cols = [
+            ['ATOM' if a else 'HETATM' for a in is_atom],
+            [cif_asym_id(e) for e in entity_ids.tolist()],
+            [str(s) if a else '.' for s, a in zip(seq_ids.tolist(), is_atom)],
+            [cif_quote(i.strip()) for i in res_first['icode'].tolist()],
+            [cif_quote(n.strip()) for n in resnames.tolist()],
+            res_first['resseq'].tolist()
+        ]
+        group, asym_id, seq_id, icode, comp_id, auth_seq_id = \
+            [np.repeat(np.asarray(c, dtype=object), res_sizes).tolist()
+             for c in res_cols]
+
+        quoted = {}
+        def quote_all(values):
+            return [quoted[v] if v in quoted else
+                    quoted.setdefault(v, cif_quote(v.strip()))
+                    for v in values.tolist()]
+
+        atom_ids = range(self.atom_id, self.atom_id + n_atoms)
+        self.atom_id += n_atoms
+
+        auth_asym_id = cif_quote(chain_id.strip()) if chain_id != ' ' else '.'
+        coord = chain_block.coord.tolist()
+        self.file.write(''.join([
+            _CIF_ROW_FORMAT.format(*row) for row in zip(
+                group, atom_ids,
+                quote_all(atoms['element']),
+                quote_all(atoms['name']),
+                [a if a != ' ' else '.' for a in atoms['altloc'].tolist()],
+                comp_id, asym_id, seq_id, icode,
+                (c[0] for c in coord), (c[1] for c in coord),
+                (c[2] for c in coord),
+                atoms['occupancy'].tolist(), atoms['bfactor'].tolist(),
+                auth_seq_id, [auth_asym_id] * n_atoms)
+        ]))
+
+    def write_footer(self):
+        self.file.write('#\n')
+        self.file.writelines(CIF_TRAILER)
+
 def save_cif(**kwargs):
     """Saves a Bio.PDB.Structure.Structure as a CIF file. Does not automatically
     append .cif extension.
@@ -77,21 +607,239 @@ def save_cif(**kwargs):
         # a dummy section at the end. ("Note that the final table in the cif file
         # may not be recognized - adding a dummy entry (like `_citation.title
         # ""`) to the end of the file may help.")
-        file.writelines('_citation.title  "Elfin"')
+        file.writelines(CIF_TRAILER)
+
+# Columns of the ATOM lines written by Bio.PDB.PDBIO, as (start, stop).
+# Occupancy and B factor are written as %6.2f, which is what PDBIO does for
+# values that fit.
+_PDB_LINE_WIDTH = 81
+_PDB_WRITE_COLUMNS = {
+    'record': (0, 6),
+    'serial': (6, 11),
+    'name': (12, 16),
+    'altloc': (16, 17),
+    'resname': (17, 20),
+    'chain': (21, 22),
+    'resseq': (22, 26),
+    'icode': (26, 27),
+    'coord': (30, 54),
+    'occupancy_bfactor': (54, 66),
+    'segid': (72, 76),
+    'element': (76, 78),
+}
+_PDB_TER_FORMAT = 'TER   %5i      %3s %c%4i%c' + ' ' * 54 + '\n'
+_PDB_END = 'END   \n'
+
+def format_fixed(values, width, decimals=0):
+    """Formats numbers the same way as '%{width}.{decimals}f' % value, or as
+    '%{width}i' % value for ints, into a uint8 character array of shape
+    values.shape + (width,), without formatting each number separately.
+
+    Numbers are scaled and rounded to integers, and the digits are cut out of
+    those. Floats too close to halfway between two rounded values for that to
+    be reliable are rounded by python's own formatting instead.
+
+    Raises ValueError if a number does not fit in width characters.
+    """
+    values = np.asarray(values)
+    shape = values.shape + (width,)
+    values = values.reshape(-1)
+    dot = 1 if decimals else 0
+    limit = 10 ** (width - dot)
+    if values.dtype.kind == 'f':
+        values = values.astype('float64')
+        negative = np.signbit(values)
+        scaled = np.abs(values) * 10 ** decimals
+        if not (scaled < limit).all():
+            raise ValueError('Number does not fit {} characters'.format(width))
+        rounded = np.rint(scaled)
+        digits = rounded.astype('i8')
+        ties = np.abs(np.abs(scaled - rounded) - 0.5) < 1e-6
+        for i in np.flatnonzero(ties).tolist():
+            digits[i] = int('{:.{}f}'.format(abs(values[i]), decimals)
+                            .replace('.', ''))
+    else:
+        values = values.astype('i8')
+        negative = values < 0
+        digits = np.abs(values)
+
+    # Digits are placed from the right, skipping the decimal point, with the
+    # minus sign right before the first digit.
+    place = np.arange(width - dot)
+    powers = 10 ** place
+    n_digits = np.maximum(
+        np.searchsorted(powers, digits, side='right'), decimals + 1)
+    if not (digits < limit).all() or \
+            (n_digits + dot + negative > width).any():
+        raise ValueError('Number does not fit {} characters'.format(width))
+
+    digit_chars = np.where(
+        n_digits[:, np.newaxis] > place,
+        ord('0') + digits.astype('i4')[:, np.newaxis] //
+            powers.astype('i4') % 10,
+        ord(' ')).astype('u1')
+    signed = np.flatnonzero(negative)
+    digit_chars[signed, n_digits[signed]] = ord('-')
+
+    chars = np.empty((len(digits), width), dtype='u1')
+    if dot:
+        chars[:, width - 1 - decimals] = ord('.')
+    chars[:, width - 1 - place - dot * (place >= decimals)] = digit_chars
+    return chars.reshape(shape)
+
+def format_strings(values, width, format_value):
+    """Formats string values into an (N, width) uint8 character array, calling
+    format_value() once per distinct value.
+
+    Raises ValueError if a formatted value is not exactly width ASCII
+    characters.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    formatted = [format_value(v) for v in uniques.tolist()]
+    if any(len(f) != width for f in formatted):
+        raise ValueError('Value does not fit {} characters'.format(width))
+    table = np.frombuffer(
+        ''.join(formatted).encode('ascii'), dtype='u1').reshape(-1, width)
+    return table[inverse.reshape(-1)]
+
+def format_pdb(chain_blocks):
+    """Formats an OrderedDict of chain ID to AtomBlock as PDB file content,
+    byte for byte what Bio.PDB.PDBIO writes for the same residues. All atom
+    lines are filled in column by column as one character array.
+
+    Raises ValueError for values that PDBIO would reject or format
+    differently, e.g. atom serial numbers above 99999 or B factors that do
+    not fit %6.2f.
+
+    Args:
+    - chain_blocks - OrderedDict of chain ID to AtomBlock.
+
+    Returns:
+    - content - PDB file content string.
+    """
+    chain_blocks = [(c, b) for c, b in chain_blocks.items() if len(b) > 0]
+    if not chain_blocks:
+        return _PDB_END
+    for chain_id, block in chain_blocks:
+        if len(chain_id) != 1:
+            raise ValueError('Chain ID {} does not fit PDB'.format(chain_id))
+        if (np.diff(block.res_starts) == 0).any():
+            raise ValueError('Empty residue')
+
+    block = AtomBlock.concatenate([b for _, b in chain_blocks])
+    atoms = block.atoms
+    n_atoms = len(atoms)
+    if n_atoms > 99999:
+        raise ValueError('Atom serial numbers do not fit PDB')
+    if (atoms['resseq'] > 9999).any():
+        raise ValueError('Residue numbers do not fit PDB')
+
+    # Same as PDBIO: elements are upper case and right aligned, and atom
+    # names of up to three letters start in the second column unless the
+    # element has two letters.
+    def format_element(element):
+        symbol = element.strip().upper()
+        if symbol and symbol.capitalize() not in \
+                Bio.Data.IUPACData.atom_weights and symbol != 'X':
+            raise ValueError('Unrecognised element {}'.format(element))
+        return symbol.rjust(2)
+
+    def format_name(element_name):
+        element, name = element_name[:2], element_name[2:].strip()
+        if len(name) < 4 and name[:1].isalpha() and \
+                len(element.strip()) < 2:
+            name = ' ' + name
+        return '%-4s' % name
+
+    elements = format_strings(atoms['element'], 2, format_element)
+    names = format_strings(
+        np.char.add(elements.view('S2').ravel().astype('U2'),
+                    atoms['fullname']),
+        4, format_name)
+
+    chain_ids = np.repeat(
+        [c for c, _ in chain_blocks], [len(b) for _, b in chain_blocks])
+    lines = np.full((n_atoms, _PDB_LINE_WIDTH), ord(' '), dtype='u1')
+    lines[:, -1] = ord('\n')
+    columns = {
+        'record': format_strings(
+            atoms['hetfield'], 6,
+            lambda h: 'ATOM  ' if h == ' ' else 'HETATM'),
+        'serial': format_fixed(np.arange(1, n_atoms + 1), 5),
+        'name': names,
+        'altloc': format_strings(atoms['altloc'], 1, str),
+        'resname': format_strings(atoms['resname'], 3, lambda r: '%3s' % r),
+        'chain': format_strings(chain_ids, 1, str),
+        'resseq': format_fixed(atoms['resseq'], 4),
+        'icode': format_strings(atoms['icode'], 1, str),
+        'coord': format_fixed(block.coord, 8, 3),
+        'occupancy_bfactor': format_fixed(
+            np.stack([atoms['occupancy'], atoms['bfactor']], axis=1), 6, 2),
+        'segid': format_strings(atoms['segid'], 4, lambda s: '%4s' % s),
+        'element': elements,
+    }
+    for name, chars in columns.items():
+        start, stop = _PDB_WRITE_COLUMNS[name]
+        lines[:, start:stop] = chars.reshape(n_atoms, -1)
+
+    # Each chain is followed by a TER record, which PDBIO does not count in
+    # atom serial numbers.
+    chunks = []
+    text = lines.tobytes().decode('ascii')
+    offset = 0
+    for chain_id, chain_block in chain_blocks:
+        last = chain_block.atoms[-1]
+        chunks.append(text[offset * _PDB_LINE_WIDTH:
+                           (offset + len(chain_block)) * _PDB_LINE_WIDTH])
+        offset += len(chain_block)
+        chunks.append(_PDB_TER_FORMAT % (
+            offset + 1, last['resname'], chain_id, last['resseq'],
+            last['icode']))
+    chunks.append(_PDB_END)
+    return ''.join(chunks)
+
+def get_pdb_blocks(struct):
+    """Returns get_chain_blocks() of a Bio.PDB.Structure.Structure if it holds
+    exactly what PDBIO would write, i.e. a single model without disordered
+    atoms or residues. Raises ValueError otherwise.
+    """
+    if len(struct) != 1:
+        raise ValueError('Structure has {} models'.format(len(struct)))
+    for chain in get_chains(struct):
+        for r in chain.child_list:
+            if r.is_disordered():
+                raise ValueError('Disordered residue {}'.format(r.id))
+    return get_chain_blocks(struct)
 
 def save_pdb(**kwargs):
-    """Saves a Bio.PDB.Structure.Structure as a PDB file.
+    """Saves a Bio.PDB.Structure.Structure, or an OrderedDict of chain ID to
+    AtomBlock, as a PDB file. The content is made by format_pdb() and
+    written with a single call, falling back to Bio.PDB.PDBIO for anything
+    format_pdb() does not handle.
 
     Args:
     - struct - Bio.PDB.Structure.Structure to be saved.
-    - save_path - string file path.
+    - chain_blocks - OrderedDict of chain ID to AtomBlock to be saved
+        instead of struct.
+    - path - string file path.
     """
-    struct = kwargs.pop('struct')
+    struct = kwargs.pop('struct', None)
+    chain_blocks = kwargs.pop('chain_blocks', None)
     path = kwargs.pop('path')
 
-    io = Bio.PDB.PDBIO()
-    io.set_structure(struct)
-    io.save(path)
+    try:
+        content = format_pdb(
+            get_pdb_blocks(struct) if chain_blocks is None else chain_blocks)
+    except ValueError:
+        if struct is None:
+            struct = structure_from_blocks('0', chain_blocks)
+        io = Bio.PDB.PDBIO()
+        io.set_structure(struct)
+        io.save(path)
+        return
+
+    with open(path, 'w') as file:
+        file.write(content)
 
 def main():
     """main"""
@@ -4,6 +4,7 @@ import argparse, sys
 import subprocess, glob
 from utilities import *
 from pdb_utilities import *
+from kabsch import superimpose
 
 def merge_chains(pdb):
     """Merge all chains in a PDB structure and re-number the residue IDs
@@ -108,7 +109,7 @@ def preprocess_double(double_file):
     sdouble_chain_lens = [len(c.child_list) for c in sdouble_chains]
     sdouble_mid_res = sdouble_chains[0].child_list[sdouble_start_idx:] + \
         sdouble_chains[1].child_list[:sdouble_end_offset]
-    sdouble_atoms = [a for r in sdouble_mid_res for a in r.child_list if a.name == 'CA']
+    sdouble_cas = get_ca_coords(sdouble_mid_res)
 
     # Find first half of the residues
     double_chain_lens = [len(c.child_list) for c in double_chains]
@@ -117,12 +118,11 @@ def preprocess_double(double_file):
         (double_chains[0].child_list[sdouble_start_idx:] if sdouble_first else \
         double_chains[0].child_list[double_start_offset:]) + \
         double_chains[1].child_list[:sdouble_end_offset]
-    double_atoms = [a for r in double_mid_res for a in r.child_list if a.name == 'CA']
+    double_cas = get_ca_coords(double_mid_res)
 
     # Superimpose double onto sdouble
-    si = Bio.PDB.Superimposer()
-    si.set_atoms(sdouble_atoms, double_atoms)
-    double.transform(*si.rotran)
+    rot, tran, _ = superimpose(sdouble_cas, double_cas)
+    double.transform(rot, tran)
 
     # Merge chains and remove bad atoms
     cleanse_atoms(merge_chains(double))
@@ -146,6 +146,9 @@ def parse_args(args):
     parser.add_argument('--output_dir', default='./resources/pdb_prepped/')
     parser.add_argument('--output_dir_cap', default='./resources/pdb_cappings/')
     parser.add_argument('--dry_run', action='store_true')
+    parser.add_argument('--writer_threads', type=int, default=1,
+        help='Number of threads writing prepped PDBs while the next ones are '
+        'prepped. 0 writes them in the prepping thread.')
     return parser.parse_args(args)
 
 def main(test_args=None):
@@ -167,45 +170,49 @@ def main(test_args=None):
         cap_output_dir = args.output_dir_cap
         make_dir(cap_output_dir)
 
-    # Doubles
-    doubleFiles = glob.glob(args.input_dir + '/doubles/*.pdb')
-    N = len(doubleFiles)
-    for i in range(N):
-        double_file = doubleFiles[i]
-        print('Prepping double [{}/{}] {}'.format(i+1, N, double_file))
-        double = preprocess_double(double_file)
-        if not args.dry_run:
-            save_pdb(struct=double, path=double_output_dir + '/' + os.path.basename(double_file))
-
-    # Singles
-    singleFiles = glob.glob(args.input_dir + '/singles/*.pdb')
-    N = len(singleFiles)
-    for i in range(N):
-        single_file = singleFiles[i]
-        print('Prepping single [{}/{}] {}'.format(i+1, N, single_file))
-        # Singles need nothing other than cleansing
-        single = cleanse_atoms(read_pdb(single_file))
-        if not args.dry_run:
-            save_pdb(struct=single, path=single_output_dir + '/' + os.path.basename(single_file))
-
-    # Hubs
-    hubFiles = glob.glob(args.input_dir + '/hubs/*.pdb')
-    N = len(hubFiles)
-    for i in range(N):
-        hub_file = hubFiles[i]
-        print('Prepping hub [{}/{}] {}'.format(i+1, N, hub_file))
-        hub = cleanse_atoms(read_pdb(hub_file))
-        if not args.dry_run:
-            save_pdb(struct=hub, path=hub_output_dir + '/' + os.path.basename(hub_file))
-    # Caps
-    capFiles = glob.glob(args.input_dir + '/cappings/*.pdb')
-    N = len(capFiles)
-    for i in range(N):
-        cap_file = capFiles[i]
-        print('Prepping cap [{}/{}] {}'.format(i+1, N, cap_file))
-        cap = cleanse_atoms(read_pdb(cap_file))
-        if not args.dry_run:
-            save_pdb(struct=cap, path=cap_output_dir + os.path.basename(cap_file))
+    # Prepped PDBs are saved in the background while the next ones are
+    # prepped. Leaving the block waits for them, or stops the writer threads
+    # if a prep step fails.
+    with BackgroundWriter(args.writer_threads) as writer:
+        # Doubles
+        doubleFiles = glob.glob(args.input_dir + '/doubles/*.pdb')
+        N = len(doubleFiles)
+        for i in range(N):
+            double_file = doubleFiles[i]
+            print('Prepping double [{}/{}] {}'.format(i+1, N, double_file))
+            double = preprocess_double(double_file)
+            if not args.dry_run:
+                writer.submit(save_pdb, struct=double, path=double_output_dir + '/' + os.path.basename(double_file))
+
+        # Singles
+        singleFiles = glob.glob(args.input_dir + '/singles/*.pdb')
+        N = len(singleFiles)
+        for i in range(N):
+            single_file = singleFiles[i]
+            print('Prepping single [{}/{}] {}'.format(i+1, N, single_file))
+            # Singles need nothing other than cleansing
+            single = cleanse_atoms(read_pdb(single_file))
+            if not args.dry_run:
+                writer.submit(save_pdb, struct=single, path=single_output_dir + '/' + os.path.basename(single_file))
+
+        # Hubs
+        hubFiles = glob.glob(args.input_dir + '/hubs/*.pdb')
+        N = len(hubFiles)
+        for i in range(N):
+            hub_file = hubFiles[i]
+            print('Prepping hub [{}/{}] {}'.format(i+1, N, hub_file))
+            hub = cleanse_atoms(read_pdb(hub_file))
+            if not args.dry_run:
+                writer.submit(save_pdb, struct=hub, path=hub_output_dir + '/' + os.path.basename(hub_file))
+        # Caps
+        capFiles = glob.glob(args.input_dir + '/cappings/*.pdb')
+        N = len(capFiles)
+        for i in range(N):
+            cap_file = capFiles[i]
+            print('Prepping cap [{}/{}] {}'.format(i+1, N, cap_file))
+            cap = cleanse_atoms(read_pdb(cap_file))
+            if not args.dry_run:
+                writer.submit(save_pdb, struct=cap, path=cap_output_dir + os.path.basename(cap_file))
 
 
 if __name__ == '__main__':
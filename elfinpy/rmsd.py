@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-import argparse, sys
+import argparse, glob, sys
 from utilities import *
+from pdb_utilities import *
+from kabsch import superimpose
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Sliding-window RMSD calculator')
@@ -12,6 +14,14 @@ def parse_args(args):
     parser.add_argument('-warn_threshold', default=5.0)
     return parser.parse_args(args)
 
+def read_ca_coords(pdb_file):
+    """Returns the CA coordinates of all chains of a PDB file as an (N, 3)
+    array, without reading the other atoms into a structure.
+    """
+    chain_blocks = read_pdb_blocks(pdb_file, ca_only=True)
+    return np.concatenate(
+        [np.zeros((0, 3))] + [b.coord for b in chain_blocks.values()])
+
 def main(test_args=None):
     args = parse_args(sys.argv[1:] if test_args is None else test_args)
 
@@ -34,72 +44,54 @@ def main(test_args=None):
         minimised_file = minimised_files[i]
         solution_file = args.solution_dir + minimised_file[minimised_file.rfind('/'):].replace('_0001.pdb', '.pdb')
             
-        minimised_pdb = read_pdb(minimised_file)
-        solution_pdb = read_pdb(solution_file)
-
-        minimised_CAs = []
-        solution_CAs = []
-        for a in minimised_pdb.get_atoms():
-            if a.id == 'CA':
-                minimised_CAs.append(a)
-        for a in solution_pdb.get_atoms():
-            if a.id == 'CA':
-                solution_CAs.append(a)
+        minimised_CA_coords = read_ca_coords(minimised_file)
+        solution_CAs = read_ca_coords(solution_file)
+
+        n_minimised_CAs = len(minimised_CA_coords)
+
+        if n_minimised_CAs != len(solution_CAs):
+            print('{}: Fatal! Number of CAs are different... Solution: {}, Minimised: {}'.format(
+                solution_file, len(solution_CAs), n_minimised_CAs))
+            continue
 
         # Superimpose the two structures before comparing
-        si = Bio.PDB.Superimposer()
-        si.set_atoms(minimised_CAs, solution_CAs)
-        rot, tran = si.rotran
+        rot, tran, _ = superimpose(minimised_CA_coords, solution_CAs)
 
-        solution_pdb.transform(rot, tran)
+        # The rotation follows BioPython's v*R + T order.
+        solution_CA_coords = np.dot(solution_CAs, rot) + tran
 
-        minimised_CA_coords = []
-        solution_CA_coords = []
-        for a in minimised_pdb.get_atoms():
-            if a.id == 'CA':
-                minimised_CA_coords.append(a.coord)
-        for a in solution_pdb.get_atoms():
-            if a.id == 'CA':
-                solution_CA_coords.append(a.coord)
+        stats = {
+            'min': float('inf'),
+            'avg': float('nan'),
+            'max': -float('inf')
+        }
 
-        n_minimised_CAs =len(minimised_CA_coords)
+        sum_win_rmsd = 0.0
+        start_index = 0
+        window_count = 0
+        while start_index + args.window_len - 1 < n_minimised_CAs:
+            sumD = 0.0
+            for i in range(start_index, start_index+args.window_len):
+                sumD += np.linalg.norm(minimised_CA_coords[i] - solution_CA_coords[i], 2)
 
-        if n_minimised_CAs != len(solution_CA_coords):
-            print('{}: Fatal! Number of CAs are different... Solution: {}, Minimised: {}'.format(
-                solution_file, len(solution_CA_coords), n_minimised_CAs))
-        else:
-            stats = {
-                'min': float('inf'),
-                'avg': float('nan'),
-                'max': -float('inf')
-            }
-
-            sum_win_rmsd = 0.0
-            start_index = 0
-            window_count = 0
-            while start_index + args.window_len - 1 < n_minimised_CAs:
-                sumD = 0.0
-                for i in range(start_index, start_index+args.window_len):
-                    sumD += np.linalg.norm(minimised_CA_coords[i] - solution_CA_coords[i], 2)
-
-                winRmsd = np.sqrt(sumD / args.window_len)
-                if winRmsd < stats['min']:
-                    stats['min'] = winRmsd
-                if winRmsd > stats['max']:
-                    stats['max'] = winRmsd
-
-                sum_win_rmsd += winRmsd
-                window_count += 1
-
-                start_index += overlap
-
-            stats['avg'] = sum_win_rmsd / window_count
-
-            print('{:20} avg: {:10} min {:10} max {:10}'.format(
-                solution_file, stats['avg'], stats['min'], stats['max']))
-
-            if stats['max'] > args.warn_threshold:
-                print('Warning: max window RMSD of {} exceeded!'.format(args.warn_threshold))
+            winRmsd = np.sqrt(sumD / args.window_len)
+            if winRmsd < stats['min']:
+                stats['min'] = winRmsd
+            if winRmsd > stats['max']:
+                stats['max'] = winRmsd
+
+            sum_win_rmsd += winRmsd
+            window_count += 1
+
+            start_index += overlap
+
+        stats['avg'] = sum_win_rmsd / window_count
+
+        print('{:20} avg: {:10} min {:10} max {:10}'.format(
+            solution_file, stats['avg'], stats['min'], stats['max']))
+
+        if stats['max'] > args.warn_threshold:
+            print('Warning: max window RMSD of {} exceeded!'.format(args.warn_threshold))
 
 if __name__ == '__main__':
     safe_exec(main)
@@ -13,6 +13,7 @@ matplotlib.use('Agg')
 plt.ioff()
 
 from utilities import *
+from xdb import XDB
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Prints module radii stat from xdb')
@@ -64,32 +65,22 @@ def show_graph_with_labels(adjacency_matrix, labels):
 def main(test_args=None):
     args = parse_args(sys.argv[1:] if test_args is None else test_args)
 
-    xdb = read_json('resources/xdb.json')
+    xdb = XDB.load('resources/xdb.json')
 
     # Print centre-of-mass stats
     (avg_d, min_d, max_d) = com_dist_info(xdb)
     print('Distances avg: {}, min: {}, max: {}'.format(avg_d, min_d, max_d))
 
     # Print adjacency matrix
-    singles = xdb['modules']['singles']
-    hubs = xdb['modules']['hubs']
+    n_modules = len(xdb.mod_names)
+    all_names = xdb.mod_names
 
-    n_singles = len(singles)
-    n_hubs = len(hubs)
-    n_modules = n_singles + n_hubs
-
-    all_names = list(singles.keys()) + list(hubs.keys())
-    name_to_idx = {name: i for i, name in enumerate(all_names)}
-
-    adjmat = [[0] * n_modules for _ in range(0, n_modules)]
+    adjmat = np.zeros((n_modules, n_modules))
 
     # print('-----------Adjacency Matrix-----------')
 
-    for tx in xdb['n_to_c_tx']:
-        mod_a, mod_b = tx['mod_a'], tx['mod_b']
-        id_a, id_b = name_to_idx[mod_a], name_to_idx[mod_b]
-        adjmat[id_a][id_b] = 1.0
-        # print(','.join((mod_a, mod_b)))
+    adjmat[xdb.chain_mods[xdb.tx_chains_a],
+           xdb.chain_mods[xdb.tx_chains_b]] = 1.0
 
     show_graph_with_labels(adjmat, all_names)
     
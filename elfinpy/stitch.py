@@ -7,8 +7,13 @@
 
 from collections import deque
 from collections import namedtuple
+import os
 import sys
+import glob
+import json
+import hashlib
 import argparse
+import multiprocessing
 import numpy as np
 
 import Bio.PDB
@@ -18,27 +23,67 @@ import Bio.PDB.StructureBuilder
 try:
     import utilities as utils
     import pdb_utilities as pdb_utils
+    import module_library as mod_lib
+    import kabsch
+    import xdb as xdb_lib
 except ImportError:
     from . import utilities as utils
     from . import pdb_utilities as pdb_utils
+    from . import module_library as mod_lib
+    from . import kabsch
+    from . import xdb as xdb_lib
 
 
 def parse_args(args):
     desc = ('Create CIF atom model from design solution JSON exported '
             'by elfin-ui.')
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument('input_file')
+    parser.add_argument('input_file',
+                        help='Design JSON file. For batch stitching, a '
+                        'directory of design JSONs, a quoted glob pattern, or '
+                        'a .txt manifest listing one design JSON per line.')
     parser.add_argument('-o', '--out_file', default='')
+    parser.add_argument('--out_dir', default='',
+                        help='Output directory for batch stitching. Defaults '
+                        'to next to each design JSON.')
+    add_stitcher_args(parser)
+    parser.add_argument('-w', '--worker_count', default='1',
+                        help='Number of processes to deposit chains with, or '
+                        'cpu_count. When batch stitching, designs are spread '
+                        'over the processes instead.')
+    return parser.parse_args(args)
+
+
+# Adds the arguments create_stitcher() reads to an argparse parser.
+def add_stitcher_args(parser):
     parser.add_argument('-x', '--xdb', default='./resources/xdb.json')
     parser.add_argument('-p', '--pdb_dir', default='./resources/pdb_aligned/')
+    parser.add_argument('-l', '--module_library', default='',
+                        help='Module library file to read aligned modules '
+                        'from instead of the PDBs in pdb_dir.')
     parser.add_argument('-c', '--cappings_dir',
                         default='./resources/pdb_cappings')
     parser.add_argument('-m', '--metadata_dir',
                         default='./resources/metadata/')
-    parser.add_argument('-s', '--show_fusion', action='store_true')
+    parser.add_argument('-s', '--show_fusion', action='store_true',
+                        help='Not implemented yet; has no effect.')
     parser.add_argument('-d', '--disable_capping', action='store_true')
+    parser.add_argument('-b', '--blend', action='store_true',
+                        help='Blend module termini into the doubles and caps '
+                        'they connect to. Off by default because it has been '
+                        'causing residue distortions.')
     parser.add_argument('--skip_unused', action='store_true')
-    return parser.parse_args(args)
+    parser.add_argument('--module_cache_size', type=int, default=64)
+    parser.add_argument('--double_cache_size', type=int, default=256)
+    parser.add_argument('--cache_dir', default='',
+                        help='Directory to keep deposited chains in. When '
+                        'given, re-stitching a design only re-deposits the '
+                        'chains that changed since the last run.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print progress for every chain and node.')
+    parser.add_argument('--stats_file', default='',
+                        help='Write per-phase timings, counters and cache '
+                        'hit rates as JSON to this file, or - for stdout.')
 
 
 def main(test_args=None):
@@ -46,32 +91,171 @@ def main(test_args=None):
 
     input_ext = args.input_file[args.input_file.rfind('.'):].lower()
 
-    if input_ext == '.json':
+    if input_ext == '.json' and not is_batch_input(args.input_file):
         spec = utils.read_json(args.input_file)
-        xdb = utils.read_json(args.xdb)
-
-        struct = Stitcher(
-            spec,
-            xdb,
-            args.pdb_dir,
-            args.cappings_dir,
-            args.metadata_dir,
-            args.show_fusion,
-            args.disable_capping,
-            args.skip_unused
-        ).run()
+        xdb = xdb_lib.XDB.load(args.xdb)
 
         if args.out_file == '':
             args.out_file = args.input_file
         args.out_file = '.'.join(args.out_file.split('.')[:-1] + ['cif'])
 
-        print('Saving to:', args.out_file)
-        pdb_utils.save_cif(struct=struct, path=args.out_file)
+        try:
+            stitcher = create_stitcher(
+                args,
+                xdb,
+                spec,
+                utils.parse_worker_count(args.worker_count)
+            )
+            print('Saving to:', args.out_file)
+            stitcher.write_cif(args.out_file)
+        except ValueError as ve:
+            print('Error:', ve)
+            exit()
+
+        if args.stats_file:
+            write_stats(stitcher, args.stats_file)
+    elif is_batch_input(args.input_file) or input_ext == '.txt':
+        design_files = find_design_files(args.input_file)
+        if not design_files:
+            print('No design files found in \"{}\"'.format(args.input_file))
+            exit()
+
+        # Load the xdb once and share one Stitcher, and therefore its module
+        # caches, across all designs.
+        xdb = xdb_lib.XDB.load(args.xdb)
+        stitcher = create_stitcher(args, xdb)
+
+        failures = stitch_batch(
+            stitcher,
+            design_files,
+            args.out_dir,
+            utils.parse_worker_count(args.worker_count)
+        )
+        if args.stats_file:
+            write_stats(stitcher, args.stats_file)
+        if failures:
+            exit(1)
     else:
         print('Unknown input file type: \"{}\"'.format(input_ext))
         exit()
 
 
+def create_stitcher(args, xdb, spec=None, worker_count=1):
+    return Stitcher(
+        spec,
+        xdb,
+        args.pdb_dir,
+        args.cappings_dir,
+        args.metadata_dir,
+        args.show_fusion,
+        args.disable_capping,
+        args.skip_unused,
+        args.module_cache_size,
+        args.double_cache_size,
+        args.blend,
+        worker_count,
+        args.cache_dir,
+        args.module_library,
+        args.verbose
+    )
+
+
+def is_glob_pattern(path):
+    return any(c in path for c in '*?[')
+
+
+def is_batch_input(input_path):
+    return os.path.isdir(input_path) or is_glob_pattern(input_path)
+
+
+# Returns the sorted design JSON paths named by a directory, a glob pattern or
+# a manifest file listing one path per line. Manifest paths are relative to
+# the manifest.
+def find_design_files(input_path):
+    if os.path.isdir(input_path):
+        return sorted(glob.glob(os.path.join(input_path, '*.json')))
+
+    if is_glob_pattern(input_path):
+        return sorted(glob.glob(input_path))
+
+    manifest_dir = os.path.dirname(input_path)
+    with open(input_path, 'r') as file:
+        lines = (l.strip() for l in file)
+        return [os.path.join(manifest_dir, l) for l in lines
+                if l and not l.startswith('#')]
+
+
+def get_out_path(design_file, out_dir=''):
+    out_file = '.'.join(design_file.split('.')[:-1] + ['cif'])
+    if out_dir:
+        out_file = os.path.join(out_dir, os.path.basename(out_file))
+    return out_file
+
+
+# Writes the Stitcher's stats as JSON to path, or to stdout if path is -.
+def write_stats(stitcher, path):
+    stats = json.dumps(stitcher.get_stats(), indent=4)
+    if path == '-':
+        print(stats)
+    else:
+        with open(path, 'w') as file:
+            file.write(stats)
+
+
+# Stitches one design and saves it as CIF. Returns an error string instead of
+# raising, so that one bad design does not stop a batch.
+def stitch_design(stitcher, design_file, out_file):
+    try:
+        stitcher.write_cif(out_file, utils.read_json(design_file))
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+
+
+# Stitches many designs with one Stitcher, optionally spreading designs over
+# worker_count processes. Returns a list of (design file, error string) for
+# designs that failed.
+def stitch_batch(stitcher, design_files, out_dir='', worker_count=1):
+    if out_dir:
+        utils.make_dir(out_dir)
+
+    jobs = [(f, get_out_path(f, out_dir)) for f in design_files]
+
+    def report(results):
+        failures = []
+        for i, ((design_file, out_file), error) in \
+                enumerate(zip(jobs, results)):
+            if error:
+                print('Failed [{}/{}] {}: {}'.format(
+                    i+1, len(jobs), design_file, error))
+                failures.append((design_file, error))
+            else:
+                print('Stitched [{}/{}] {} -> {}'.format(
+                    i+1, len(jobs), design_file, out_file))
+        return failures
+
+    if worker_count > 1:
+        with multiprocessing.Pool(
+                worker_count,
+                _init_worker,
+                (stitcher,)) as pool:
+            def merge_stats(results):
+                for error, stats in results:
+                    stitcher.stats.merge(stats)
+                    yield error
+
+            failures = report(
+                merge_stats(pool.imap(_stitch_design_task, jobs)))
+    else:
+        failures = report(stitch_design(stitcher, *job) for job in jobs)
+
+    print('Stitched {}/{} designs'.format(
+        len(jobs) - len(failures), len(jobs)))
+    for design_file, error in failures:
+        print('Failed: {}: {}'.format(design_file, error))
+
+    return failures
+
+
 def validate_spec(spec):
     if 'networks' not in spec:
         return 'No networks object in spec.'
@@ -128,43 +312,191 @@ class ChainIdentifier(ChainIdentifierBase):
     def __repr__(self):
         return '{}->{}'.format(self.src, self.dst)
 
+class NetworkIndex(object):
+    """
+    Compiled form of a network JSON object, built once so that walking and
+    decomposing the network only needs constant time lookups per terminus.
+
+    Holds the next linkage of every (ui_name, chain_id, term), the chains of
+    every hub along with their interfaceable termini, and the leaves of the
+    network.
+    """
+    def __init__(self, network, xdb=None):
+        self.network = network
+        self.nodes = {}
+
+        # (ui_name, chain_id, term) -> linkage leaving that terminus in the
+        # direction of the opposite terminus, i.e. the next linkage to follow
+        # when walking a chain that enters the node at term.
+        self.next_linkages = {}
+
+        # ui_name -> [(hub_chain_id, [interfaceable terms])]
+        self.hub_chains = {}
+
+        # ui_name -> [hub_chain_id] of hub chains without any linkage.
+        self.unused_hub_chains = {}
+
+        self.leaves = []
+
+        if xdb is not None:
+            xdb = xdb_lib.as_xdb(xdb)
+
+        try:
+            for ui_name in network:
+                self.add_node(ui_name, xdb)
+        except KeyError as ke:
+            raise ValueError(
+                'Probably bad input format. KeyError: {}'.format(ke))
+
+    def add_node(self, ui_name, xdb):
+        node = get_node(self.network, ui_name)
+        self.nodes[ui_name] = node
+
+        cl = node['c_linkage']
+        nl = node['n_linkage']
+        for term, linkages in (('n', cl), ('c', nl)):
+            for l in linkages:
+                key = (ui_name, l['source_chain_id'], term)
+                assert key not in self.next_linkages, \
+                    'Expected only next_linkages size <= 1 (since' \
+                    'each node has max 2 linkages, one N and one C).'
+                self.next_linkages[key] = l
+
+        if xdb is None:
+            return
+
+        # A leaf is a terminus that is either unoccupied or on a hub node.
+        mod_type = node['module_type']
+        mod_name = node['module_name']
+        chains = xdb.mod_chains[xdb.find_module(mod_type, mod_name)]
+
+        if mod_type == 'hub':
+            linked_chains = {l['source_chain_id'] for l in cl} | \
+                {l['source_chain_id'] for l in nl}
+            hub_chains = []
+            for chain in chains:
+                c = xdb.chain_ids[chain]
+                if xdb.has_links(chain, 'n'):
+                    self.leaves.append(TermIdentifier(ui_name, c, 'c'))
+                if xdb.has_links(chain, 'c'):
+                    self.leaves.append(TermIdentifier(ui_name, c, 'n'))
+                hub_chains.append(
+                    (c, [t for t in utils.TERM_TYPES
+                         if xdb.has_links(chain, t)]))
+            self.hub_chains[ui_name] = hub_chains
+            self.unused_hub_chains[ui_name] = \
+                [xdb.chain_ids[chain] for chain in chains
+                 if xdb.chain_ids[chain] not in linked_chains]
+        else:  # Guaranteed to be 'single' thanks to get_node()
+            if not nl:
+                self.leaves.append(TermIdentifier(
+                    ui_name, cl[0]['source_chain_id'], 'n'))
+            if not cl:
+                self.leaves.append(TermIdentifier(
+                    ui_name, nl[0]['source_chain_id'], 'c'))
+
+    # Walks the a chain starting with the src TermIdentifier, yielding each
+    # TermIdentifier and next_linkage on the fly.
+    def walk_chain(self, src):
+        ui_name, chain_id, term = src
+        next_linkages = self.next_linkages
+
+        while True:
+            # Advance until either a hub or a single with dangling terminus is
+            # encountered.
+            term_iden = TermIdentifier(ui_name, chain_id, term)
+            next_linkage = next_linkages.get((ui_name, chain_id, term))
+            yield term_iden, next_linkage
+
+            if not next_linkage:
+                break
+
+            ui_name, chain_id = \
+                next_linkage['target_mod'], \
+                next_linkage['target_chain_id']
+
+    # Walks the network and returns a generator of ChainIdentifiers.
+    #
+    # This method guarantees that src->dst is in the direction of N->C. Each
+    # terminus is walked over once, so this runs in linear time in the size
+    # of the network.
+    def decompose(self, skip_unused=False):
+        src_q = deque()
+        visited = set()
+        skipped = set()
+
+        # Find entry node to begin walking the network with.
+        assert self.leaves, 'No leave nodes for network.'
+
+        src_q.extend(self.leaves)
+
+        while src_q:
+            src = src_q.popleft()
+            if src in visited:
+                # This could happen when termini identifiers on hubs are added
+                # before the termini on the other end of those chains are
+                # popped out of the queue.
+                continue
+
+            visited.add(src)
+
+            for term_iden, next_linkage in self.walk_chain(src):
+                ui_name, chain_id, term = term_iden
+                hub_chains = self.hub_chains.get(ui_name)
+
+                if not next_linkage:
+                    dst = TermIdentifier(
+                        ui_name, chain_id, utils.opposite_term(term))
+                    if dst not in visited:
+                        visited.add(dst)
+
+                        srcdst = (src, dst) if term == 'n' else (dst, src)
+                        yield ChainIdentifier(*srcdst)
+
+                        if hub_chains is not None:
+                            # Add unvisited components as new chain sources.
+                            for hub_chain_id, terms in hub_chains:
+                                for t in terms:
+                                    iden = TermIdentifier(
+                                        ui_name, hub_chain_id, t)
+                                    if iden not in visited:
+                                        src_q.append(iden)
+                    break
+
+                if hub_chains is not None:
+                    # This is a "bypass" hub, i.e. the current hub component
+                    # has interfaceable N and C terms, and the current chain
+                    # goes through it without ending here.
+                    #
+                    # In this case, check for unused components that might not
+                    # need to be placed since they aren't leaves nor connect
+                    # to any leaf nodes. Each is only placed once even if
+                    # several chains bypass the same hub or it is a leaf too.
+                    for hub_chain_id in self.unused_hub_chains[ui_name]:
+                        srcdst = (
+                            TermIdentifier(ui_name, hub_chain_id, 'n'),
+                            TermIdentifier(ui_name, hub_chain_id, 'c')
+                        )
+                        if hub_chain_id == chain_id or \
+                                srcdst[0] in visited or \
+                                srcdst in skipped:
+                            continue
+
+                        if skip_unused:
+                            skipped.add(srcdst)
+                            print('Skipping unused hub component:',
+                                  ui_name, hub_chain_id)
+                        else:
+                            visited.update(srcdst)
+                            yield ChainIdentifier(*srcdst)
+
 # Returns a list of all leaf TermIdentifiers.
 #
 # A leaf is a terminus that is either unoccupied or on a hub node.
 
 
 def find_leaves(network, xdb):
-    try:
-        res = []
-
-        for ui_name in network:
-            node = get_node(network, ui_name)
-
-            mod_type = node['module_type']
-            mod_name = node['module_name']
-            chains = xdb['modules'][mod_type + 's'][mod_name]['chains']
-            cl = node['c_linkage']
-            nl = node['n_linkage']
-
-            if mod_type == 'hub':
-                for c in chains:
-                    if chains[c]['n']:
-                        res.append(TermIdentifier(ui_name, c, 'c'))
-                    if chains[c]['c']:
-                        res.append(TermIdentifier(ui_name, c, 'n'))
-            else:  # Guaranteed to be 'single' thanks to get_node()
-                if not nl:
-                    res.append(TermIdentifier(
-                        ui_name, cl[0]['source_chain_id'], 'n'))
-                if not cl:
-                    res.append(TermIdentifier(
-                        ui_name, nl[0]['source_chain_id'], 'c'))
-
-        return res
-    except KeyError as ke:
-        print('KeyError:', ke)
-        print('Probably bad input format.')
-        exit()
+    return NetworkIndex(network, xdb).leaves
 
 # Walks the a chain starting with the src TermIdentifier, according to the
 # network JSON object, yielding each TermIdentifier and next_linkage on the
@@ -172,172 +504,217 @@ def find_leaves(network, xdb):
 
 
 def walk_chain(network, src):
-    ui_name, chain_id, term = src
+    return NetworkIndex(network).walk_chain(src)
 
-    while True:
-        node = get_node(network, ui_name)
+# Walks the network and returns a generator of ChainIdentifiers.
+#
+# This method guarantees that src->dst is in the direction of N->C.
 
-        # Advance until either a hub or a single with dangling terminus is
-        # encountered.
-        next_linkages = [
-            l for l in node[utils.opposite_term(term) + '_linkage']
-            if l['source_chain_id'] == chain_id
-        ]
 
-        assert len(next_linkages) <= 1, \
-            'Expected only next_linkages size <= 1 (since' \
-            'each node has max 2 linkages, one N and one C).'
+def decompose_network(network, xdb, skip_unused=False):
+    return NetworkIndex(network, xdb).decompose(skip_unused)
 
-        term_iden = TermIdentifier(ui_name, chain_id, term)
-        next_linkage = next_linkages[0] if next_linkages else None
-        yield term_iden, next_linkage
 
-        if not next_linkage:
-            break
+# chain is the XDB index of the module chain res belongs to.
+ModInfo = namedtuple(
+    'ModInfo', ['mod_type', 'mod_name', 'res', 'res_n', 'chain'])
 
-        ui_name, chain_id = \
-            next_linkage['target_mod'], \
-            next_linkage['target_chain_id']
 
-# Walks the network and returns a generator of ChainIdentifiers.
-#
-# This method guarantees that src->dst is in the direction of N->C.
+BlendPlan = namedtuple(
+    'BlendPlan', ['keep', 'res_starts', 'moving_idx', 'fixed_idx', 'weights'])
 
 
-def decompose_network(network, xdb, skip_unused=False):
-    src_q = deque()
-    visited = set()
+# Precomputes how to blend residue blocks M = (1-w)M + wF, where M is an atom
+# coordinate in moving_res, F is the coordinate of the same atom in the
+# matching residue of fixed_res, and w is the corresponding per-residue weight
+# in weights.
+#
+# A plan only depends on the atom and residue names of the two blocks, so it
+# can be computed once per junction type and applied to every junction of
+# that type with apply_blend().
+#
+# Dirty atoms are removed. They seem to crop up in the process of optimizing
+# PDBs even if preprocess.py already removed them once. Atoms not in the fixed
+# residue are also removed - this is only known to happen to CYS (HG) and HIS
+# (HE1/HE2). If residues are not the same (name), only backbone atoms are
+# blended.
+def plan_blend(moving_res, fixed_res, weights):
+    assert moving_res.n_residues == fixed_res.n_residues
+    assert moving_res.n_residues == len(weights)
+
+    m_res_idx = moving_res.residue_index()
+    m_names = moving_res.atoms['name']
+
+    f_lookup = {
+        key: j for j, key in enumerate(zip(
+            fixed_res.residue_index().tolist(),
+            fixed_res.atoms['name'].tolist()))
+    }
+    fixed_idx = np.array(
+        [f_lookup.get(key, -1)
+         for key in zip(m_res_idx.tolist(), m_names.tolist())],
+        dtype=int)
+
+    m_resnames = moving_res.atoms['resname'][moving_res.res_starts[:-1]]
+    f_resnames = fixed_res.atoms['resname'][fixed_res.res_starts[:-1]]
+    same_res = (m_resnames == f_resnames)[m_res_idx]
+
+    dirty = np.isin(m_names, list(pdb_utils.DIRTY_ATOMS))
+    absent = fixed_idx < 0
+
+    # Complain about absent atoms
+    for j in np.flatnonzero(same_res & absent & ~dirty):
+        print(m_names[j], 'not in', moving_res.atoms['resname'][j])
+
+    keep = ~dirty & ~absent
+
+    # Identical residues should have the same atom positions. Only modify
+    # backbone atoms otherwise.
+    blended = keep & \
+        (same_res | np.isin(m_names, list(pdb_utils.BACKBONE_NAMES)))
+
+    res_sizes = np.bincount(m_res_idx[keep], minlength=moving_res.n_residues)
+    return BlendPlan(
+        keep,
+        np.concatenate(([0], np.cumsum(res_sizes))),
+        np.flatnonzero(blended),
+        fixed_idx[blended],
+        np.asarray(weights, dtype='float64')[m_res_idx[blended]][:, None]
+    )
+
+
+# Blends moving_res into fixed_res according to a plan from plan_blend(), as
+# a single array operation over all blended atoms. Returns the blended moving
+# residues as a new AtomBlock.
+def apply_blend(plan, moving_res, fixed_res):
+    coord = moving_res.coord.copy()
+    w = plan.weights
+    coord[plan.moving_idx] = \
+        (1-w)*coord[plan.moving_idx] + w*fixed_res.coord[plan.fixed_idx]
+
+    return pdb_utils.AtomBlock(
+        moving_res.atoms[plan.keep],
+        coord[plan.keep],
+        plan.res_starts.copy())
 
-    # Find entry node to begin walking the network with.
-    leaves = find_leaves(network, xdb)
-    assert leaves, 'No leave nodes for network.'
 
-    src_q.extend(leaves)
+def blend_residues(moving_res, fixed_res, weights):
+    plan = plan_blend(moving_res, fixed_res, weights)
+    return apply_blend(plan, moving_res, fixed_res)
 
-    while src_q:
-        src = src_q.popleft()
-        if src in visited:
-            # This could happen when termini identifiers on hubs are added
-            # before the termini on the other end of those chains are popped
-            # out of the queue.
-            continue
 
-        visited.add(src)
-        mod_type = None
+CapInfo = namedtuple('CapInfo', ['cap_name', 'res', 'align_res'])
 
-        chain_walker = walk_chain(network, src)
-        for term_iden, next_linkage in chain_walker:
-            ui_name, chain_id, term = term_iden
-            node = get_node(network, ui_name)
-            mod_type = node['module_type']
 
-            if not next_linkage:
-                dst = TermIdentifier(
-                    ui_name, chain_id, utils.opposite_term(term))
-                if dst not in visited:
-                    visited.add(dst)
-
-                    srcdst = (src, dst) if term == 'n' else (dst, src)
-                    chain_iden = ChainIdentifier(*srcdst)
-
-                    yield chain_iden
-
-                    if mod_type == 'hub':
-                        # Add unvisited components as new chain sources.
-                        hub = xdb['modules']['hubs'][node['module_name']]
-                        for hub_chain_id in hub['chains']:
-                            hub_chain = hub['chains'][hub_chain_id]
-                            for term in utils.TERM_TYPES:
-                                if hub_chain[term]:  # If not dormant.
-                                    iden = (ui_name, hub_chain_id, term)
-                                    if iden not in visited:
-                                        src_q.append(iden)
-                break
+class CappingIndex:
+    """
+    Capping residues of module termini, pre-expressed in each module's own
+    frame.
 
-            if mod_type == 'hub':
-                # This is a "bypass" hub, i.e. the current hub component has
-                # interfaceable N and C terms, and the current chain goes
-                # through it without ending here.
-                #
-                # In this case, check for unused components that might not
-                # need to be placed since they aren't leaves nor connect to
-                # any leaf nodes.
-                hub = xdb['modules']['hubs'][node['module_name']]
-                for hub_chain_id in hub['chains']:
-                    if hub_chain_id == chain_id:
-                        continue
-                    c_links = len([l for l in node['c_linkage']
-                                   if l['source_chain_id'] == hub_chain_id])
-                    n_links = len([l for l in node['n_linkage']
-                                   if l['source_chain_id'] == hub_chain_id])
-
-                    if c_links == n_links == 0:
-                        if skip_unused:
-                            print('Skipping unused hub component:',
-                                  ui_name, hub_chain_id)
-                        else:
-                            srcdst = (
-                                TermIdentifier(ui_name, hub_chain_id, 'n'),
-                                TermIdentifier(ui_name, hub_chain_id, 'c')
-                            )
-                            yield ChainIdentifier(*srcdst)
+    The cap-to-module relationship is fixed for a given module library, so
+    each cap PDB is read once and each module terminus is aligned to its cap
+    once. Entries are shared and must not be modified in place.
+    """
+    def __init__(self, xdb, cappings_dir, metadata_dir):
+        self.xdb = xdb
+        self.cr_dir = cappings_dir
+        self.cap_pdb_res = {}
+        self.entries = {}
 
+        # Parse capping repeat indicies into inclusive residue ID ranges of
+        # the repeat part of each cap PDB, keyed by cap name then term.
+        self.repeat_ranges = {}
+        meta_csv = utils.read_csv(
+            metadata_dir + '/repeat_indicies.csv', delim=' ')
+        for row in meta_csv:
+            cap_name = row[0].split('.')[0].replace('DHR', 'D')
+            r_ids = [int(idx) for idx in row[1:]]
+            self.repeat_ranges[cap_name] = {
+                'n': tuple(r_ids[:2]),
+                'c': tuple(r_ids[2:])
+            }
+
+    # Returns the name of the cap for a module terminus, or None if the
+    # terminus should not be capped.
+    def get_cap_name(self, mod_info, term):
+        if mod_info.mod_type == 'single':
+            return mod_info.mod_name.split('_')[0 if term == 'n' else -1]
+
+        # If we were to cap hubs, we need to first check whether the term is
+        # an open terminus in this hub.
+        if not self.xdb.has_links(mod_info.chain, term):
+            return None
+        return self.xdb.chain_single_names[mod_info.chain]
+
+    # Returns the path of the PDB of a cap.
+    def get_cap_pdb_path(self, cap_name, term):
+        return '{}/{}_{}.pdb'.format(self.cr_dir, cap_name,
+                                     'NI' if term == 'n' else 'IC')
+
+    # Returns the residues of a cap PDB, reading it only once.
+    def get_cap_pdb_res(self, cap_name, term):
+        key = (cap_name, term)
+        if key not in self.cap_pdb_res:
+            self.cap_pdb_res[key] = pdb_utils.AtomBlock.concatenate(
+                pdb_utils.read_pdb_blocks(
+                    self.get_cap_pdb_path(cap_name, term)).values())
+        return self.cap_pdb_res[key]
+
+    # Returns the CapInfo of a module terminus, or None if the terminus
+    # should not be capped. mod_info residues must be in the module's own
+    # frame.
+    def get(self, mod_info, term):
+        utils.check_term_type(term)
 
-ModInfo = namedtuple('ModInfo', ['mod_type', 'mod_name', 'res', 'res_n'])
+        key = (mod_info.chain, term)
+        if key not in self.entries:
+            cap_name = self.get_cap_name(mod_info, term)
+            self.entries[key] = None if cap_name is None else \
+                self.align_cap(cap_name, mod_info.res, term)
+        return self.entries[key]
 
+    # Aligns the repeat part of a cap PDB to the terminal residues of
+    # prime_res, and returns the cap residues in the frame of prime_res.
+    def align_cap(self, cap_name, prime_res, term):
+        cap_res = self.get_cap_pdb_res(cap_name, term)
 
-def transform_residues(res, rot, tran):
-    for r in res:
-        for a in r:
-            # Do the transform manually because BioPython has non
-            # standard multiplication order.
-            a.coord = rot.dot(a.coord) + tran
+        # Find residue index at which the residue id[1] matches capping
+        # start index. Residue id often does not start from 1 and is never
+        # 0-based.
+        rid_range = self.repeat_ranges[cap_name][term]
 
-# Blend residue lists M = (1-w)M + wF, where M is an atom coordinate in
-# moving_res, F is an atom coordinate in fixed_res, and w is the corresponding
-# weight in weights.
-#
-# Also removes dirty atoms. If residues are not the same (name), only backbone
-# atoms are blended.
+        matches = np.flatnonzero(cap_res.residue_ids() == rid_range[0])
+        if not len(matches):
+            raise ValueError('Could not find residue index {}'.format(
+                rid_range[0]))
+        match_start = matches[0]
 
+        match_len = rid_range[1] - rid_range[0] + 1  # Inclusive
+        match_end = match_start + match_len
 
-def blend_residues(moving_res, fixed_res, weights):
-    # temporarily disable blending because it's causing horrible
-    # residue distortions
-    return
-    assert len(moving_res) == len(fixed_res)
-    assert len(moving_res) == len(weights)
-
-    for m, f, w in zip(moving_res, fixed_res, weights):
-        # Remove dirty atoms. They seem to crop up in the process of
-        # optimizing PDBs even if preprocess.py already removed them once.
-        #
-        # Also remove atoms not in fixed residue - this is only known to
-        # happen to CYS (HG) and HIS (HE1/HE2).
-
-        if m.resname == f.resname:
-            # Complain about absent atoms
-            for a in m:
-                if a.name not in pdb_utils.DIRTY_ATOMS and a.name not in f:
-                    print(a.name, 'not in', f.resname)
-
-        to_remove = [a for a in m if a.name in
-                     pdb_utils.DIRTY_ATOMS or a.name not in f]
-        for da in to_remove:
-            m.detach_child(da.name)
-
-        # Compute new position based on combination of two positions.
-        def compute_coord(a, b): return (1-w)*a.coord + w*b.coord
-        for ma in m:
-            if m.resname == f.resname:
-                # Identical residues should have the same atom positions
-                assert ma.name in f
-                ma.coord = compute_coord(ma, f[ma.name])
-            else:
-                # Only modify backbone atoms.
-                if ma.name in pdb_utils.BACKBONE_NAMES and \
-                        ma.name in f:
-                    ma.coord = compute_coord(ma, f[ma.name])
+        # N: match left, C: match right
+        prime_align_res = prime_res.residues(None, match_len) \
+            if term == 'n' else \
+            prime_res.residues(-match_len)
+        cap_align_res = cap_res.residues(match_start, match_end)
+
+        rot, tran, _ = kabsch.superimpose(
+            prime_align_res.ca_coord(), cap_align_res.ca_coord())
+
+        def moved(residues):
+            # Rotation in BioPython is inversed.
+            residues = residues.copy()
+            residues.transform(np.transpose(rot), tran)
+            return residues
+
+        return CapInfo(
+            cap_name,
+            moved(pdb_utils.AtomBlock.concatenate([
+                cap_res.residues(None, match_start),
+                cap_res.residues(match_end)
+            ])),
+            moved(cap_align_res)
+        )
 
 
 class Stitcher:
@@ -351,60 +728,114 @@ class Stitcher:
         show_fusion=False,
         disable_capping=False,
         skip_unused=False,
+        module_cache_size=64,
+        double_cache_size=256,
+        blend=False,
+        worker_count=1,
+        cache_dir='',
+        module_library='',
+        verbose=False,
     ):
-        spec_complaint = validate_spec(spec)
-        if spec_complaint:
-            print('Error:', spec_complaint)
-            exit()
+        if spec is not None:
+            self.set_spec(spec)
 
-        self.spec = spec
-        self.xdb = xdb
+        self.xdb = xdb_lib.as_xdb(xdb)
         self.pdb_dir = pdb_dir
-        self.cr_dir = cappings_dir
+        self.module_library = \
+            mod_lib.ModuleLibrary(module_library) if module_library else None
         self.show_fusion = show_fusion
+        if show_fusion:
+            # Warn regardless of verbosity, as the option does nothing yet.
+            print('Warning: show_fusion is not implemented and has no effect')
         self.disable_capping = disable_capping
         self.skip_unused = skip_unused
-        self.si = Bio.PDB.Superimposer()
+        self.blend = blend
+        self.worker_count = worker_count
+        self.verbose = verbose
         self.chain_id = 0
 
-        # Parse and convert capping repeat indicies into a dictionary
-        self.capping_repeat_idx = {}
-        meta_csv = utils.read_csv(
-            metadata_dir + '/repeat_indicies.csv', delim=' ')
-        for row in meta_csv:
-            mod_name = row[0].split('.')[0].replace('DHR', 'D')
-            self.capping_repeat_idx[mod_name] = \
-                [int(idx) for idx in row[1:]]
+        # Phase timings, counters and cache hit counts.
+        self.stats = utils.RunStats()
+
+        # Parsed module residues keyed by (module type, module name). Entries
+        # are shared, so callers must copy residues before modifying them.
+        self.module_cache = utils.LRUCache(module_cache_size)
+
+        # Parsed double residues keyed by double name, and the composed
+        # drop/lift transforms for each kind of junction.
+        self.double_cache = utils.LRUCache(double_cache_size)
+        self.double_txs = {}
+
+        # BlendPlans keyed by junction type.
+        self.blend_plans = {}
+
+        self.capping_index = \
+            CappingIndex(self.xdb, cappings_dir, metadata_dir)
+
+        # Deposited chains keyed by chain fingerprint, on disk. Fingerprints
+        # include the size and mtime of the files a chain is read from, so
+        # that chains are deposited again when dbgen.py or preprocess.py
+        # regenerate them in place.
+        self.cache_dir = cache_dir
+        self.file_stamps = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_salt = json.dumps([
+                self.xdb.fingerprint(),
+                os.path.abspath(module_library or pdb_dir),
+                self.get_file_stamp(module_library) if module_library else None,
+                os.path.abspath(cappings_dir),
+                self.get_file_stamp(metadata_dir + '/repeat_indicies.csv'),
+                blend,
+                disable_capping
+            ])
+
+    def set_spec(self, spec):
+        spec_complaint = validate_spec(spec)
+        if spec_complaint:
+            raise ValueError(spec_complaint)
+
+        self.spec = spec
+        self.network_indices = {}
+
+    # Deposits the modules of a chain and returns them as one AtomBlock.
+    # Residue IDs are assigned later by number_chain(), so that chains can be
+    # deposited independently of each other.
+    def deposit_chain(self, net_index, chain_iden):
+        with self.stats.phase('deposit_chain'):
+            return self._deposit_chain(net_index, chain_iden)
 
-    def deposit_chain(self, network, chain_iden):
+    def _deposit_chain(self, net_index, chain_iden):
         # n -src-> c ... n -dst-> c
-        print('Deposit chain:', chain_iden)
+        self.log('Deposit chain:', chain_iden)
 
         src, dst = chain_iden
-        atom_chain = self.new_chain()
+        node_blocks = []
 
         # Build context to pass to subroutines.
         def context(): return 0
-        context.atom_chain = atom_chain
-        context.network = network
+        context.network = net_index.network
         context.last_node = None
 
-        chain_walker = walk_chain(network, src)
+        chain_walker = net_index.walk_chain(src)
         for term_iden, next_linkage in chain_walker:
             context.term_iden = term_iden
             context.next_linkage = next_linkage
 
-            print('Deposit {}->{}'.format(repr(term_iden),
-                                          next_linkage['target_mod']
-                                          if next_linkage else None))
+            self.log('Deposit {}->{}'.format(repr(term_iden),
+                                             next_linkage['target_mod']
+                                             if next_linkage else None))
+            self.stats.count('nodes')
 
-            context.node = get_node(network, term_iden.ui_name)
+            context.node = get_node(net_index.network, term_iden.ui_name)
             context.mod_info = self.get_mod_info(
                 context.node, term_iden.chain_id)
 
-            context.pref_res = []
-            context.main_res = [r.copy() for r in context.mod_info.res]
-            context.suff_res = []
+            context.pref_res = pdb_utils.AtomBlock.empty()
+            # Copy because mod_info residues are shared through the module
+            # cache.
+            context.main_res = context.mod_info.res.copy()
+            context.suff_res = pdb_utils.AtomBlock.empty()
 
             if context.last_node:
                 # Midway through the chain - always displace N term.
@@ -420,130 +851,199 @@ class Stitcher:
                 # There's no next node - cap C term.
                 self.cap_terminus(context, 'c')
 
-            all_res = context.pref_res + context.main_res + context.suff_res
-            for r in all_res:
-                r.id = (r.id[0], self.next_residue_id(), r.id[2])
-                rot = np.transpose(np.asarray(context.node['rot']))
-                r.transform(rot, context.node['tran'])
-                atom_chain.add(r)
-
-            if self.show_fusion:
-                # curr_chain = Bio.PDB.Chain.Chain(chain_id)
-                # chains.append(curr_chain)
-                print('TODO: show_fusion')
+            # Place the whole node with one batched transform.
+            with self.stats.phase('transform'):
+                node_block = pdb_utils.AtomBlock.concatenate([
+                    context.pref_res, context.main_res, context.suff_res])
+                node_block.transform(
+                    np.asarray(context.node['rot']),
+                    np.asarray(context.node['tran']))
+            node_blocks.append(node_block)
 
             context.last_node = context.node
             context.last_term_iden = term_iden
 
-        print('')
-        self.model.add(atom_chain)
+        self.log('')
+        return pdb_utils.AtomBlock.concatenate(node_blocks)
+
+    # Fingerprints everything that deposit_chain() output depends on: the
+    # xdb, stitching options, and the module, chain, transform and next
+    # linkage of every node along the chain, along with the stamps of the
+    # module, double and cap PDBs it reads. Node names are left out so that
+    # renaming nodes does not invalidate cached chains.
+    def get_chain_fingerprint(self, net_index, chain_iden):
+        h = hashlib.sha1(self.cache_salt.encode())
+        first = True
+        for term_iden, next_linkage in net_index.walk_chain(chain_iden.src):
+            node = net_index.nodes[term_iden.ui_name]
+            mod_type = node['module_type']
+            mod_name = node['module_name']
+            chain = self.xdb.find_chain(mod_name, term_iden.chain_id)
+            key = [
+                mod_type,
+                mod_name,
+                term_iden.chain_id,
+                term_iden.term,
+                node['rot'],
+                node['tran'],
+                self.get_module_stamp(mod_type, mod_name)
+            ]
+            if first:
+                key.append(self.get_cap_stamp(mod_type, mod_name, chain, 'n'))
+                first = False
+            if next_linkage:
+                next_node = net_index.network[next_linkage['target_mod']]
+                key += [next_node['module_name'],
+                        next_linkage['target_chain_id']]
+                if self.blend:
+                    next_chain = self.xdb.find_chain(
+                        next_node['module_name'],
+                        next_linkage['target_chain_id'])
+                    key.append(self.get_module_stamp(
+                        'double',
+                        self.xdb.chain_single_names[chain] + '-' +
+                        self.xdb.chain_single_names[next_chain]))
+            else:
+                key.append(self.get_cap_stamp(mod_type, mod_name, chain, 'c'))
+            h.update(json.dumps(key).encode())
+        return h.hexdigest()
+
+    # Returns [size, mtime] of a file, or None if it cannot be read. Each file
+    # is stamped once, as each module is parsed once.
+    def get_file_stamp(self, path):
+        if path not in self.file_stamps:
+            try:
+                stat = os.stat(path)
+                self.file_stamps[path] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                self.file_stamps[path] = None
+        return self.file_stamps[path]
+
+    # Returns the stamp of the PDB a module is read from, or None if it is
+    # read from the module library, whose stamp is in the cache salt.
+    def get_module_stamp(self, mod_type, mod_name):
+        if self.module_library is not None:
+            return None
+        return self.get_file_stamp(self.get_module_path(mod_type, mod_name))
+
+    # Returns the stamp of the cap PDB of a module terminus, or None if the
+    # terminus is not capped.
+    def get_cap_stamp(self, mod_type, mod_name, chain, term):
+        if self.disable_capping:
+            return None
+        cap_name = self.capping_index.get_cap_name(
+            ModInfo(mod_type, mod_name, None, None, chain), term)
+        if cap_name is None:
+            return None
+        return self.get_file_stamp(
+            self.capping_index.get_cap_pdb_path(cap_name, term))
+
+    # Returns the deposited chain from the chain cache if its fingerprint is
+    # unchanged, otherwise deposits it and caches it.
+    def get_chain_block(self, net_index, chain_iden):
+        if not self.cache_dir:
+            return self.deposit_chain(net_index, chain_iden)
+
+        path = os.path.join(
+            self.cache_dir,
+            self.get_chain_fingerprint(net_index, chain_iden) + '.npz')
+        if os.path.isfile(path):
+            try:
+                with self.stats.phase('read_chain_cache'):
+                    chain_block = pdb_utils.AtomBlock.load_npz(path)
+                self.log('Reuse cached chain:', chain_iden)
+                self.stats.count_cache('chain', 1, 0)
+                return chain_block
+            except (OSError, ValueError, KeyError) as e:
+                print('Warning: ignoring bad cached chain {}: {}'.format(
+                    path, e))
+
+        self.stats.count_cache('chain', 0, 1)
+        chain_block = self.deposit_chain(net_index, chain_iden)
+        with self.stats.phase('write_chain_cache'):
+            chain_block.save_npz(path)
+        return chain_block
+
+    # Numbers the residues of a deposited chain and returns it along with a
+    # new chain ID.
+    def number_chain(self, chain_block):
+        self.stats.count('chains')
+        self.stats.count('residues', chain_block.n_residues)
+        self.stats.count('atoms', len(chain_block))
+        chain_block.renumber(self.next_residue_id(chain_block.n_residues))
+        return self.next_chain_id(), chain_block
 
     def cap_terminus(self, deposit_context, term):
+        with self.stats.phase('cap_terminus'):
+            self._cap_terminus(deposit_context, term)
+
+    def _cap_terminus(self, deposit_context, term):
         utils.check_term_type(term)
 
         if self.disable_capping:
-            print('Capping disabled')
+            self.log('Capping disabled')
             return
 
         # Unpack context.
         mod_info = deposit_context.mod_info
         residues = deposit_context.main_res
-        chain_id = deposit_context.term_iden.chain_id
-
-        if mod_info.mod_type == 'single':
-            cap_name = mod_info.mod_name.split('_')[0 if term == 'n' else -1]
-        elif mod_info.mod_type == 'hub':
-            # If we were to cap hubs, we need to first check whether N
-            # term is an open terminus in this hub.
-            hub = self.xdb['modules']['hubs'][mod_info.mod_name]
-            chain = hub['chains'][chain_id]
-            cap_name = chain['single_name']
-
-            if chain[term]:
-                # Continue to capping as usual.
-                pass
-            else:
-                # No need to cap a hub component term that is a
-                # closed interface.
-                return
 
-        print('Capping {}({})'.format(term, cap_name))
-
-        pdb_path = '{}/{}_{}.pdb'.format(self.cr_dir, cap_name,
-                                         'NI' if term == 'n' else 'IC')
-        cap_and_repeat = pdb_utils.read_pdb(pdb_path)
+        cap = self.capping_index.get(mod_info, term)
+        if cap is None:
+            # No need to cap a hub component term that is a closed
+            # interface.
+            return
 
-        cap_res = self.get_capping(
-            prime_res=residues,
-            cap_res=pdb_utils.get_residues(cap_and_repeat),
-            cr_r_ids=self.capping_repeat_idx[cap_name],
-            term=term
-        )
+        self.log('Capping {}({})'.format(term, cap.cap_name))
+        self.stats.count('caps')
 
+        # Copy because cap residues are shared through the capping index.
         if term == 'n':
-            deposit_context.pref_res = cap_res
-        else:
-            deposit_context.suff_res = cap_res
-
-    # Computes the capping residues. Displaces primary residues (thus modifies
-    # the prime_res parameter).
-    def get_capping(self, prime_res, cap_res, cr_r_ids, term):
-        utils.check_term_type(term)
-
-        # Find residue index at which the residue id[1] matches capping
-        # start index. Residue id often does not start from 1 and is never
-        # 0-based.
-        rid_range = tuple(cr_r_ids[:2]) if term == 'n' else tuple(cr_r_ids[2:])
-
-        for i, el in enumerate(cap_res):
-            if el.id[1] == rid_range[0]:
-                match_start = i
-                break
+            deposit_context.pref_res = cap.res.copy()
         else:
-            raise ValueError('Could not find residue index {}'.format(
-                rid_range[0]))
-
-        match_len = rid_range[1] - rid_range[0] + 1  # Inclusive
-        match_end = match_start + match_len
-
-        # N: match left, C: match right
-        prime_align_res = prime_res[:match_len] \
-            if term == 'n' else \
-            prime_res[-match_len:]
-        cap_align_res = cap_res[match_start:match_end]
-
-        prim_atoms = [r['CA'] for r in prime_align_res]
-        cap_atoms = [r['CA'] for r in cap_align_res]
-
-        self.si.set_atoms(prim_atoms, cap_atoms)
-        rot, tran = self.si.rotran
-
-        result = []
-        cap_protrude_res = cap_res[:match_start] + cap_res[match_end:]
-        for r in cap_protrude_res:
-            rr = r.copy()
-            rr.transform(rot, tran)
-            result.append(rr)
+            deposit_context.suff_res = cap.res.copy()
 
-        # Also transform cap align res to the right frame.
-        for r in cap_align_res:
-            r.transform(rot, tran)
+        if not self.blend:
+            return
 
-        # Displace prime_res using linear weights, the same method as
+        # Displace prime residues using linear weights, the same method as
         # displace_terminus().
+        match_len = cap.align_res.n_residues
 
         # Linear weights (0, 1] - default for 'c'.
         disp_w = [i/match_len for i in range(1, match_len + 1)]
-        if term == 'n':
-            disp_w.reverse()  # Want [1, 0) for N term.
 
-        blend_residues(prime_align_res, cap_align_res, disp_w)
+        plan_key = ('cap', mod_info.chain, term)
 
-        return result
+        # N: match left, C: match right
+        if term == 'n':
+            disp_w.reverse()  # Want [1, 0) for N term.
+            deposit_context.main_res = pdb_utils.AtomBlock.concatenate([
+                self.blend_residues(plan_key,
+                                    residues.residues(None, match_len),
+                                    cap.align_res, disp_w),
+                residues.residues(match_len)
+            ])
+        else:
+            deposit_context.main_res = pdb_utils.AtomBlock.concatenate([
+                residues.residues(None, -match_len),
+                self.blend_residues(plan_key,
+                                    residues.residues(-match_len),
+                                    cap.align_res, disp_w)
+            ])
 
     def displace_terminus(self, deposit_context, term):
         utils.check_term_type(term)
 
+        if not self.blend:
+            # Displacement only changes blended residues.
+            return
+
+        with self.stats.phase('displace_terminus'):
+            self._displace_terminus(deposit_context, term)
+        self.stats.count('displacements')
+
+    def _displace_terminus(self, deposit_context, term):
         if term == 'n':
             assert deposit_context.last_node
 
@@ -553,8 +1053,6 @@ class Stitcher:
             a_chain_id = deposit_context.last_term_iden.chain_id
             a_info = self.get_mod_info(a_node, a_chain_id)
 
-            b_node = deposit_context.node
-            b_chain_id = deposit_context.term_iden.chain_id
             b_info = deposit_context.mod_info
 
         elif term == 'c':
@@ -562,8 +1060,6 @@ class Stitcher:
             assert next_linkage
 
             # Node A is on the N end, so we get the C end node.
-            a_node = deposit_context.node
-            a_chain_id = deposit_context.term_iden.chain_id
             a_info = deposit_context.mod_info
 
             b_ui_name, b_chain_id = next_linkage['target_mod'], \
@@ -572,29 +1068,20 @@ class Stitcher:
             b_info = self.get_mod_info(b_node, b_chain_id)
 
         types = (a_info.mod_type, b_info.mod_type)
-        if types == ('single', 'single'):
-            a_single_name = a_info.mod_name
-            b_single_name = b_info.mod_name
-
-        elif types == ('hub', 'single'):
-            hub = self.xdb['modules']['hubs'][a_info.mod_name]
-            a_single_name = hub['chains'][a_chain_id]['single_name']
-            b_single_name = b_info.mod_name
-
-        elif types == ('single', 'hub'):
-            a_single_name = a_info.mod_name
-            hub = self.xdb['modules']['hubs'][b_info.mod_name]
-            b_single_name = hub['chains'][b_chain_id]['single_name']
-        else:
+        if types not in (('single', 'single'),
+                         ('hub', 'single'),
+                         ('single', 'hub')):
             raise ValueError('Unknown type tuple:', types)
 
+        # Hub chains are blended like the single they are derived from.
+        a_single_name = self.xdb.chain_single_names[a_info.chain]
+        b_single_name = self.xdb.chain_single_names[b_info.chain]
+
         a_single_len = self.get_single_len(a_single_name)
         b_single_len = self.get_single_len(b_single_name)
 
-        dbl_name = a_single_name + '-' + b_single_name
-        dbl_pdb = pdb_utils.read_pdb(
-            self.pdb_dir + '/doubles/' + dbl_name + '.pdb')
-        dbl_res = pdb_utils.get_residues(dbl_pdb)
+        dbl_res, rot, tran = self.get_double(
+            term, a_info, a_single_name, b_info, b_single_name)
 
         main_res = deposit_context.main_res
 
@@ -605,26 +1092,10 @@ class Stitcher:
             # main_res:                  [n ... | ... c]
             # disp_w:                    [1....0]
             # dbl:      [n ... | ... c]  [n ... | ... c]
-            if b_info.mod_type == 'hub':
-                # Lift double (in A frame) to hub arm frame with A at the
-                # arm's tip.
-                chains = \
-                    self.xdb['modules']['singles'][a_single_name]['chains']
-                tx_id = chains[a_chain_id]['c'][b_info.mod_name][b_chain_id]
-                tx = self.xdb['n_to_c_tx'][tx_id]
-                rot = np.asarray(tx['rot'])
-                tran = np.asarray(tx['tran'])
-            else:  # Guaranteed to be 'single' thanks to get_node()
-                # Drop double to B frame.
-                rot, tran = self.get_drop_tx(a_single_name, b_single_name)
-
-            transform_residues(dbl_res, rot, tran)
-
             disp_n = b_single_len // 2
             disp_w = [i/disp_n for i in range(1, disp_n + 1)]
 
-            main_disp = main_res[:disp_n]
-            dbl_part = dbl_res[-b_single_len:-b_single_len+disp_n]
+            dbl_part = dbl_res.residues(-b_single_len, -b_single_len+disp_n)
             disp_w.reverse()  # Make it 1 -> 0
         elif term == 'c':
             # Displace C term residues (second half of main_res) based on
@@ -634,76 +1105,221 @@ class Stitcher:
             # main_res: [n ... | ... c]
             # disp_w:          [0....1]
             # dbl:      [n ... | ... c]  [n ... | ... c]
-            if a_info.mod_type == 'hub':
+            disp_n = a_single_len // 2
+            disp_w = [i/disp_n for i in range(1, disp_n + 1)]
+
+            dbl_part = dbl_res.residues(disp_n, disp_n+disp_n)
+
+        # Only the blended part of the shared double needs to be copied and
+        # moved into the frame of main_res.
+        dbl_part = dbl_part.copy()
+        if rot is not None:
+            dbl_part.transform(rot, tran)
+
+        plan_key = ('double', term, a_info.chain, b_info.chain)
+        if term == 'n':
+            deposit_context.main_res = pdb_utils.AtomBlock.concatenate([
+                self.blend_residues(plan_key,
+                                    main_res.residues(None, disp_n),
+                                    dbl_part, disp_w),
+                main_res.residues(disp_n)
+            ])
+        else:
+            deposit_context.main_res = pdb_utils.AtomBlock.concatenate([
+                main_res.residues(None, -disp_n),
+                self.blend_residues(plan_key,
+                                    main_res.residues(-disp_n),
+                                    dbl_part, disp_w)
+            ])
+
+    # Blends moving_res into fixed_res. The blend plan is computed once per
+    # plan_key, i.e. once per (module, double) or (module, cap) junction.
+    def blend_residues(self, plan_key, moving_res, fixed_res, weights):
+        with self.stats.phase('blend'):
+            plan = self.blend_plans.get(plan_key)
+            if plan is None:
+                self.stats.count_cache('blend_plan', 0, 1)
+                plan = plan_blend(moving_res, fixed_res, weights)
+                self.blend_plans[plan_key] = plan
+            elif len(plan.keep) != len(moving_res):
+                # Moving residues were already changed by blending of the
+                # other terminus, which only happens in very short modules.
+                self.stats.count_cache('blend_plan', 0, 1)
+                plan = plan_blend(moving_res, fixed_res, weights)
+            else:
+                self.stats.count_cache('blend_plan', 1, 0)
+
+            return apply_blend(plan, moving_res, fixed_res)
+
+    # Returns the shared residues of the double a_single_name-b_single_name
+    # together with the (rot, tran) that moves them into the frame of the
+    # module whose term is being displaced. rot and tran are None if the
+    # double is already in that frame.
+    #
+    # Double residues are parsed once and kept in the double cache, and
+    # transforms are composed once per junction type, so displacing a
+    # terminus only costs transforming the blended residues.
+    def get_double(self, term, a_info, a_single_name, b_info, b_single_name):
+        dbl_name = a_single_name + '-' + b_single_name
+
+        def load_residues():
+            return pdb_utils.AtomBlock.concatenate(
+                self.load_module('double', dbl_name).values())
+
+        dbl_res = self.double_cache.get(dbl_name, load_residues)
+
+        tx_key = (term, a_info.chain, b_info.chain)
+        if tx_key not in self.double_txs:
+            rot, tran = None, None
+            if term == 'n':
+                if b_info.mod_type == 'hub':
+                    # Lift double (in A frame) to hub arm frame with A at the
+                    # arm's tip.
+                    rot, tran = self.xdb.get_rot_tran(
+                        self.xdb.find_tx(a_info.chain, b_info.chain))
+                else:  # Guaranteed to be 'single' thanks to get_node()
+                    # Drop double to B frame.
+                    rot, tran = self.get_drop_tx(a_single_name, b_single_name)
+            elif a_info.mod_type == 'hub':
                 # Step 1: Drop double to B frame.
                 rot, tran = self.get_drop_tx(a_single_name, b_single_name)
 
                 # Step 2: Lift double (in B frame) to hub arm frame.
-                chains = self.xdb['modules']['hubs'][a_info.mod_name]['chains']
-                tx_id = chains[a_chain_id]['c'][b_single_name][b_chain_id]
-                tx = self.xdb['n_to_c_tx'][tx_id]
-                hub_rot = np.asarray(tx['rot'])
-                hub_tran = np.asarray(tx['tran'])
+                hub_rot, hub_tran = self.xdb.get_rot_tran(
+                    self.xdb.find_tx(a_info.chain, b_info.chain))
 
                 tran = hub_rot.dot(tran) + hub_tran
                 rot = hub_rot.dot(rot)
-                transform_residues(dbl_res, rot, tran)
-
-            disp_n = a_single_len // 2
-            disp_w = [i/disp_n for i in range(1, disp_n + 1)]
 
-            main_disp = main_res[-disp_n:]
-            dbl_part = dbl_res[disp_n:disp_n+disp_n]
+            self.double_txs[tx_key] = (rot, tran)
 
-        blend_residues(main_disp, dbl_part, disp_w)
+        return (dbl_res,) + self.double_txs[tx_key]
 
     def get_drop_tx(self, a_single_name, b_single_name):
-        a_chains = self.xdb['modules']['singles'][a_single_name]['chains']
-
-        assert len(a_chains) == 1
-        a_chain_id = list(a_chains.keys())[0]
-        a_b_chains = a_chains[a_chain_id]['c'][b_single_name]
-
-        assert len(a_b_chains) == 1
-        b_chain_id = list(a_b_chains.keys())[0]
-        tx_id = a_b_chains[b_chain_id]
-
-        tx = self.xdb['n_to_c_tx'][tx_id]
+        tx_id = self.xdb.find_tx(
+            self.xdb.find_single_chain(a_single_name),
+            self.xdb.find_single_chain(b_single_name))
 
         # Inverse tx because dbgen.py computes the tx that takes the
         # single B module to part B inside double.
-        rot = np.transpose(tx['rot'])
-        tran = rot.dot(-np.asarray(tx['tran']))
-
-        return rot, tran
+        return self.xdb.get_rot_tran(tx_id, inverse=True)
 
     # Returns the number of residues in a single module.
     def get_single_len(self, mod_name):
-        chains = self.xdb['modules']['singles'][mod_name]['chains']
-        assert len(chains) == 1
-
-        chain_id = list(chains.keys())[0]
-        return chains[chain_id]['n_residues']
+        return int(self.xdb.chain_n_residues[
+            self.xdb.find_single_chain(mod_name)])
+
+    # Returns {chain ID: AtomBlock} of an aligned module, read from the module
+    # library if there is one, or else parsed from its PDB.
+    def load_module(self, mod_type, mod_name):
+        with self.stats.phase('load_module'):
+            if self.module_library is not None:
+                return self.module_library.get_module(
+                    mod_type + 's', mod_name)
+
+            return pdb_utils.read_pdb_blocks(
+                self.get_module_path(mod_type, mod_name))
+
+    # Returns the path of the aligned PDB of a module.
+    def get_module_path(self, mod_type, mod_name):
+        return self.pdb_dir + '/' + mod_type + 's/' + mod_name + '.pdb'
+
+    # Returns a dict of chain ID to AtomBlock for a module, loading it only if
+    # it is not already in the module cache. The residues are shared between
+    # all callers and must not be modified in place.
+    def get_module_residues(self, mod_type, mod_name):
+        return self.module_cache.get(
+            (mod_type, mod_name),
+            lambda: self.load_module(mod_type, mod_name))
+
+    # Parses every module in the xdb ahead of time, e.g. for long running
+    # processes that should not pay for module parsing per request.
+    def preload_modules(self):
+        for mod_type in ('single', 'hub'):
+            for mod_name in self.xdb.modules[mod_type + 's']:
+                self.get_module_residues(mod_type, mod_name)
 
     def get_mod_info(self, node, chain_id):
         mod_type = node['module_type']
         mod_name = node['module_name']
 
         # Obtain module residues.
-        pdb = pdb_utils.read_pdb(self.pdb_dir + '/' + mod_type +
-                                 's/' + mod_name + '.pdb')
-        res = pdb_utils.get_residues(pdb, chain_id)
-        res_n = len(res)
-
-        return ModInfo(mod_type, mod_name, res, res_n)
-
-    def deposit_chains(self, network):
-        chain_iden_gen = decompose_network(network, self.xdb, self.skip_unused)
-        for chain_iden in chain_iden_gen:
-            self.deposit_chain(network, chain_iden)
-
-    def new_chain(self):
-        return Bio.PDB.Chain.Chain(self.next_chain_id())
+        res = self.get_module_residues(mod_type, mod_name)[chain_id]
+        res_n = res.n_residues
+
+        return ModInfo(mod_type, mod_name, res, res_n,
+                       self.xdb.find_chain(mod_name, chain_id))
+
+    # Deposits all chains of a network. If a process pool is given, chains
+    # are deposited concurrently but still added to the model in the order
+    # the network index decomposes them.
+    def deposit_chains(self, nw_name, pool=None):
+        net_index = self.get_network_index(nw_name)
+        chain_iden_gen = self.stats.iterate(
+            'decompose_network', net_index.decompose(self.skip_unused))
+
+        if pool is None:
+            chain_blocks = (self.get_chain_block(net_index, chain_iden)
+                            for chain_iden in chain_iden_gen)
+        else:
+            chain_blocks = self.merge_worker_stats(pool.imap(
+                _deposit_chain_task,
+                ((nw_name, chain_iden) for chain_iden in chain_iden_gen)))
+
+        for chain_block in chain_blocks:
+            yield self.number_chain(chain_block)
+
+    # Merges the stats pool workers return along with each result into this
+    # Stitcher's stats, yielding the results.
+    def merge_worker_stats(self, results):
+        for result, stats in results:
+            self.stats.merge(stats)
+            yield result
+
+    # Compiles a network of the current spec once. Pool workers compile
+    # their own copy the first time they deposit a chain of the network.
+    def get_network_index(self, nw_name):
+        net_index = self.network_indices.get(nw_name)
+        if net_index is None:
+            with self.stats.phase('compile_network'):
+                net_index = NetworkIndex(
+                    self.spec['networks'][nw_name], self.xdb)
+            self.network_indices[nw_name] = net_index
+        return net_index
+
+    def deposit_networks(self, pool=None):
+        networks = self.spec['networks']
+        for nw_name in networks:
+            self.log('Processing network \"{}\"'.format(nw_name))
+            yield from self.deposit_chains(nw_name, pool)
+
+    # Prints progress messages if verbose.
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
+
+    # Returns stats of all runs so far, including those of pool workers and
+    # module and double cache hit rates, as a JSON serializable dict.
+    def get_stats(self):
+        stats = utils.RunStats()
+        stats.merge(self.stats.to_dict())
+        stats.count_cache(
+            'module', self.module_cache.hits, self.module_cache.misses)
+        stats.count_cache(
+            'double', self.double_cache.hits, self.double_cache.misses)
+        return stats.to_dict()
+
+    def reset_stats(self):
+        self.stats.clear()
+        for cache in (self.module_cache, self.double_cache):
+            cache.hits = cache.misses = 0
+
+    # Returns the stats gathered since the last call and resets them, e.g.
+    # for pool workers to hand back to the parent process.
+    def pop_stats(self):
+        stats = self.get_stats()
+        self.reset_stats()
+        return stats
 
     def next_chain_id(self):
         cid = str(self.chain_id)
@@ -713,34 +1329,103 @@ class Stitcher:
     def reset_residue_id(self):
         self.residue_id = 1
 
-    def next_residue_id(self):
+    # Reserves count consecutive residue IDs and returns the first one.
+    def next_residue_id(self, count=1):
         rid = self.residue_id
-        self.residue_id += 1
+        self.residue_id += count
         return rid
 
-    def run(self):
-        self.reset_residue_id()
-        self.model = Bio.PDB.Model.Model(0)
+    # Stitches the design spec given to the constructor, or spec if given,
+    # yielding (chain ID, AtomBlock) for each chain as soon as it has been
+    # deposited. The same Stitcher can run many designs, sharing its caches.
+    def stitch_chains(self, spec=None):
+        if spec is not None:
+            self.set_spec(spec)
 
-        if self.show_fusion:
-            print('Note: show_fusion is on')
+        self.chain_id = 0
+        self.reset_residue_id()
 
-        networks = self.spec['networks']
-        for nw_name in networks:
-            print('Processing network \"{}\"'.format(nw_name))
-            complaint = self.deposit_chains(networks[nw_name])
-            if complaint:
-                print('Error: {}', complaint)
-                exit()
+        if self.worker_count > 1:
+            with multiprocessing.Pool(
+                    self.worker_count,
+                    _init_worker,
+                    (self,)) as pool:
+                yield from self.deposit_networks(pool)
+        else:
+            yield from self.deposit_networks()
+
+    # Stitches a design into a Bio.PDB.Structure.Structure.
+    def run(self, spec=None):
+        model = Bio.PDB.Model.Model(0)
+        with self.stats.phase('stitch'):
+            for chain_id, chain_block in self.stitch_chains(spec):
+                with self.stats.phase('build_structure'):
+                    atom_chain = Bio.PDB.Chain.Chain(chain_id)
+                    for r in chain_block.to_residues():
+                        atom_chain.add(r)
+                    model.add(atom_chain)
 
         # Create output
         sb = Bio.PDB.StructureBuilder.StructureBuilder()
         sb.init_structure('0')
         structure = sb.get_structure()
-        structure.add(self.model)
+        structure.add(model)
 
         return structure
 
+    # Stitches a design into an open text file as CIF, writing each chain out
+    # as soon as it has been deposited.
+    def dump_cif(self, file, spec=None):
+        with self.stats.phase('stitch'):
+            writer = pdb_utils.CifWriter(file)
+            writer.write_header()
+            for chain_id, chain_block in self.stitch_chains(spec):
+                with self.stats.phase('write_output'):
+                    writer.write_chain(chain_block, chain_id)
+            writer.write_footer()
+
+    # Stitches a design straight into a CIF file, writing each chain out as
+    # soon as it has been deposited instead of building the whole structure
+    # in memory first. A partially written file is removed on error.
+    def write_cif(self, path, spec=None):
+        if spec is not None:
+            # Validate before creating the output file
+            self.set_spec(spec)
+
+        try:
+            with open(path, 'w') as file:
+                self.dump_cif(file)
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+
+# Each pool worker process keeps its own Stitcher, so module, double and cap
+# caches fill up independently in every worker.
+_worker_stitcher = None
+
+
+def _init_worker(stitcher):
+    global _worker_stitcher
+    _worker_stitcher = stitcher
+    # Only report work done in this process.
+    stitcher.reset_stats()
+
+
+# Pool tasks return their stats along with their result, to be merged into
+# the parent's.
+def _stitch_design_task(job):
+    error = stitch_design(_worker_stitcher, *job)
+    return error, _worker_stitcher.pop_stats()
+
+
+def _deposit_chain_task(task):
+    nw_name, chain_iden = task
+    net_index = _worker_stitcher.get_network_index(nw_name)
+    chain_block = _worker_stitcher.get_chain_block(net_index, chain_iden)
+    return chain_block, _worker_stitcher.pop_stats()
+
 
 if __name__ == '__main__':
     utils.safe_exec(main)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+#
+# This script runs a long lived stitching service, so that the xdb and parsed
+# module PDBs stay in memory between designs. Design JSON exported by
+# elfin-ui is POSTed to /stitch over HTTP, either on a localhost TCP port or
+# on a Unix socket, and the CIF atom model is returned as the response body.
+#
+# e.g. curl --data-binary @design.json http://127.0.0.1:8000/stitch > out.cif
+#      curl --unix-socket /tmp/stitch.sock --data-binary @design.json \
+#           http://localhost/stitch > out.cif
+#
+
+import io
+import os
+import sys
+import signal
+import json
+import asyncio
+import argparse
+import concurrent.futures
+from functools import partial
+
+try:
+    import utilities as utils
+    import stitch
+    import xdb as xdb_lib
+except ImportError:
+    from . import utilities as utils
+    from . import stitch
+    from . import xdb as xdb_lib
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error'
+}
+
+
+def parse_args(args):
+    desc = ('Run a resident stitching service that turns design solution '
+            'JSON POSTed to /stitch into CIF atom models.')
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('-u', '--unix_socket', default='',
+                        help='Listen on this Unix socket path instead of a '
+                        'TCP port.')
+    stitch.add_stitcher_args(parser)
+    parser.add_argument('-w', '--worker_count', default='1',
+                        help='Number of stitching processes, or cpu_count.')
+    parser.add_argument('--preload', action='store_true',
+                        help='Parse all modules in the xdb when each worker '
+                        'starts instead of on first use.')
+    parser.add_argument('--max_request_size', type=int, default=64 << 20,
+                        help='Largest accepted design JSON in bytes.')
+    return parser.parse_args(args)
+
+
+def main(test_args=None):
+    args = parse_args(sys.argv[1:] if test_args is None else test_args)
+
+    xdb = xdb_lib.XDB.load(args.xdb)
+    stitcher = stitch.create_stitcher(args, xdb)
+    worker_count = utils.parse_worker_count(args.worker_count)
+
+    asyncio.run(serve(args, stitcher, worker_count))
+
+
+# Starts worker_count stitching processes, each holding its own copy of
+# stitcher and therefore of its module caches, then serves requests until
+# SIGINT or SIGTERM. Request parsing happens on the event loop; stitching
+# happens in the workers.
+async def serve(args, stitcher, worker_count):
+    loop = asyncio.get_running_loop()
+    serve_task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, serve_task.cancel)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            worker_count,
+            initializer=_init_worker,
+            initargs=(stitcher, args.preload)) as executor:
+
+        # Start the workers up front so the first requests do not pay for
+        # process start-up and preloading.
+        await asyncio.gather(*(
+            loop.run_in_executor(executor, _ping)
+            for _ in range(worker_count)))
+
+        handler = partial(
+            handle_connection, executor, args.max_request_size)
+        if args.unix_socket:
+            server = await asyncio.start_unix_server(
+                handler, path=args.unix_socket)
+            print('Listening on {}'.format(args.unix_socket))
+        else:
+            server = await asyncio.start_server(
+                handler, args.host, args.port)
+            print('Listening on http://{}:{}'.format(args.host, args.port))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            print('Stopped')
+        finally:
+            if args.unix_socket and os.path.exists(args.unix_socket):
+                os.remove(args.unix_socket)
+
+
+async def handle_connection(executor, max_request_size, reader, writer):
+    try:
+        status, body = await handle_request(
+            executor, max_request_size, reader)
+    except (asyncio.IncompleteReadError, ValueError, UnicodeDecodeError) \
+            as e:
+        status, body = 400, 'Bad request: {}'.format(e).encode()
+    except Exception as e:
+        status, body = 500, '{}: {}'.format(type(e).__name__, e).encode()
+
+    content_type = 'chemical/x-mmcif' if status == 200 else 'text/plain'
+    writer.write(
+        'HTTP/1.1 {} {}\r\n'
+        'Content-Type: {}\r\n'
+        'Content-Length: {}\r\n'
+        'Connection: close\r\n\r\n'.format(
+            status, HTTP_REASONS[status], content_type, len(body)
+        ).encode() + body)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+# Reads one HTTP request and returns (status code, response body bytes).
+async def handle_request(executor, max_request_size, reader):
+    request_line = await reader.readline()
+    if not request_line:
+        raise ValueError('empty request')
+    method, path, _ = request_line.decode('latin-1').split()
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = int(headers.get('content-length', 0))
+    if content_length > max_request_size:
+        return 413, b'Design JSON too large'
+    body = await reader.readexactly(content_length)
+
+    if path.split('?')[0].rstrip('/') != '/stitch':
+        return 404, b'Only /stitch is served'
+    if method != 'POST':
+        return 405, b'POST design JSON to /stitch'
+
+    spec = json.loads(body.decode('utf-8'))
+
+    loop = asyncio.get_running_loop()
+    cif, error = await loop.run_in_executor(executor, _stitch_task, spec)
+    if error:
+        return 400, error.encode()
+    return 200, cif
+
+
+_worker_stitcher = None
+
+
+def _init_worker(stitcher, preload=False):
+    global _worker_stitcher
+    _worker_stitcher = stitcher
+    if preload:
+        stitcher.preload_modules()
+
+
+def _ping():
+    pass
+
+
+# Stitches spec into CIF bytes. Returns (CIF bytes, None), or (None, error
+# string) if the design is invalid.
+def _stitch_task(spec):
+    file = io.StringIO()
+    try:
+        _worker_stitcher.dump_cif(file, spec)
+    except ValueError as ve:
+        return None, str(ve)
+    return file.getvalue().encode(), None
+
+
+if __name__ == '__main__':
+    utils.safe_exec(main)
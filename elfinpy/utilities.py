@@ -9,6 +9,12 @@ import traceback as traceback_module
 import json
 import csv
 import re
+import time
+import threading
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import numpy as np
 
@@ -56,6 +62,236 @@ def to_dict(obj, classkey=None):
         return obj
 
 
+class LRUCache(object):
+    """A bounded mapping that evicts its least recently used entry once
+    capacity is exceeded.
+
+    Args:
+    - capacity - maximum number of entries to keep. None means unbounded.
+    """
+    def __init__(self, capacity=None):
+        if capacity is not None and capacity < 1:
+            raise ValueError('LRUCache capacity must be at least 1')
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, factory):
+        """Returns the entry for key, calling factory() to create it on a
+        miss.
+        """
+        try:
+            value = self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+
+        value = factory()
+        self._entries[key] = value
+        if self.capacity is not None and len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+class RunStats(object):
+    """Records wall time and call counts of named phases, plus named counters
+    and cache hit/miss counts, for instrumenting long runs. Phases may nest,
+    in which case the outer phase's time includes the inner phase's.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.caches = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager that times its body under phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, 1, time.perf_counter() - start)
+
+    def add_phase(self, name, calls, seconds):
+        entry = self.phases.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+
+    def iterate(self, name, iterable):
+        """Yields from iterable, timing each step under phase name. Useful for
+        generators whose work is interleaved with the consumer's.
+        """
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_cache(self, name, hits, misses):
+        entry = self.caches.setdefault(name, [0, 0])
+        entry[0] += hits
+        entry[1] += misses
+
+    def merge(self, stats_dict):
+        """Adds the numbers of another RunStats' to_dict() output, e.g. from a
+        worker process.
+        """
+        for name, p in stats_dict['phases'].items():
+            self.add_phase(name, p['calls'], p['seconds'])
+        for name, n in stats_dict['counters'].items():
+            self.count(name, n)
+        for name, c in stats_dict['caches'].items():
+            self.count_cache(name, c['hits'], c['misses'])
+
+    def clear(self):
+        self.phases.clear()
+        self.counters.clear()
+        self.caches.clear()
+
+    def to_dict(self):
+        """Returns a JSON serializable dict of all phases, counters and caches,
+        including each cache's hit rate.
+        """
+        def cache_entry(hits, misses):
+            total = hits + misses
+            return OrderedDict([
+                ('hits', hits),
+                ('misses', misses),
+                ('hit_rate', hits / total if total else None)
+            ])
+
+        return OrderedDict([
+            ('phases', OrderedDict(
+                (name, OrderedDict([('calls', c), ('seconds', t)]))
+                for name, (c, t) in self.phases.items())),
+            ('counters', OrderedDict(self.counters)),
+            ('caches', OrderedDict(
+                (name, cache_entry(*c)) for name, c in self.caches.items()))
+        ])
+
+class BackgroundWriter(object):
+    """Runs output writing calls on a pool of threads, so that the next output
+    can be computed while previous ones are being written.
+
+    At most max_pending calls are queued or running at a time; submit() blocks
+    until one finishes once there are that many, so slow writes hold back the
+    caller instead of piling up outputs in memory. The first error raised by a
+    call is raised again by the next submit(), wait() or close().
+
+    Use as a context manager to close() on exit.
+
+    Args:
+    - thread_count - number of writer threads. 0 makes submit() call the
+        function right away, in the calling thread.
+    - max_pending - maximum number of outstanding calls. Defaults to twice
+        thread_count.
+    """
+    def __init__(self, thread_count=1, max_pending=None):
+        if thread_count < 0:
+            raise ValueError('Invalid writer thread count: {}'.format(thread_count))
+        if max_pending is None:
+            max_pending = 2 * thread_count
+        if thread_count > 0 and max_pending < thread_count:
+            raise ValueError('BackgroundWriter max_pending must be at least thread_count')
+        self.thread_count = thread_count
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(thread_count) \
+            if thread_count > 0 else None
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the error that is already propagating.
+            self.shutdown()
+
+    def submit(self, func, *args, key=None, **kwargs):
+        """Calls func(*args, **kwargs) on a writer thread.
+
+        Args:
+        - func - function to call
+        - key - optional name of the output written, e.g. its path, that
+            wait(key) waits for
+        """
+        self.check()
+        if self._executor is None:
+            func(*args, **kwargs)
+            return
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending[future] = key
+        future.add_done_callback(self._finish)
+
+    def _finish(self, future):
+        with self._lock:
+            del self._pending[future]
+            if self._error is None and not future.cancelled():
+                self._error = future.exception()
+        self._slots.release()
+
+    def check(self):
+        """Raises the first error of a finished call, if any."""
+        if self._error is not None:
+            raise self._error
+
+    def wait(self, key=None):
+        """Waits for all outstanding calls, or only those submitted with key,
+        to finish.
+
+        Calls with the key must have been submitted before this call, which
+        makes waiting from within a writer thread safe: calls start in
+        submission order, so they are already running.
+        """
+        with self._lock:
+            futures = [f for f, k in self._pending.items()
+                if key is None or k == key]
+        concurrent.futures.wait(futures)
+        self.check()
+
+    def close(self):
+        """Waits for all outstanding calls and stops the writer threads."""
+        try:
+            self.wait()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stops the writer threads after outstanding calls finish, without
+        raising their errors.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
 def get_rotation(angle_x=0, angle_y=0, angle_z=0):
     """https://en.wikipedia.org/wiki/Rotation_matrix
     """
@@ -96,6 +332,23 @@ def gen_pymol_txm(rot, tran):
     pymol_rot_mat = np.append(rot_tp_tran, [[0, 0, 0, 1]], axis=0)
     return '[' + ', '.join(map(str, pymol_rot_mat.ravel())) + ']'
 
+def parse_worker_count(worker_count):
+    """Converts a worker count argument into a number of processes.
+
+    Args:
+    - worker_count - an int, a string of an int, or 'cpu_count'.
+
+    Returns:
+    - _ - the number of worker processes, at least 1.
+    """
+    if worker_count == 'cpu_count':
+        return multiprocessing.cpu_count()
+
+    worker_count = int(worker_count)
+    if worker_count < 1:
+        raise ValueError('Invalid worker count: {}'.format(worker_count))
+    return worker_count
+
 def int_ceil(float_num):
     """Ceil a float then turn it into an int."""
     return int(np.ceil(float_num))
@@ -210,16 +463,14 @@ def com_dist_info(xdb):
     """Computes centre-of-mass distance information.
 
     Args:
-    - xdb - a dict containing the xdb data. Should have originated from
-        read_json().
+    - xdb - an xdb.XDB, e.g. from XDB.load().
 
     Returns:
     - (_, _, _) - tuple containing average, min and max values for centre-of-mass
         distances.
     """
-    all_tx = xdb['n_to_c_tx']
-    dists = [np.linalg.norm(tx['tran']) for tx in all_tx]
-    return np.average(dists), min(dists), max(dists)
+    dists = np.linalg.norm(xdb.txs[:, :3, 3], axis=1)
+    return np.average(dists), np.min(dists), np.max(dists)
 
 def read_csv_points(csv_file):
     """A wrapper of read_csv() but returns as list of numpy array points."""
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+
+#
+# This script loads an xdb (e.g. resources/xdb.json) through a binary sidecar
+# file kept next to it, <xdb>.sidecar.
+#
+# dbgen.py writes the xdb as indented JSON, which is slow to parse. On first
+# use, the sidecar is built from the JSON and holds the transforms as float64
+# arrays, module and chain IDs as integer indices into name tables, and the
+# module tree as compact JSON. Later loads read the sidecar instead, as long
+# as it still matches the JSON, which stays the source of truth. The sidecar
+# layout follows that of module_library.py:
+#
+#   magic (8 bytes) | header size (uint64 LE) | JSON header | arrays
+#
+# A sidecar matches its JSON if the JSON's size and mtime are those recorded
+# in the header or, failing that, if its SHA1 is.
+#
+# load_xdb() returns the xdb as the same dict the JSON parses to, while
+# XDB.load() returns an XDB, which numbers modules and chains and indexes
+# their links and transforms, for consumers that look them up many times.
+#
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import utilities as utils
+except ImportError:
+    from . import utilities as utils
+
+MAGIC = b'ELFINXD1'
+SIDECAR_VERSION = 1
+SIDECAR_SUFFIX = '.sidecar'
+ARRAY_ALIGNMENT = 64
+
+# Keys of every n_to_c_tx entry, in the order dbgen.py writes them.
+TX_KEYS = ('mod_a', 'mod_a_chain', 'mod_b', 'mod_b_chain', 'rot', 'tran')
+
+
+def parse_args(args):
+    desc = ('Builds the binary sidecar of an xdb if it is missing or out of '
+            'date, and prints what the xdb holds.')
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('xdb', nargs='?', default='./resources/xdb.json')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the sidecar even if it is up to date.')
+    return parser.parse_args(args)
+
+
+def main(test_args=None):
+    args = parse_args(sys.argv[1:] if test_args is None else test_args)
+
+    if args.rebuild:
+        xdb = build_sidecar(args.xdb)
+    else:
+        xdb = load_xdb(args.xdb)
+
+    print('Singles: {}'.format(len(xdb['modules']['singles'])))
+    print('Hubs: {}'.format(len(xdb['modules']['hubs'])))
+    print('Transforms: {}'.format(len(xdb['n_to_c_tx'])))
+    if read_sidecar(args.xdb) is None:
+        print('No sidecar for {}'.format(args.xdb))
+    else:
+        print('Sidecar: {}'.format(sidecar_path(args.xdb)))
+
+
+def sidecar_path(xdb_path):
+    return xdb_path + SIDECAR_SUFFIX
+
+
+def load_xdb(xdb_path):
+    """Reads an xdb JSON file, from its sidecar if that is up to date.
+    Otherwise the JSON is parsed and the sidecar (re)built from it.
+
+    Args:
+    - xdb_path - path of the xdb JSON file.
+
+    Returns:
+    - xdb - dict equal to utils.read_json(xdb_path).
+    """
+    sidecar = read_sidecar(xdb_path)
+    if sidecar is not None:
+        return sidecar_to_xdb(*sidecar)
+    return build_sidecar(xdb_path)
+
+
+def as_xdb(xdb):
+    """Returns xdb as an XDB, converting it if it is an xdb dict."""
+    return XDB.from_dict(xdb) if isinstance(xdb, dict) else xdb
+
+
+class XDB(object):
+    """An xdb held in arrays, with modules and module chains numbered by
+    integer indices so that links and transforms can be looked up without
+    walking the nested module dicts.
+
+    Modules are numbered in xdb order, singles first. Chains are numbered per
+    module, so chain i is chain chain_ids[i] of module mod_names[chain_mods[i]]
+    and the chains of module m are mod_chains[m]. Transform t, i.e.
+    n_to_c_tx[t], is txs[t] as a 4x4 homogeneous matrix, and inv_txs[t] is
+    its inverse.
+
+    Links are kept in CSR form. The C terminus of chain i links to the N
+    terminus of chains c_chains[c_indptr[i]:c_indptr[i+1]] (sorted) through
+    transforms c_txs[c_indptr[i]:c_indptr[i+1]], and likewise for the N
+    terminus with n_indptr, n_chains and n_txs.
+
+    Args:
+    - header - sidecar header, see xdb_to_sidecar().
+    - arrays - sidecar arrays, see xdb_to_sidecar().
+    """
+    def __init__(self, header, arrays):
+        self.modules = header['other']['modules']
+
+        # Modules referred to by transforms only have no type or chains.
+        self.mod_names = list(header['mod_names'])
+        self.mod_index = {n: i for i, n in enumerate(self.mod_names)}
+        self.mod_types = [None] * len(self.mod_names)
+
+        chain_names = header['chain_ids']
+        chain_table = np.full(
+            (len(self.mod_names), len(chain_names)), -1, dtype=np.intp)
+        chain_name_index = {c: i for i, c in enumerate(chain_names)}
+
+        self.mod_chains = [range(0)] * len(self.mod_names)
+        self.chain_ids = []
+        chain_mods = []
+        chain_n_residues = []
+        self.chain_single_names = []
+        for mod_type in ('singles', 'hubs'):
+            for mod_name, mod in self.modules[mod_type].items():
+                mod_id = self.mod_index[mod_name]
+                self.mod_types[mod_id] = mod_type[:-1]
+                start = len(self.chain_ids)
+                for chain_id, chain in mod['chains'].items():
+                    chain_table[mod_id, chain_name_index[chain_id]] = \
+                        len(self.chain_ids)
+                    self.chain_ids.append(chain_id)
+                    chain_mods.append(mod_id)
+                    chain_n_residues.append(chain.get('n_residues', 0))
+                    self.chain_single_names.append(
+                        chain.get('single_name', mod_name))
+                self.mod_chains[mod_id] = range(start, len(self.chain_ids))
+        self.chain_mods = np.array(chain_mods, dtype=np.intp)
+        self.chain_n_residues = np.array(chain_n_residues, dtype=np.intp)
+        self.chain_index = {
+            (self.mod_names[m], c): i
+            for i, (m, c) in enumerate(zip(chain_mods, self.chain_ids))}
+
+        self.tx_chains_a = chain_table[arrays['mod_a'], arrays['mod_a_chain']]
+        self.tx_chains_b = chain_table[arrays['mod_b'], arrays['mod_b_chain']]
+        if np.any(self.tx_chains_a < 0) or np.any(self.tx_chains_b < 0):
+            raise ValueError('Transforms link chains that are not in the xdb')
+
+        rot = arrays['rot']
+        tran = arrays['tran']
+        inv_rot = np.transpose(rot, (0, 2, 1))
+        self.txs = homogeneous(rot, tran)
+        self.inv_txs = homogeneous(
+            inv_rot, np.matmul(inv_rot, -tran[..., None])[..., 0])
+
+        n_chains = len(self.chain_ids)
+        self.c_indptr, self.c_chains, self.c_txs = \
+            link_csr(self.tx_chains_a, self.tx_chains_b, n_chains)
+        self.n_indptr, self.n_chains, self.n_txs = \
+            link_csr(self.tx_chains_b, self.tx_chains_a, n_chains)
+
+    @classmethod
+    def from_dict(cls, xdb):
+        """Builds an XDB from an xdb dict, e.g. one read by load_xdb()."""
+        return cls(*xdb_to_sidecar(xdb))
+
+    @classmethod
+    def load(cls, xdb_path):
+        """Reads an xdb JSON file into an XDB, from its sidecar if that is up
+        to date, like load_xdb().
+        """
+        sidecar = read_sidecar(xdb_path)
+        if sidecar is None:
+            return cls.from_dict(build_sidecar(xdb_path))
+        return cls(*sidecar)
+
+    def __len__(self):
+        return len(self.txs)
+
+    def find_module(self, mod_type, mod_name):
+        """Returns the index of a module. Raises KeyError if there is no
+        mod_type module called mod_name.
+        """
+        mod_id = self.mod_index[mod_name]
+        if self.mod_types[mod_id] != mod_type:
+            raise KeyError(mod_name)
+        return mod_id
+
+    def find_chain(self, mod_name, chain_id):
+        """Returns the index of chain chain_id of module mod_name. Raises
+        KeyError if there is no such chain.
+        """
+        return self.chain_index[(mod_name, chain_id)]
+
+    def find_single_chain(self, mod_name):
+        """Returns the index of the only chain of single module mod_name."""
+        chains = self.mod_chains[self.find_module('single', mod_name)]
+        assert len(chains) == 1
+        return chains[0]
+
+    def has_links(self, chain, term):
+        """Returns whether the term terminus of a chain links to any other
+        chain.
+        """
+        indptr = self.n_indptr if term == 'n' else self.c_indptr
+        return indptr[chain + 1] > indptr[chain]
+
+    def find_tx(self, chain_a, chain_b):
+        """Returns the ID of the transform linking the C terminus of chain_a
+        to the N terminus of chain_b. Raises KeyError if they are not linked.
+        """
+        start, stop = self.c_indptr[chain_a], self.c_indptr[chain_a + 1]
+        i = start + np.searchsorted(self.c_chains[start:stop], chain_b)
+        if i == stop or self.c_chains[i] != chain_b:
+            raise KeyError((chain_a, chain_b))
+        return int(self.c_txs[i])
+
+    def get_rot_tran(self, tx_id, inverse=False):
+        """Returns transform tx_id, or its inverse, as (rot, tran)."""
+        tx = (self.inv_txs if inverse else self.txs)[tx_id]
+        return tx[:3, :3].copy(), tx[:3, 3].copy()
+
+    def fingerprint(self):
+        """Returns a SHA1 hex digest of the xdb content."""
+        h = hashlib.sha1(json.dumps(
+            [self.mod_names, self.chain_ids, self.modules],
+            sort_keys=True).encode())
+        for arr in (self.tx_chains_a, self.tx_chains_b, self.txs):
+            h.update(np.ascontiguousarray(arr).tobytes())
+        return h.hexdigest()
+
+
+def homogeneous(rot, tran):
+    txs = np.zeros((len(rot), 4, 4))
+    txs[:, :3, :3] = rot
+    txs[:, :3, 3] = tran
+    txs[:, 3, 3] = 1
+    return txs
+
+
+def link_csr(src, dst, n):
+    """Returns (indptr, dst, tx IDs) of links src -> dst, sorted by src then
+    dst, where tx IDs are the positions of the links in src and dst.
+    """
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(n + 1, dtype=np.intp)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=n))
+    return indptr, dst[order], order
+
+
+def build_sidecar(xdb_path):
+    """Parses an xdb JSON file and saves its sidecar. If the xdb does not
+    have the expected layout, or the sidecar cannot be written, the xdb is
+    still returned but no sidecar is left behind.
+
+    Args:
+    - xdb_path - path of the xdb JSON file.
+
+    Returns:
+    - xdb - dict parsed from xdb_path.
+    """
+    stat = os.stat(xdb_path)
+    with open(xdb_path, 'rb') as file:
+        data = file.read()
+    xdb = json.loads(data.decode())
+
+    try:
+        header, arrays = xdb_to_sidecar(xdb)
+    except (KeyError, TypeError, ValueError):
+        print('Warning: {} has an unexpected layout; not building a '
+              'sidecar for it'.format(xdb_path))
+        return xdb
+
+    header['source'] = source_info(stat, hashlib.sha1(data).hexdigest())
+    try:
+        write_sidecar(sidecar_path(xdb_path), header, arrays)
+    except OSError as error:
+        print('Warning: could not save xdb sidecar: {}'.format(error))
+    return xdb
+
+
+def source_info(stat, sha1):
+    return OrderedDict([
+        ('size', stat.st_size),
+        ('mtime_ns', stat.st_mtime_ns),
+        ('sha1', sha1)
+    ])
+
+
+def xdb_to_sidecar(xdb):
+    """Splits an xdb dict into a sidecar header and arrays.
+
+    Args:
+    - xdb - dict as read from an xdb JSON file.
+
+    Returns:
+    - (header, arrays) - header OrderedDict without the source entry, and an
+      OrderedDict of array name to numpy array.
+    """
+    txs = xdb['n_to_c_tx']
+    mod_names = OrderedDict()
+    chain_ids = OrderedDict()
+    for mod_type in ('singles', 'hubs'):
+        for mod_name, mod in xdb['modules'][mod_type].items():
+            mod_names.setdefault(mod_name, len(mod_names))
+            for chain_id in mod['chains']:
+                chain_ids.setdefault(chain_id, len(chain_ids))
+
+    for tx in txs:
+        if tuple(tx) != TX_KEYS:
+            raise ValueError('Unexpected transform keys: {}'.format(list(tx)))
+
+    def lookup(table, key):
+        return np.array(
+            [table.setdefault(tx[key], len(table)) for tx in txs],
+            dtype='<i4')
+
+    arrays = OrderedDict([
+        ('mod_a', lookup(mod_names, 'mod_a')),
+        ('mod_a_chain', lookup(chain_ids, 'mod_a_chain')),
+        ('mod_b', lookup(mod_names, 'mod_b')),
+        ('mod_b_chain', lookup(chain_ids, 'mod_b_chain')),
+        ('rot', np.array([tx['rot'] for tx in txs],
+                         dtype='<f8').reshape(len(txs), 3, 3)),
+        ('tran', np.array([tx['tran'] for tx in txs],
+                          dtype='<f8').reshape(len(txs), 3))
+    ])
+
+    header = OrderedDict([
+        ('version', SIDECAR_VERSION),
+        ('keys', list(xdb)),
+        ('mod_names', list(mod_names)),
+        ('chain_ids', list(chain_ids)),
+        ('other', OrderedDict(
+            (k, v) for k, v in xdb.items() if k != 'n_to_c_tx'))
+    ])
+    return header, arrays
+
+
+def sidecar_to_xdb(header, arrays):
+    """Rebuilds the xdb dict from a sidecar header and arrays."""
+    mod_names = header['mod_names']
+    chain_ids = header['chain_ids']
+    columns = (
+        [mod_names[i] for i in arrays['mod_a'].tolist()],
+        [chain_ids[i] for i in arrays['mod_a_chain'].tolist()],
+        [mod_names[i] for i in arrays['mod_b'].tolist()],
+        [chain_ids[i] for i in arrays['mod_b_chain'].tolist()],
+        arrays['rot'].tolist(),
+        arrays['tran'].tolist()
+    )
+    txs = [dict(zip(TX_KEYS, values)) for values in zip(*columns)]
+
+    other = header['other']
+    return {k: txs if k == 'n_to_c_tx' else other[k] for k in header['keys']}
+
+
+def write_sidecar(path, header, arrays):
+    header = OrderedDict(header)
+    header['arrays'] = OrderedDict()
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = OrderedDict([
+            ('dtype', arr.dtype.str),
+            ('shape', list(arr.shape)),
+            ('offset', offset)
+        ])
+        offset = align(offset + arr.nbytes)
+
+    header_bytes = json.dumps(
+        header, separators=(',', ':'), ensure_ascii=False).encode()
+    data_start = align(len(MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(struct.pack('<Q', data_start - len(MAGIC) - 8))
+            file.write(header_bytes)
+            for name, arr in arrays.items():
+                file.write(b'\0' * (
+                    data_start + header['arrays'][name]['offset'] -
+                    file.tell()))
+                file.write(np.ascontiguousarray(arr).tobytes())
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def align(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def read_sidecar(xdb_path):
+    """Reads the sidecar of an xdb JSON file.
+
+    Args:
+    - xdb_path - path of the xdb JSON file.
+
+    Returns:
+    - (header, arrays) - or None if there is no sidecar, or it does not
+      match the JSON.
+    """
+    path = sidecar_path(xdb_path)
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+        stat = os.stat(xdb_path)
+    except OSError:
+        return None
+
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    try:
+        header, data_start = read_header(data)
+        if header.get('version') != SIDECAR_VERSION:
+            return None
+        source = header['source']
+        if source['size'] != stat.st_size:
+            return None
+        arrays = load_arrays(data, data_start, header)
+        check_sidecar(header, arrays)
+    except (struct.error, ValueError, KeyError, TypeError, AttributeError):
+        # A damaged sidecar is rebuilt from the JSON.
+        return None
+
+    if source['mtime_ns'] != stat.st_mtime_ns:
+        # Touched but maybe not changed, e.g. by a checkout.
+        if source['sha1'] != file_sha1(xdb_path):
+            return None
+        header['source'] = source_info(stat, source['sha1'])
+        try:
+            write_sidecar(path, header, arrays)
+        except OSError:
+            pass
+
+    return header, arrays
+
+
+def read_header(data):
+    header_size, = struct.unpack('<Q', data[len(MAGIC):len(MAGIC) + 8])
+    data_start = len(MAGIC) + 8 + header_size
+    if data_start > len(data):
+        raise ValueError('Sidecar header is cut short')
+    header = json.loads(data[len(MAGIC) + 8:data_start].rstrip(b'\0 ').decode())
+    return header, data_start
+
+
+def check_sidecar(header, arrays):
+    """Raises KeyError or ValueError if a sidecar header and arrays are not
+    as written by xdb_to_sidecar().
+    """
+    for key in ('keys', 'mod_names', 'chain_ids', 'other'):
+        header[key]
+    n_txs = len(arrays['rot'])
+    shapes = {name: (n_txs,) for name in TX_KEYS[:4]}
+    shapes['rot'] = (n_txs, 3, 3)
+    shapes['tran'] = (n_txs, 3)
+    for name, shape in shapes.items():
+        if arrays[name].shape != shape:
+            raise ValueError('Bad sidecar array shape: {} {}'.format(
+                name, arrays[name].shape))
+
+
+def load_arrays(data, data_start, header):
+    arrays = OrderedDict()
+    for name, info in header['arrays'].items():
+        arrays[name] = np.frombuffer(
+            data,
+            dtype=np.dtype(info['dtype']),
+            count=int(np.prod(info['shape'])),
+            offset=data_start + info['offset']).reshape(info['shape'])
+    return arrays
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+if __name__ == '__main__':
+    utils.safe_exec(main)
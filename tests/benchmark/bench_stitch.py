@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+#
+# This script benchmarks stitch.py on a synthetic module library (see
+# synthetic_library.py), so it runs offline without the elfin-data PDBs.
+# Single-chain and multi-hub designs of each requested size are stitched in a
+# fresh process each, and stitching time, throughput and peak memory are
+# reported.
+#
+# e.g. python -m tests.benchmark.bench_stitch
+#      python -m tests.benchmark.bench_stitch --sizes 10,100 -o base.json
+#      python -m tests.benchmark.bench_stitch --compare base.json
+#
+# Run it from the repository root. With --compare, the exit code is 1 if any
+# case got slower than the baseline by more than --tolerance.
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from . import synthetic_library as synth
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+CASES = ('chain', 'hubs')
+
+# Nodes per hub network in the multi-hub case: the hub plus two arms.
+HUB_NETWORK_NODES = 50
+
+
+def parse_args(args):
+    desc = ('Benchmark stitch.py on a synthetic module library: stitching '
+            'time, throughput and peak memory per design size.')
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--sizes', default='10,100,1000,5000',
+                        help='Comma separated design node counts.')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma separated subset of ' + ', '.join(CASES))
+    parser.add_argument('--work_dir', default='',
+                        help='Keep the library, designs and CIFs here '
+                        'instead of a temporary directory.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Stitch each design this many times and keep '
+                        'the fastest run.')
+    parser.add_argument('-w', '--worker_count', default='1',
+                        help='Passed on to the Stitcher.')
+    parser.add_argument('-b', '--blend', action='store_true',
+                        help='Stitch with terminus blending.')
+    parser.add_argument('-l', '--module_library', action='store_true',
+                        help='Read modules from a packed module library '
+                        'instead of PDBs.')
+    parser.add_argument('-o', '--out_file', default='',
+                        help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', default='',
+                        help='Baseline JSON written by an earlier -o run.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed fractional throughput drop against '
+                        '--compare.')
+    parser.add_argument('--run_case', default='', help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def main(test_args=None):
+    args = parse_args(sys.argv[1:] if test_args is None else test_args)
+
+    if args.run_case:
+        print(json.dumps(run_case(args)))
+        return
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        run_benchmarks(args, args.work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='elfin_bench_')
+        try:
+            run_benchmarks(args, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+def run_benchmarks(args, work_dir):
+    lib_dir = os.path.join(work_dir, 'library')
+    xdb = synth.make_library(lib_dir)
+    if args.module_library:
+        pack_module_library(lib_dir)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    cases = args.cases.split(',')
+    for case in cases:
+        if case not in CASES:
+            raise ValueError('Unknown case: {}'.format(case))
+
+    results = []
+    print_row(('case', 'nodes', 'atoms', 'seconds',
+               'nodes/s', 'atoms/s', 'peak MB'))
+    for case in cases:
+        for size in sizes:
+            spec = make_design(xdb, case, size)
+            spec_file = os.path.join(
+                work_dir, '{}_{}.json'.format(case, size))
+            with open(spec_file, 'w') as file:
+                json.dump(spec, file)
+
+            runs = [run_case_process(args, lib_dir, spec_file)
+                    for _ in range(max(1, args.repeat))]
+            result = min(runs, key=lambda r: r['seconds'])
+            result['peak_mb'] = max(r['peak_mb'] for r in runs)
+            result['case'] = case
+            result['size'] = size
+            results.append(result)
+
+            print_row((
+                case,
+                result['nodes'],
+                result['atoms'],
+                '{:.3f}'.format(result['seconds']),
+                '{:.0f}'.format(result['nodes_per_s']),
+                '{:.0f}'.format(result['atoms_per_s']),
+                '{:.1f}'.format(result['peak_mb'])))
+
+    if args.out_file:
+        with open(args.out_file, 'w') as file:
+            json.dump({'results': results}, file, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)['results']
+        regressions = compare_results(baseline, results, args.tolerance)
+        for line in regressions:
+            print('Regression: ' + line)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}'.format(args.compare))
+
+
+def make_design(xdb, case, size):
+    """Returns design JSON of about size nodes for case.
+
+    The chain case is one network holding one chain. The hubs case splits
+    the nodes over hub networks of about HUB_NETWORK_NODES nodes, each with
+    one bare hub chain.
+    """
+    if case == 'chain':
+        return synth.chain_design(xdb, size)
+
+    n_hubs = max(1, size // HUB_NETWORK_NODES)
+    arm_length = max(1, (size // n_hubs - 1) // 2)
+    return synth.hub_design(xdb, arm_length, n_hubs=n_hubs)
+
+
+def pack_module_library(lib_dir):
+    try:
+        from elfinpy import pdb_utilities as pdb_utils
+        from elfinpy.module_library import ModuleLibraryWriter, MODULE_TYPES
+    except ImportError:
+        sys.path.insert(0, os.path.join(REPO_DIR, 'elfinpy'))
+        import pdb_utilities as pdb_utils
+        from module_library import ModuleLibraryWriter, MODULE_TYPES
+
+    writer = ModuleLibraryWriter()
+    for mod_type in MODULE_TYPES:
+        mod_dir = os.path.join(lib_dir, 'pdb_aligned', mod_type)
+        for pdb_file in sorted(os.listdir(mod_dir)):
+            writer.add(
+                mod_type,
+                pdb_file.replace('.pdb', ''),
+                pdb_utils.read_pdb_blocks(os.path.join(mod_dir, pdb_file)))
+    writer.save(os.path.join(lib_dir, 'modules.eml'))
+
+
+def run_case_process(args, lib_dir, spec_file):
+    command = [
+        sys.executable, '-m', 'tests.benchmark.bench_stitch',
+        '--run_case', spec_file,
+        '--work_dir', lib_dir,
+        '--worker_count', args.worker_count
+    ]
+    if args.blend:
+        command.append('--blend')
+    if args.module_library:
+        command.append('--module_library')
+
+    output = subprocess.check_output(command, cwd=REPO_DIR)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Runs in the child process: stitches args.run_case against the library in
+# args.work_dir and returns the measurements. Imports and reading the xdb are
+# not timed.
+def run_case(args):
+    try:
+        from elfinpy import stitch
+        from elfinpy import utilities as utils
+        from elfinpy import xdb as xdb_lib
+    except ImportError:
+        sys.path.insert(0, os.path.join(REPO_DIR, 'elfinpy'))
+        import stitch
+        import utilities as utils
+        import xdb as xdb_lib
+
+    lib_dir = args.work_dir
+    xdb = xdb_lib.XDB.load(os.path.join(lib_dir, 'xdb.json'))
+    spec = utils.read_json(args.run_case)
+    module_library = \
+        os.path.join(lib_dir, 'modules.eml') if args.module_library else ''
+
+    stitcher = stitch.Stitcher(
+        None,
+        xdb,
+        os.path.join(lib_dir, 'pdb_aligned'),
+        os.path.join(lib_dir, 'pdb_cappings'),
+        os.path.join(lib_dir, 'metadata'),
+        blend=args.blend,
+        worker_count=utils.parse_worker_count(args.worker_count),
+        module_library=module_library)
+
+    out_file = args.run_case.replace('.json', '.cif')
+    setup_mb = peak_rss_mb()
+    start = time.time()
+    stitcher.write_cif(out_file, spec)
+    seconds = time.time() - start
+
+    stats = stitcher.get_stats()
+    nodes = synth.count_nodes(spec)
+    atoms = stats['counters'].get('atoms', 0)
+    return {
+        'nodes': nodes,
+        'atoms': atoms,
+        'chains': stats['counters'].get('chains', 0),
+        'seconds': seconds,
+        'nodes_per_s': nodes / seconds,
+        'atoms_per_s': atoms / seconds,
+        'setup_mb': setup_mb,
+        'peak_mb': peak_rss_mb(),
+        'stats': stats
+    }
+
+
+def compare_results(baseline, results, tolerance):
+    """Finds cases whose throughput dropped against a baseline.
+
+    Args:
+    - baseline - results list from an earlier run
+    - results - results list from this run
+    - tolerance - allowed fractional drop in nodes per second
+
+    Returns:
+    - regressions - list of description strings, empty if none regressed
+    """
+    base_by_key = {(r['case'], r['size']): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = base_by_key.get((result['case'], result['size']))
+        if base is None:
+            continue
+        if result['nodes_per_s'] < base['nodes_per_s'] * (1 - tolerance):
+            regressions.append(
+                '{} {} nodes: {:.0f} nodes/s, baseline {:.0f}'.format(
+                    result['case'],
+                    result['size'],
+                    result['nodes_per_s'],
+                    base['nodes_per_s']))
+    return regressions
+
+
+def print_row(cols):
+    print('{:>6} {:>6} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(*cols))
+
+
+if __name__ == '__main__':
+    main()
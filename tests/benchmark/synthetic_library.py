@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+
+#
+# This script generates a synthetic module library that stitch.py can run on
+# without the private elfin-data PDBs: single, double and hub module PDBs,
+# capping PDBs with their repeat_indicies.csv, and an xdb whose transforms
+# agree with the generated geometry. It also generates single-chain and hub
+# design JSON of a given size on top of that xdb.
+#
+# Everything is seeded, so the same arguments always give the same files.
+#
+
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+# Backbone-ish atom offsets around each CA: (name, element, offset)
+RESIDUE_ATOMS = [
+    ('N', 'N', (-1.2, 0.4, -0.6)),
+    ('CA', 'C', (0.0, 0.0, 0.0)),
+    ('C', 'C', (1.1, 0.5, 0.6)),
+    ('O', 'O', (1.3, 1.6, 0.9)),
+    ('CB', 'C', (0.2, -1.4, 0.3)),
+    ('H', 'H', (-1.9, 0.1, -1.0))
+]
+RESIDUE_NAMES = ['ALA', 'LEU', 'GLY', 'SER', 'HIS']
+HUB_CHAIN_IDS = 'ABC'
+
+
+def parse_args(args):
+    desc = 'Generate a synthetic module library, xdb and test designs.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('out_dir')
+    parser.add_argument('--singles', type=int, default=4,
+                        help='Number of single modules.')
+    parser.add_argument('--hubs', type=int, default=1,
+                        help='Number of C3 hub modules.')
+    parser.add_argument('--length', type=int, default=24,
+                        help='Residue count of the shortest single.')
+    parser.add_argument('--chain_nodes', type=int, default=12,
+                        help='Node count of the example chain design.')
+    return parser.parse_args(args)
+
+
+def main(test_args=None):
+    args = parse_args(sys.argv[1:] if test_args is None else test_args)
+
+    xdb = make_library(
+        args.out_dir,
+        n_singles=args.singles,
+        n_hubs=args.hubs,
+        length=args.length)
+
+    with open(os.path.join(args.out_dir, 'chain.json'), 'w') as file:
+        json.dump(chain_design(xdb, args.chain_nodes), file)
+    with open(os.path.join(args.out_dir, 'hub.json'), 'w') as file:
+        json.dump(hub_design(xdb, 4, n_hubs=2), file)
+    print('Generated synthetic library in {}'.format(args.out_dir))
+
+
+def rotation(axis, angle):
+    """Returns the 3x3 rotation of angle radians around axis."""
+    axis = np.asarray(axis, dtype=float)
+    axis /= np.linalg.norm(axis)
+    k = np.array([
+        [0, -axis[2], axis[1]],
+        [axis[2], 0, -axis[0]],
+        [-axis[1], axis[0], 0]])
+    return np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k.dot(k)
+
+
+def make_residues(n_residues, seed):
+    """Generates a helical run of residues.
+
+    Args:
+    - n_residues - number of residues
+    - seed - random seed for the per-atom jitter and residue names
+
+    Returns:
+    - residues - list of (residue name, [(atom name, element, coord)])
+    """
+    rand = np.random.RandomState(seed)
+    residues = []
+    for i in range(n_residues):
+        theta = np.radians(100 * i)
+        ca = np.array([2.3 * np.cos(theta), 2.3 * np.sin(theta), 1.5 * i])
+        frame = rotation([np.cos(theta), np.sin(theta), 0.3], theta)
+        res_name = RESIDUE_NAMES[(i + seed) % len(RESIDUE_NAMES)]
+        atoms = []
+        for name, element, offset in RESIDUE_ATOMS:
+            if res_name == 'GLY' and name == 'CB':
+                continue
+            atoms.append((
+                name,
+                element,
+                ca + frame.dot(offset) + rand.uniform(-.05, .05, 3)))
+        residues.append((res_name, atoms))
+    return residues
+
+
+def center_residues(residues):
+    ca_coords = [c for _, atoms in residues for n, _, c in atoms if n == 'CA']
+    com = np.mean(ca_coords, axis=0)
+    return transform_residues(residues, np.eye(3), -com)
+
+
+def transform_residues(residues, rot, tran):
+    return [(res_name, [(n, e, rot.dot(c) + tran) for n, e, c in atoms])
+            for res_name, atoms in residues]
+
+
+def write_pdb(path, chains):
+    """Writes chains to a minimal PDB file.
+
+    Args:
+    - path - output file path
+    - chains - list of (chain id, residues)
+    """
+    lines = []
+    serial = 1
+    for chain_id, residues in chains:
+        for res_id, (res_name, atoms) in enumerate(residues, 1):
+            for name, element, coord in atoms:
+                lines.append(
+                    'ATOM  %5d %-4s %3s %s%4d    %8.3f%8.3f%8.3f'
+                    '  1.00  0.00          %2s\n' % (
+                        serial,
+                        (' ' + name) if len(name) < 4 else name,
+                        res_name, chain_id, res_id,
+                        coord[0], coord[1], coord[2],
+                        element))
+                serial += 1
+        lines.append('TER   \n')
+    lines.append('END   \n')
+    with open(path, 'w') as file:
+        file.writelines(lines)
+
+
+def make_tx(mod_a, mod_a_chain, mod_b, mod_b_chain, rot, tran):
+    return {
+        'mod_a': mod_a,
+        'mod_a_chain': mod_a_chain,
+        'mod_b': mod_b,
+        'mod_b_chain': mod_b_chain,
+        'rot': np.asarray(rot).tolist(),
+        'tran': np.asarray(tran).tolist()
+    }
+
+
+def make_library(
+        out_dir,
+        n_singles=4,
+        n_hubs=1,
+        length=24,
+        cap_length=6,
+        repeat_length=6):
+    """Writes a synthetic module library and its xdb.
+
+    Creates pdb_aligned/{singles,doubles,hubs}, pdb_cappings,
+    metadata/repeat_indicies.csv and xdb.json under out_dir. Every ordered
+    pair of singles forms a double, and every chain of a hub accepts every
+    single at its C terminus.
+
+    Args:
+    - out_dir - root directory of the library
+    - n_singles - number of single modules; single k has length+2k residues
+    - n_hubs - number of C3 hubs with free C termini
+    - length - residue count of the shortest single
+    - cap_length - residue count of each cap
+    - repeat_length - residues shared by a cap and its single
+
+    Returns:
+    - xdb - the xdb dict that was written to xdb.json
+    """
+    for sub_dir in ('pdb_aligned/singles', 'pdb_aligned/doubles',
+                    'pdb_aligned/hubs', 'pdb_cappings', 'metadata'):
+        os.makedirs(os.path.join(out_dir, sub_dir), exist_ok=True)
+
+    radii = {'average_all': 1., 'max_ca_dist': 1., 'max_heavy_dist': 1.}
+    modules = {'singles': {}, 'hubs': {}}
+    n_to_c_tx = []
+
+    singles = {}
+    for k in range(n_singles):
+        name = 'D{}'.format(k + 1)
+        singles[name] = center_residues(make_residues(length + 2 * k, k))
+        write_pdb(
+            os.path.join(out_dir, 'pdb_aligned/singles', name + '.pdb'),
+            [('A', singles[name])])
+        modules['singles'][name] = {
+            'chains': {
+                'A': {'n': {}, 'c': {}, 'n_residues': len(singles[name])}
+            },
+            'radii': radii
+        }
+
+    # Doubles: b placed at a's C terminus, with jitter so that aligning the
+    # double back onto its singles is not exact.
+    double_tx = {}
+    for a in singles:
+        for b in singles:
+            ia, ib = int(a[1:]), int(b[1:])
+            rot = rotation([np.sin(ia), np.cos(ib), 0.5],
+                           0.3 + 0.1 * ia + 0.05 * ib)
+            tran = np.array([3.0 * ia, -2.0 * ib, 1.5 * len(singles[a])])
+            double_tx[a, b] = (rot, tran)
+
+            jitter = np.random.RandomState(ia * 10 + ib)
+            double = [
+                (res_name,
+                 [(n, e, c + jitter.uniform(-.4, .4, 3)) for n, e, c in atoms])
+                for res_name, atoms in
+                singles[a] + transform_residues(singles[b], rot, tran)]
+            write_pdb(
+                os.path.join(
+                    out_dir, 'pdb_aligned/doubles', a + '-' + b + '.pdb'),
+                [('A', double)])
+
+            tx_id = len(n_to_c_tx)
+            n_to_c_tx.append(make_tx(a, 'A', b, 'A', rot, tran))
+            modules['singles'][a]['chains']['A']['c'] \
+                .setdefault(b, {})['A'] = tx_id
+            modules['singles'][b]['chains']['A']['n'] \
+                .setdefault(a, {})['A'] = tx_id
+
+    # Hubs: three rotated copies of one single, each with a free C terminus.
+    for h in range(n_hubs):
+        hub_name = 'H{}'.format(h + 1)
+        component = 'D{}'.format(h % n_singles + 1)
+        hub_chains = []
+        hub_chain_info = {}
+        for j, chain_id in enumerate(HUB_CHAIN_IDS):
+            rot = rotation([0, 0, 1], 2 * np.pi * j / len(HUB_CHAIN_IDS))
+            tran = rot.dot([8.0, 0, 0])
+            hub_chains.append(
+                (chain_id, transform_residues(singles[component], rot, tran)))
+            hub_chain_info[chain_id] = {
+                'single_name': component,
+                'n': {},
+                'n_tip': {},
+                'c': {},
+                'c_tip': {},
+                'n_residues': len(singles[component])
+            }
+            for b in singles:
+                rot_b, tran_b = double_tx[component, b]
+                tx_id = len(n_to_c_tx)
+                n_to_c_tx.append(make_tx(
+                    hub_name, chain_id, b, 'A',
+                    rot.dot(rot_b), rot.dot(tran_b) + tran))
+                hub_chain_info[chain_id]['c'].setdefault(b, {})['A'] = tx_id
+                modules['singles'][b]['chains']['A']['n'] \
+                    .setdefault(hub_name, {})[chain_id] = tx_id
+        write_pdb(
+            os.path.join(out_dir, 'pdb_aligned/hubs', hub_name + '.pdb'),
+            hub_chains)
+        modules['hubs'][hub_name] = {
+            'oligomer_type': 'C3',
+            'symmetric': True,
+            'chains': hub_chain_info,
+            'radii': radii
+        }
+
+    # Caps: each cap PDB holds the cap plus repeat_length residues of its
+    # single, deliberately in a different frame from the aligned single.
+    csv_rows = []
+    for k, name in enumerate(singles):
+        residues = singles[name]
+        rot = rotation([1, 2, 3], 0.7 + k)
+        tran = np.array([5., -3., 2.])
+
+        first_ca = residues[0][1][1][2]
+        n_cap = transform_residues(
+            make_residues(cap_length, 50 + k),
+            np.eye(3),
+            first_ca - np.array([0, 0, 1.5 * cap_length]))
+        write_pdb(
+            os.path.join(out_dir, 'pdb_cappings', name + '_NI.pdb'),
+            [('A', transform_residues(
+                n_cap + residues[:repeat_length], rot, tran))])
+
+        last_ca = residues[-1][1][1][2]
+        c_cap = transform_residues(
+            make_residues(cap_length, 70 + k),
+            np.eye(3),
+            last_ca + np.array([0, 0, 1.5]))
+        write_pdb(
+            os.path.join(out_dir, 'pdb_cappings', name + '_IC.pdb'),
+            [('A', transform_residues(
+                residues[-repeat_length:] + c_cap, rot.T, -tran))])
+
+        csv_rows.append('DHR{}.pdb {} {} {} {}'.format(
+            name[1:],
+            cap_length + 1,
+            cap_length + repeat_length,
+            1,
+            repeat_length))
+
+    with open(os.path.join(out_dir, 'metadata/repeat_indicies.csv'), 'w') \
+            as file:
+        file.write('\n'.join(csv_rows) + '\n')
+
+    xdb = {'modules': modules, 'n_to_c_tx': n_to_c_tx}
+    with open(os.path.join(out_dir, 'xdb.json'), 'w') as file:
+        json.dump(xdb, file, indent=4)
+    return xdb
+
+
+def compose(frame, rot, tran):
+    frame_rot, frame_tran = frame
+    return frame_rot.dot(rot), frame_rot.dot(tran) + frame_tran
+
+
+def chain_nodes(xdb, mod_names, prefix, start=None):
+    """Places a run of singles joined C to N, starting at frame start.
+
+    Returns:
+    - nodes - dict of node name to elfin-ui node JSON
+    """
+    if start is None:
+        start = (np.eye(3), np.zeros(3))
+    n_to_c_tx = xdb['n_to_c_tx']
+    singles = xdb['modules']['singles']
+
+    nodes = {}
+    frame = start
+    for i, mod_name in enumerate(mod_names):
+        node_name = '{}{}'.format(prefix, i)
+        node = {
+            'module_name': mod_name,
+            'module_type': 'single',
+            'c_linkage': [],
+            'n_linkage': [],
+            'rot': frame[0].tolist(),
+            'tran': frame[1].tolist()
+        }
+        if i + 1 < len(mod_names):
+            tx = n_to_c_tx[singles[mod_name]['chains']['A']['c']
+                           [mod_names[i + 1]]['A']]
+            node['c_linkage'].append({
+                'source_chain_id': 'A',
+                'target_chain_id': 'A',
+                'terminus': 'c',
+                'target_mod': '{}{}'.format(prefix, i + 1)
+            })
+            frame = compose(frame, np.asarray(tx['rot']),
+                            np.asarray(tx['tran']))
+        if i > 0:
+            node['n_linkage'].append({
+                'source_chain_id': 'A',
+                'target_chain_id': 'A',
+                'terminus': 'n',
+                'target_mod': '{}{}'.format(prefix, i - 1)
+            })
+        nodes[node_name] = node
+    return nodes
+
+
+def chain_design(xdb, n_nodes, seed=0):
+    """Returns design JSON of one network holding a single n_nodes chain."""
+    names = sorted(xdb['modules']['singles'])
+    rand = np.random.RandomState(seed)
+    mod_names = [names[i] for i in rand.randint(0, len(names), n_nodes)]
+    return {
+        'pg_networks': {},
+        'networks': {'net0': chain_nodes(xdb, mod_names, 'n')}
+    }
+
+
+def hub_design(xdb, arm_length, n_hubs=1, seed=0, unused_arm=True):
+    """Returns design JSON of n_hubs networks, each a hub with arms.
+
+    Each network is a hub with an arm_length chain of singles on its chains.
+    If unused_arm is True the last hub chain is left bare, so the stitcher
+    has to handle an unused hub component too.
+    """
+    names = sorted(xdb['modules']['singles'])
+    hub_names = sorted(xdb['modules']['hubs'])
+    n_to_c_tx = xdb['n_to_c_tx']
+    rand = np.random.RandomState(seed)
+
+    networks = {}
+    for h in range(n_hubs):
+        hub_name = hub_names[h % len(hub_names)]
+        hub = xdb['modules']['hubs'][hub_name]
+        origin = (np.eye(3), np.array([100.0 * h, 0, 0]))
+        hub_node = {
+            'module_name': hub_name,
+            'module_type': 'hub',
+            'c_linkage': [],
+            'n_linkage': [],
+            'rot': origin[0].tolist(),
+            'tran': origin[1].tolist()
+        }
+        nodes = {'hub': hub_node}
+
+        chain_ids = sorted(hub['chains'])
+        if unused_arm:
+            chain_ids = chain_ids[:-1]
+        for chain_id in chain_ids:
+            mod_names = [
+                names[i] for i in rand.randint(0, len(names), arm_length)]
+            tx = n_to_c_tx[hub['chains'][chain_id]['c'][mod_names[0]]['A']]
+            prefix = 'a{}_'.format(chain_id)
+            arm = chain_nodes(
+                xdb, mod_names, prefix,
+                compose(origin, np.asarray(tx['rot']),
+                        np.asarray(tx['tran'])))
+            arm[prefix + '0']['n_linkage'].append({
+                'source_chain_id': 'A',
+                'target_chain_id': chain_id,
+                'terminus': 'n',
+                'target_mod': 'hub'
+            })
+            hub_node['c_linkage'].append({
+                'source_chain_id': chain_id,
+                'target_chain_id': 'A',
+                'terminus': 'c',
+                'target_mod': prefix + '0'
+            })
+            nodes.update(arm)
+        networks['hubnet{}'.format(h)] = nodes
+    return {'pg_networks': {}, 'networks': networks}
+
+
+def count_nodes(spec):
+    return sum(len(nw) for nw in spec['networks'].values())
+
+
+if __name__ == '__main__':
+    main()
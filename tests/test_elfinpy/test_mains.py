@@ -20,7 +20,10 @@ def test_mains():
   script_main_test('preprocess')
   script_main_test('hubinfo_convert')
   script_main_test('dbgen')
+  script_main_test('module_library')
+  script_main_test('xdb')
   script_main_test('stitch')
+  script_main_test('stitch_server')
 
   script_main_test('job_dispatcher')
   script_main_test('rmsd')
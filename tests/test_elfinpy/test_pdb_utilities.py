@@ -0,0 +1,171 @@
+import io
+import os
+
+import numpy as np
+import pytest
+import Bio.PDB
+
+from elfinpy import pdb_utilities as pdb_utils
+from tests.benchmark import synthetic_library as synth
+
+@pytest.fixture(scope='module')
+def lib_dir(tmp_path_factory):
+  lib_dir = str(tmp_path_factory.mktemp('lib'))
+  synth.make_library(lib_dir, n_singles=2, n_hubs=1, length=8)
+  return lib_dir
+
+@pytest.fixture
+def atom_lines(lib_dir):
+  with open(os.path.join(lib_dir, 'pdb_aligned', 'hubs', 'H1.pdb')) as file:
+    return [l.rstrip('\n') for l in file if l.startswith('ATOM')]
+
+def bio_blocks(path):
+  return pdb_utils.get_chain_blocks(pdb_utils.read_pdb(path))
+
+def assert_same_blocks(expected, actual):
+  assert list(expected) == list(actual)
+  for chain_id in expected:
+    assert np.array_equal(expected[chain_id].atoms, actual[chain_id].atoms)
+    assert np.array_equal(expected[chain_id].coord, actual[chain_id].coord)
+    assert actual[chain_id].coord.dtype == expected[chain_id].coord.dtype
+    assert np.array_equal(
+      expected[chain_id].res_starts, actual[chain_id].res_starts)
+
+def write_text(tmp_path, lines, newline='\n'):
+  path = str(tmp_path / 'test.pdb')
+  with open(path, 'w', newline='') as file:
+    file.write(''.join(l + newline for l in lines))
+  return path
+
+def with_chain(line, chain_id):
+  return line[:21] + chain_id + line[22:]
+
+@pytest.mark.filterwarnings('ignore::Bio.PDB.PDBExceptions.PDBConstructionWarning')
+def test_parse_pdb_blocks_matches_bio(tmp_path, atom_lines):
+  header = ['HEADER    TEST', 'REMARK   1 SYNTHETIC']
+  cases = [
+    atom_lines,
+    header + atom_lines + ['TER', 'END'],
+    [l[:76] + l[76:78].lower() for l in atom_lines],
+    [l.rstrip() for l in atom_lines],
+  ]
+  for lines in cases:
+    path = write_text(tmp_path, lines)
+    expected = bio_blocks(path)
+    with open(path, 'rb') as file:
+      assert_same_blocks(expected, pdb_utils.parse_pdb_blocks(file.read()))
+    assert_same_blocks(expected, pdb_utils.read_pdb_blocks(path))
+
+    ca_only = pdb_utils.read_pdb_blocks(path, ca_only=True)
+    assert_same_blocks(
+      {k: b.ca_atoms() for k, b in expected.items()}, ca_only)
+
+@pytest.mark.filterwarnings('ignore::Bio.PDB.PDBExceptions.PDBConstructionWarning')
+def test_unsupported_input_falls_back(tmp_path, atom_lines):
+  a = atom_lines
+  n = len(a)
+  cases = {
+    'crlf': (a, '\r\n'),
+    'hetatm': (a[:5] + ['HETATM' + a[5][6:]] + a[6:], '\n'),
+    'altloc': (a[:5] + [a[5][:16] + 'A' + a[5][17:]] + a[6:], '\n'),
+    'models': (['MODEL        1'] + a + ['ENDMDL'], '\n'),
+    'no_element': ([l[:76] for l in a], '\n'),
+    'unknown_element': (a[:5] + [a[5][:76] + 'QQ'] + a[6:], '\n'),
+    'bad_number': (a[:5] + [a[5][:54] + '  x.00' + a[5][60:]] + a[6:], '\n'),
+    'space_in_name': (a[:5] + [a[5][:12] + ' C A' + a[5][16:]] + a[6:], '\n'),
+    'repeated_atom': (a[:5] + [a[4]] + a[5:], '\n'),
+    'repeated_residue': (a + a[:4], '\n'),
+    'split_chain':
+      ([with_chain(l, 'X') for l in a[:n // 3]] + a[n // 3:2 * n // 3] +
+       [with_chain(l, 'X') for l in a[2 * n // 3:]], '\n'),
+  }
+  for name, (lines, newline) in cases.items():
+    path = write_text(tmp_path, lines, newline)
+    with open(path, 'rb') as file:
+      with pytest.raises(ValueError):
+        pdb_utils.parse_pdb_blocks(file.read())
+
+    # The fallback reads the file as Bio.PDB does, errors included.
+    try:
+      expected = bio_blocks(path)
+    except Exception as e:
+      with pytest.raises(type(e)):
+        pdb_utils.read_pdb_blocks(path)
+      continue
+    assert_same_blocks(expected, pdb_utils.read_pdb_blocks(path))
+
+def pdbio_text(struct):
+  pdb_io = Bio.PDB.PDBIO()
+  pdb_io.set_structure(struct)
+  out = io.StringIO()
+  pdb_io.save(out)
+  return out.getvalue()
+
+def read_text(path):
+  with open(path) as file:
+    return file.read()
+
+def scrambled_blocks(path, seed):
+  # Values that exercise rounding, signs and column widths.
+  rand = np.random.RandomState(seed)
+  chain_blocks = pdb_utils.read_pdb_blocks(path)
+  for block in chain_blocks.values():
+    n = len(block)
+    coord = rand.uniform(-999, 999, (n, 3))
+    coord[::7] = np.round(coord[::7], 3) + 0.0005
+    coord[::11] = -np.round(coord[::11], 1)
+    block.coord = coord.astype(np.float32).astype(np.float64)
+    block.atoms['bfactor'] = np.round(rand.uniform(-99, 999, n), 3)
+    block.atoms['occupancy'] = np.round(rand.uniform(0, 1, n), 3)
+  return chain_blocks
+
+@pytest.mark.filterwarnings('ignore::Bio.PDB.PDBExceptions.PDBConstructionWarning')
+def test_format_pdb_matches_pdbio(tmp_path, lib_dir):
+  out_path = str(tmp_path / 'out.pdb')
+  paths = [os.path.join(lib_dir, 'pdb_aligned', 'hubs', 'H1.pdb'),
+           os.path.join(lib_dir, 'pdb_aligned', 'singles', 'D1.pdb')]
+  for path in paths:
+    struct = pdb_utils.read_pdb(path)
+    assert len(list(struct.get_chains())) > 1 or 'singles' in path
+    expected = pdbio_text(struct)
+    assert pdb_utils.format_pdb(pdb_utils.get_pdb_blocks(struct)) == expected
+    pdb_utils.save_pdb(struct=struct, path=out_path)
+    assert read_text(out_path) == expected
+
+    for seed in range(3):
+      chain_blocks = scrambled_blocks(path, seed)
+      expected = pdbio_text(pdb_utils.structure_from_blocks('0', chain_blocks))
+      assert pdb_utils.format_pdb(chain_blocks) == expected
+      pdb_utils.save_pdb(chain_blocks=chain_blocks, path=out_path)
+      assert read_text(out_path) == expected
+
+@pytest.mark.filterwarnings('ignore::Bio.PDB.PDBExceptions.PDBConstructionWarning')
+def test_save_pdb_falls_back_to_pdbio(tmp_path, lib_dir, atom_lines):
+  out_path = str(tmp_path / 'out.pdb')
+  hub_path = os.path.join(lib_dir, 'pdb_aligned', 'hubs', 'H1.pdb')
+
+  # Two models
+  struct = pdb_utils.read_pdb(hub_path)
+  model = struct[0].copy()
+  model.id = 1
+  model.serial_num = 2
+  struct.add(model)
+  # Alternate locations
+  altloc_path = write_text(
+    tmp_path, atom_lines[:5] + [atom_lines[5][:16] + 'A' + atom_lines[5][17:]] +
+    [atom_lines[5][:16] + 'B' + atom_lines[5][17:]] + atom_lines[6:])
+
+  for struct in (struct, pdb_utils.read_pdb(altloc_path)):
+    with pytest.raises(ValueError):
+      pdb_utils.get_pdb_blocks(struct)
+    pdb_utils.save_pdb(struct=struct, path=out_path)
+    assert read_text(out_path) == pdbio_text(struct)
+
+  # B factors that do not fit %6.2f, which PDBIO writes anyway
+  chain_blocks = pdb_utils.read_pdb_blocks(hub_path)
+  chain_blocks['B'].atoms['bfactor'][3] = 12345.
+  with pytest.raises(ValueError):
+    pdb_utils.format_pdb(chain_blocks)
+  pdb_utils.save_pdb(chain_blocks=chain_blocks, path=out_path)
+  assert read_text(out_path) == \
+    pdbio_text(pdb_utils.structure_from_blocks('0', chain_blocks))
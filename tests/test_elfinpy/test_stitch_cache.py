@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+
+from elfinpy import stitch
+from elfinpy import pdb_utilities as pdb_utils
+from tests.benchmark import synthetic_library as synth
+
+def stitch_coords(lib_dir, xdb, spec, cache_dir=''):
+  stitcher = stitch.Stitcher(
+    spec,
+    xdb,
+    os.path.join(lib_dir, 'pdb_aligned'),
+    os.path.join(lib_dir, 'pdb_cappings'),
+    os.path.join(lib_dir, 'metadata'),
+    blend=True,
+    cache_dir=cache_dir)
+  coords = [block.coord.copy() for _, block in stitcher.stitch_chains()]
+  return coords, stitcher.stats.caches.get('chain', [0, 0])[0]
+
+def shift_pdb(path):
+  chain_blocks = pdb_utils.read_pdb_blocks(path)
+  for block in chain_blocks.values():
+    block.coord = block.coord + np.float32(0.5)
+  pdb_utils.save_pdb(chain_blocks=chain_blocks, path=path)
+  stat = os.stat(path)
+  os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def assert_same(a, b):
+  assert len(a) == len(b)
+  for coord_a, coord_b in zip(a, b):
+    np.testing.assert_array_equal(coord_a, coord_b)
+
+def test_chain_cache_follows_regenerated_pdbs(tmp_path):
+  lib_dir = str(tmp_path / 'lib')
+  cache_dir = str(tmp_path / 'cache')
+  xdb = synth.make_library(lib_dir, n_singles=3, n_hubs=1, length=12)
+  spec = synth.chain_design(xdb, 4)
+
+  cached, hits = stitch_coords(lib_dir, xdb, spec, cache_dir)
+  assert hits == 0
+  reused, hits = stitch_coords(lib_dir, xdb, spec, cache_dir)
+  assert hits == 1
+  assert_same(reused, cached)
+  assert_same(stitch_coords(lib_dir, xdb, spec)[0], cached)
+
+  # Regenerate the N cap, module and first double of the chain in turn.
+  nodes = spec['networks']['net0']
+  node = next(n for n in nodes.values() if not n['n_linkage'])
+  next_node = nodes[node['c_linkage'][0]['target_mod']]
+  paths = [
+    os.path.join(lib_dir, 'pdb_cappings',
+                 node['module_name'].split('_')[0] + '_NI.pdb'),
+    os.path.join(lib_dir, 'pdb_aligned', 'singles',
+                 node['module_name'] + '.pdb'),
+    os.path.join(lib_dir, 'pdb_aligned', 'doubles',
+                 node['module_name'] + '-' + next_node['module_name'] + '.pdb')
+  ]
+  for path in paths:
+    shift_pdb(path)
+    fresh = stitch_coords(lib_dir, xdb, spec)[0]
+    assert not all(np.array_equal(a, b) for a, b in zip(fresh, cached))
+    restitched, hits = stitch_coords(lib_dir, xdb, spec, cache_dir)
+    assert hits == 0
+    assert_same(restitched, fresh)
+    cached = fresh
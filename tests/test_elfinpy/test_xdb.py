@@ -0,0 +1,56 @@
+import os
+import json
+
+from elfinpy import xdb as xdb_lib
+from tests.benchmark import synthetic_library as synth
+
+def make_xdb(tmp_path):
+  xdb = synth.make_library(str(tmp_path), n_singles=3, n_hubs=1, length=12)
+  xdb_path = str(tmp_path / 'xdb.json')
+  with open(xdb_path) as file:
+    assert json.load(file) == xdb
+  return xdb_path, json.loads(json.dumps(xdb))
+
+def test_load_xdb_builds_and_reads_sidecar(tmp_path):
+  xdb_path, xdb = make_xdb(tmp_path)
+
+  assert xdb_lib.read_sidecar(xdb_path) is None
+  assert xdb_lib.load_xdb(xdb_path) == xdb
+  assert xdb_lib.read_sidecar(xdb_path) is not None
+  assert xdb_lib.load_xdb(xdb_path) == xdb
+
+def test_load_xdb_rebuilds_damaged_sidecar(tmp_path):
+  xdb_path, xdb = make_xdb(tmp_path)
+  sidecar_path = xdb_lib.sidecar_path(xdb_path)
+  xdb_lib.load_xdb(xdb_path)
+  with open(sidecar_path, 'rb') as file:
+    data = file.read()
+  header_end = len(xdb_lib.MAGIC) + 8
+
+  damaged = [
+    data[:12],
+    data[:header_end] + b'\xff' * 16 + data[header_end + 16:],
+    data[:header_end] + b'[' + data[header_end + 1:],
+    data[:header_end + 40],
+    data[:len(data) // 2],
+  ]
+  for i, sidecar in enumerate(damaged):
+    with open(sidecar_path, 'wb') as file:
+      file.write(sidecar)
+    # Touched but unchanged, so the sidecar would be checked by SHA1.
+    os.utime(xdb_path, ns=(i, i))
+
+    assert xdb_lib.read_sidecar(xdb_path) is None
+    assert xdb_lib.load_xdb(xdb_path) == xdb
+    assert xdb_lib.read_sidecar(xdb_path) is not None
+
+def test_load_xdb_accepts_touched_json(tmp_path):
+  xdb_path, xdb = make_xdb(tmp_path)
+  xdb_lib.load_xdb(xdb_path)
+  stat = os.stat(xdb_path)
+  os.utime(xdb_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+  header, arrays = xdb_lib.read_sidecar(xdb_path)
+  assert header['source']['mtime_ns'] == stat.st_mtime_ns + 10**9
+  assert xdb_lib.load_xdb(xdb_path) == xdb
+  assert xdb_lib.XDB.load(xdb_path).mod_names == header['mod_names']